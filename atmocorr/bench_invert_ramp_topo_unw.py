@@ -0,0 +1,302 @@
+#!/usr/bin/env python2
+# -*- coding: utf-8 -*-
+############################################
+#
+# PyGdalSAR: An InSAR post-processing package
+# written in Python-Gdal
+#
+############################################
+# Author        : Simon DAOUT (Oxford)
+############################################
+
+"""\
+bench_invert_ramp_topo_unw.py
+-------------
+Benchmark and accuracy test of invert_ramp_topo_unw.py. Synthesizes a network of ROI_PAC
+unwrapped interferograms (2 bands BIL format) with known ramps and phase/elevation terms,
+turbulent atmosphere, a deformation signal and coherence masks, with the matching
+baseline.rsc, list of interferograms and radar.hgt. Then, for each setting flat,nfit,ivar,
+times the estimation, --tsinv and apply stages and compares the corrections to the true ones.
+
+Stages are timed from three runs of invert_ramp_topo_unw.py: --estim=no (apply only),
+--estim=yes (estimation + apply) and --estim=no --tsinv=yes (time series inversion + apply).
+The apply time includes the start of the script.
+
+usage: bench_invert_ramp_topo_unw.py [--outdir=<path>] [--nlign=<value>] [--ncol=<value>] \
+[--nimages=<value>] [--nconnect=<value>] [--model=<flat,nfit,ivar>] [--settings=<list>] \
+[--threshold_coh=<value>] [--options=<string>] [--generate=<yes/no>] [--seed=<value>]
+
+Options:
+-h --help             Show this screen.
+--outdir PATH         Directory of the synthetic network and of the runs [default: ./bench_ramp]
+--nlign VALUE         Number of lines of the interferograms [default: 1500]
+--ncol VALUE          Number of columns of the interferograms [default: 1000]
+--nimages VALUE       Number of acquisitions [default: 20]
+--nconnect VALUE      Each acquisition is paired with the nconnect next ones [default: 3]
+--model VALUE         flat,nfit,ivar terms of the true corrections (see invert_ramp_topo_unw.py) [default: 3,0,0]
+--settings LIST       Settings flat,nfit,ivar tested, separated by spaces [default: "0,0,0 3,0,0 3,1,0 3,0,1 4,0,1"]
+--threshold_coh VALUE Threshold on coherence given to invert_ramp_topo_unw.py [default: 0.3]
+--options STRING      Additional arguments given to all runs of invert_ramp_topo_unw.py (e.g. "--nproc=4")
+--generate yes/no     If no, reuse the network already synthesized in outdir [default: yes]
+--seed VALUE          Seed of the random generator [default: 0]
+"""
+
+# system
+from os import path, environ
+import os, sys
+import subprocess
+import time
+import datetime
+
+# numpy
+import numpy as np
+
+# scipy
+import scipy.ndimage as ndimage
+
+import docopt
+import roipac
+
+# read arguments
+arguments = docopt.docopt(__doc__)
+
+if arguments["--outdir"] ==  None:
+    outdir = './bench_ramp'
+else:
+    outdir = arguments["--outdir"]
+if arguments["--nlign"] ==  None:
+    nlign = 1500
+else:
+    nlign = int(arguments["--nlign"])
+if arguments["--ncol"] ==  None:
+    ncol = 1000
+else:
+    ncol = int(arguments["--ncol"])
+if arguments["--nimages"] ==  None:
+    nimages = 20
+else:
+    nimages = int(arguments["--nimages"])
+if arguments["--nconnect"] ==  None:
+    nconnect = 3
+else:
+    nconnect = int(arguments["--nconnect"])
+if arguments["--model"] ==  None:
+    model = [3,0,0]
+else:
+    model = map(int,arguments["--model"].split(','))
+if arguments["--settings"] ==  None:
+    settings = [[0,0,0],[3,0,0],[3,1,0],[3,0,1],[4,0,1]]
+else:
+    settings = [map(int,s.split(',')) for s in arguments["--settings"].strip('"\'').split()]
+if arguments["--threshold_coh"] ==  None:
+    threshold_coh = 0.3
+else:
+    threshold_coh = float(arguments["--threshold_coh"])
+if arguments["--options"] ==  None:
+    options = []
+else:
+    options = arguments["--options"].split()
+if arguments["--generate"] ==  None:
+    generate = 'yes'
+else:
+    generate = arguments["--generate"]
+if arguments["--seed"] ==  None:
+    seed = 0
+else:
+    seed = int(arguments["--seed"])
+
+script = path.join(path.dirname(path.abspath(__file__)), 'invert_ramp_topo_unw.py')
+outdir = path.abspath(outdir)
+int_path = outdir + '/int/'
+rlook = '4'
+
+# coefficients: 0:y**3 1:y**2 2:y 3:x**3 4:x**2 5:x 6:xy**2 7:xy 8:cst 9:z 10:z**2 11:yz 12:yz**2
+names = ['rg**3','rg**2','rg','az**3','az**2','az','az**2*rg**2','az*rg','cst','z','z**2','z*az','(z*az)**2']
+ramp_terms = [[8],[2,8],[5,8],[2,5,8],[2,5,7,8],[1,2,8],[4,5,8]]
+elev_terms = {(0,0):[9], (1,0):[9,10], (0,1):[9,11], (1,1):[9,11,12]}
+
+def terms(flat, nfit, ivar):
+    ''' Index of the coefficients estimated by invert_ramp_topo_unw.py for these settings '''
+    return ramp_terms[flat] + elev_terms[(nfit,ivar)]
+
+def eval_ramp(sol, z):
+    ''' Correction of the 13 coefficients sol on the whole image '''
+    rg = np.arange(ncol, dtype=np.float64)[np.newaxis,:]
+    az = np.arange(nlign, dtype=np.float64)[:,np.newaxis]
+    corr = (sol[0]*rg**3 + sol[1]*rg**2 + sol[2]*rg) + (sol[3]*az**3 + sol[4]*az**2 + sol[5]*az + sol[8])
+    corr = corr + (sol[6]*az**2)*rg**2 + (sol[7]*az)*rg
+    corr += (sol[9] + sol[11]*az)*z
+    corr += (sol[10] + sol[12]*az**2)*z**2
+    return corr
+
+def smooth_noise(rnd, sigma):
+    ''' Gaussian random field of unit standard deviation and correlation length sigma pixels '''
+    field = ndimage.gaussian_filter(rnd.randn(nlign,ncol), sigma)
+    return field/np.std(field)
+
+def unwname(date1, date2, suffout=''):
+    folder = int_path + 'int_'+ str(date1) + '_' + str(date2) + '/'
+    if suffout == '':
+        return folder + str(date1) + '-' + str(date2) + '_' + rlook + 'rlks.unw'
+    return folder + str(date1) + '-' + str(date2) + '_' + suffout + '_' + rlook + 'rlks.unw'
+
+#####################################################################################
+# SYNTHETIC NETWORK
+#####################################################################################
+
+rnd = np.random.RandomState(seed)
+
+# acquisitions every 12 days and interferograms with the nconnect next acquisitions
+t0 = datetime.date(2015,1,1)
+days = [t0 + datetime.timedelta(12*n) for n in xrange(nimages)]
+dates = np.array([int(d.strftime('%Y%m%d')) for d in days])
+bt = np.array([(d - t0).days/365.25 for d in days])
+date_1, date_2 = [], []
+for n in xrange(nimages):
+    for m in xrange(n+1, min(n+1+nconnect, nimages)):
+        date_1.append(dates[n]); date_2.append(dates[m])
+date_1, date_2 = np.array(date_1), np.array(date_2)
+kmax = len(date_1)
+
+# topography: smooth relief between 0 and 3000 m
+elev = smooth_noise(rnd, 80.) + 0.5*smooth_noise(rnd, 20.)
+elev = 3000.*(elev - np.min(elev))/(np.max(elev) - np.min(elev))
+zspan = np.max(elev) - np.min(elev)
+
+# size of each term over the image: random coefficients give corrections of about 1-3 rad
+span = np.array([ncol**3, ncol**2, ncol, nlign**3, nlign**2, nlign, (nlign*ncol)**2, nlign*ncol,
+    1., zspan, zspan**2, nlign*zspan, (nlign*zspan)**2], dtype=np.float64)
+true_terms = terms(*model)
+coeffs = np.zeros((nimages,13))
+for t in true_terms:
+    coeffs[:,t] = 2.*rnd.randn(nimages)/span[t]
+
+# true corrections of the interferograms
+true_sol = coeffs[np.searchsorted(dates,date_2)] - coeffs[np.searchsorted(dates,date_1)]
+
+if generate == 'yes':
+    print 'Synthesize {} interferograms of {} x {} pixels from {} acquisitions in {}'.format(kmax,nlign,ncol,nimages,outdir)
+    start = time.time()
+    if not path.exists(int_path):
+        os.makedirs(int_path)
+    rsc = {'XMIN':0, 'XMAX':ncol-1, 'YMIN':0, 'YMAX':nlign-1}
+    roipac.write_unw(outdir + '/radar.hgt', np.ones((nlign,ncol),dtype=np.float32), elev.astype(np.float32), rsc)
+
+    fid = open(outdir + '/baseline.rsc', 'w')
+    bp = 100.*rnd.randn(nimages)
+    for n in xrange(nimages):
+        fid.write('{} {:.6f} {:.6f} 0 {:.6f}\n'.format(dates[n], bp[n], bt[n], bt[n]))
+    fid.close()
+    np.savetxt(outdir + '/list_pair', np.vstack([date_1,date_2]).T, fmt='%i')
+
+    # turbulent atmosphere of each acquisition and subsiding zone of 2 rad/yr
+    aps = [0.5*smooth_noise(rnd, 15.).astype(np.float32) for n in xrange(nimages)]
+    az, rg = np.ogrid[:nlign,:ncol]
+    defo = -2.*np.exp(-((az-0.3*nlign)**2 + (rg-0.6*ncol)**2)/(2.*(0.05*(nlign+ncol))**2))
+    for kk in xrange(kmax):
+        n, m = np.searchsorted(dates,date_1[kk]), np.searchsorted(dates,date_2[kk])
+        # coherence decreasing with time, incoherent patches set to 0
+        coh = np.clip(0.75 - 0.02*(m-n) + 0.25*smooth_noise(rnd, 10.), 0., 1.)
+        phi = eval_ramp(true_sol[kk], elev) + defo*(bt[m]-bt[n]) + aps[m] - aps[n]
+        phi += 0.3*rnd.randn(nlign,ncol)*(1.-coh)
+        phi[coh<0.2] = 0.
+        if not path.exists(path.dirname(unwname(date_1[kk],date_2[kk]))):
+            os.makedirs(path.dirname(unwname(date_1[kk],date_2[kk])))
+        roipac.write_unw(unwname(date_1[kk],date_2[kk]), coh.astype(np.float32), phi.astype(np.float32), rsc)
+    del aps, defo, coh, phi
+    print 'Done in {:.1f} s'.format(time.time()-start)
+
+    # true coefficients in the format of liste_coeff_ramps.txt
+    true_spint = np.zeros((kmax,16))
+    true_spint[:,0], true_spint[:,1], true_spint[:,2] = date_1, date_2, nlign
+    true_spint[:,3:] = true_sol
+    np.savetxt(outdir + '/true_coeff_ramps.txt', true_spint, header='#date1   |   dates2   |   Lenght   |   '\
+        + '   |   '.join(names), fmt=['%i','%i','%.8f'] + ['%.8e']*13)
+
+#####################################################################################
+# RUNS
+#####################################################################################
+
+def run(flat, nfit, ivar, estim, tsinv, logname):
+    ''' Run invert_ramp_topo_unw.py in outdir and return its duration '''
+    cmd = [sys.executable, script, '--int_list=list_pair', '--int_path='+int_path, '--prefix=', '--suffix=',
+        '--rlook='+rlook, '--dates_list=baseline.rsc', '--topofile=radar.hgt', '--flat={}'.format(flat),
+        '--nfit={}'.format(nfit), '--ivar={}'.format(ivar), '--estim='+estim, '--tsinv='+tsinv,
+        '--cohpixel=yes', '--threshold_coh={}'.format(threshold_coh), '--plot=no'] + options
+    env = dict(environ)
+    # no display
+    env['TERM'] = 'screen'
+    log = open(outdir + '/' + logname, 'w')
+    start = time.time()
+    status = subprocess.call(cmd, cwd=outdir, stdout=log, stderr=subprocess.STDOUT, env=env)
+    duration = time.time() - start
+    log.close()
+    if status != 0:
+        print 'Run failed, see {}'.format(outdir + '/' + logname)
+        sys.exit()
+    return duration
+
+def map_errors():
+    ''' RMS (rad) of the differences between the corrections applied and the true ones,
+    without their mean, for each interferogram '''
+    err = np.zeros(kmax)
+    for kk in xrange(kmax):
+        phi_in = roipac.read_unw(unwname(date_1[kk],date_2[kk]))[1]
+        phi_out = roipac.read_unw(unwname(date_1[kk],date_2[kk],'_corrunw'))[1]
+        valid = np.logical_and(phi_in!=0, phi_out!=0)
+        diff = (phi_in - phi_out).astype(np.float64) - eval_ramp(true_sol[kk], elev)
+        diff = diff[valid]
+        err[kk] = np.sqrt(np.mean((diff - np.mean(diff))**2)) if len(diff) > 0 else np.nan
+    return err
+
+results = []
+for flat, nfit, ivar in settings:
+    setting = '{},{},{}'.format(flat,nfit,ivar)
+    print
+    print '#################################'
+    print 'flat={} nfit={} ivar={}'.format(flat,nfit,ivar)
+    print '#################################'
+    tag = 'bench_{}_{}_{}'.format(flat,nfit,ivar)
+
+    t_estim = run(flat, nfit, ivar, 'yes', 'no', tag + '_estim.log')
+    err_estim = map_errors()
+    spint = np.atleast_2d(np.loadtxt(outdir + '/liste_coeff_ramps.txt', comments='#'))
+    t_apply = run(flat, nfit, ivar, 'no', 'no', tag + '_apply.log')
+    t_tsinv = run(flat, nfit, ivar, 'no', 'yes', tag + '_tsinv.log')
+    err_tsinv = map_errors()
+    t_estim, t_tsinv = max(t_estim - t_apply, 0.), max(t_tsinv - t_apply, 0.)
+
+    # error of the coefficients of the true model, in rad over the image
+    coef_err = {}
+    for t in true_terms:
+        if t != 8:
+            coef_err[names[t]] = np.median(abs(spint[:,3+t] - true_sol[:,t]))*span[t]
+
+    print 'Estimation: {:.1f} s, {:.1f} int/min'.format(t_estim, 60.*kmax/max(t_estim,1e-6))
+    print 'Time series inversion: {:.1f} s'.format(t_tsinv)
+    print 'Apply: {:.1f} s, {:.1f} int/min'.format(t_apply, 60.*kmax/max(t_apply,1e-6))
+    print 'RMS of the correction errors (rad): {:.3f} (estimation), {:.3f} (tsinv)'.format(np.nanmedian(err_estim), np.nanmedian(err_tsinv))
+    print 'Median errors of the coefficients (rad over the image): ' + ', '.join(['{}: {:.3f}'.format(k,coef_err[k]) for k in sorted(coef_err)])
+    results.append([setting, t_estim, t_tsinv, t_apply, np.nanmedian(err_estim), np.nanmedian(err_tsinv)] \
+        + [coef_err[names[t]] for t in true_terms if t != 8])
+
+# summary
+header = ['flat,nfit,ivar', 'estim (s)', 'int/min', 'tsinv (s)', 'apply (s)', 'int/min', 'err estim', 'err tsinv'] \
+    + ['err ' + names[t] for t in true_terms if t != 8]
+lines = ['{:>14}'.format(h) for h in header]
+fid = open(outdir + '/bench_results.txt', 'w')
+fid.write('# {} interferograms of {} x {} pixels, model {}, options: {}\n'.format(kmax,nlign,ncol,
+    ','.join(map(str,model)),' '.join(options)))
+fid.write('#' + ''.join(lines) + '\n')
+print
+print ''.join(lines)
+for r in results:
+    row = [r[0], r[1], 60.*kmax/max(r[1],1e-6), r[2], r[3], 60.*kmax/max(r[3],1e-6)] + r[4:]
+    line = '{:>14}'.format(row[0]) + ''.join([' {:13.3f}'.format(v) for v in row[1:]])
+    print line
+    fid.write(' ' + line + '\n')
+fid.close()
+print
+print 'Errors are medians over the interferograms in rad: RMS of the difference between the correction'
+print 'applied and the true one, and errors of the coefficients times their span over the image.'
+print 'Results saved in {}'.format(outdir + '/bench_results.txt')
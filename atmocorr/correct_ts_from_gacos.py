@@ -12,13 +12,14 @@ Correct Time Series data from Gacos atmospheric models. 1) convert .ztd files to
 3) correct data
 
 Usage: correct_ts_from_gacos.py [--cube=<path>] [--path=<path>] [--list_images=<path>] [--imref=<value>] [--crop=<values>] \
-[--gacos2data=<value>] [--proj=<value>] [--ref=<values>] [--ramp=<yes/no>] [--zone=<values>] [--topofile=<path>] [--plot=<yes/no>] [--load=<yes/no>]
+[--gacos2data=<value>] [--proj=<value>] [--ref=<values>] [--ramp=<yes/no>] [--zone=<values>] [--topofile=<path>] [--plot=<yes/no>] [--load=<yes/no>] [--nproc=<value>] [--cache=<path>] \
+[--joint=<yes/no>] [--joint_scale=<shared/date>]
 
 correct_ts_from_gacos.py -h | --help
 
 Options:
 -h --help           Show this screen.
---cube PATH         Path to the cube of TS displacements file to be corrected from atmo models [default: depl_cumul]
+--cube PATH         Path to the cube of TS displacements file to be corrected from atmo models [default: depl_cumule]
 --path PATH         Path to .ztd data (default: ./GACOS/)
 --list_images PATH      Path to list images file made of 5 columns containing for each images 1) number 2) Doppler freq (not read) 3) date in YYYYMMDD format 4) numerical date 5) perpendicular baseline [default: images_retenues]
 --imref VALUE       Reference image number [default: 1]
@@ -31,6 +32,12 @@ Options:
 --gacos2data  VALUE Scaling value between zenithal gacos data (m) and desired output (e.g data in mm and LOS) [default: 1000.]
 --plot  YES/NO      Display results [default: yes]   
 --load YES/no       If no, do not load data again and directly read cube_gacos [default: True]   
+--nproc VALUE       Number of dates read, resampled and corrected in parallel [default: 1]
+--joint yes/no      If yes, fit all dates together in one weighted least-squares inversion of their binned statistics: one scaling factor
+of the GACOS models for all dates, and an offset (and ramp) for each date [default: no]
+--joint_scale VALUE Scaling factor of the joint fit shared by all dates (shared) or one per date (date) [default: shared]
+--cache PATH        Directory of the resampled models of each date, keyed by the size and date of the .ztd and .rsc files, the projection,
+the crop, the size of the data and gacos2data. With --load=yes, only new or modified dates are resampled [default: None]
 """
 
 import gdal
@@ -43,9 +50,14 @@ import matplotlib.cm as cm
 import matplotlib.pyplot as plt
 from mpl_toolkits.axes_grid1 import make_axes_locatable
 from numpy.lib.stride_tricks import as_strided
-import subprocess
+import scipy.sparse as sparse
+import scipy.sparse.linalg as splinalg
+import multiprocessing
+import hashlib
 np.warnings.filterwarnings('ignore')
 import docopt
+import binning
+import quicklook
 
 # read arguments
 arguments = docopt.docopt(__doc__)
@@ -96,6 +108,28 @@ if arguments["--load"] ==  None:
 else:
     load = arguments["--load"] 
 
+if arguments["--nproc"] ==  None:
+    nproc = 1
+else:
+    nproc = int(arguments["--nproc"])
+
+if arguments["--joint"] ==  None:
+    joint = 'no'
+else:
+    joint = arguments["--joint"]
+if arguments["--joint_scale"] ==  None:
+    joint_scale = 'shared'
+else:
+    joint_scale = arguments["--joint_scale"]
+if joint_scale not in ['shared','date']:
+    print 'Error: --joint_scale must be shared or date. Exit!'
+    sys.exit()
+
+if arguments["--cache"] ==  None:
+    cachedir = None
+else:
+    cachedir = arguments["--cache"]
+
 if arguments["--topofile"] ==  None:
    radar = None
 else:
@@ -140,93 +174,148 @@ if radar is not None:
 else:
     elev = np.zeros((nlign,ncol))
 
-# load cube of displacements
-cubei = np.fromfile('depl_cumule',dtype=np.float32)
-cube = as_strided(cubei[:nlign*ncol*N])
-print 'Number of line in the cube: ', cube.shape
-maps = cube.reshape((nlign,ncol,N))
+# cube of displacements mapped in memory
+maps = np.memmap(cubef,dtype=np.float32,mode='r',shape=(nlign,ncol,N))
+print 'Number of line in the cube: ', maps.shape
 
 nfigure = 0
 
-if load == 'yes':
-    gacos = np.zeros((nlign,ncol,N))
-    for i in xrange((N)):
-
-        print 'Read ',idates[i], i
-        infile = path+'{}.ztd'.format(int(idates[i]))
-        rsc = path+'{}.ztd.rsc'.format(int(idates[i]))
-        temp1 = path+'{}_temp1.tif'.format(int(idates[i]))
-        outtif = path+'{}_gacos.tif'.format(int(idates[i]))
-
-        # read .rsc
-        nncol = np.int(open(rsc).readlines()[0].split(None, 2)[1])
-        nnlign = np.int(open(rsc).readlines()[1].split(None, 2)[1])
-        xfirst = np.float(open(rsc).readlines()[6].split(None, 2)[1])
-        yfirst = np.float(open(rsc).readlines()[7].split(None, 2)[1])
-        xstep = np.float(open(rsc).readlines()[8].split(None, 2)[1])
-        ystep = np.float(open(rsc).readlines()[9].split(None, 2)[1])
-        geotransform = (xfirst, xstep, 0, yfirst, 0, ystep)
-        print 'Read .rsc and set Geotransform', geotransform
-        ztd_ = np.fromfile(infile, dtype='float32').reshape(nnlign,nncol)
-        
-        # transform gacos format to samething humanily readeable
-        driver = gdal.GetDriverByName('GTiff')
-        ds = driver.Create(temp1, nncol, nnlign, 1, gdal.GDT_Float32)
-        band = ds.GetRasterBand(1)
-        band.WriteArray(ztd_)
-        ds.SetGeoTransform(geotransform)
-        srs = osr.SpatialReference() 
-        srs.ImportFromEPSG(4326)
-        ds.SetProjection(srs.ExportToWkt()) 
-        band.FlushCache()
-        del ds,band
-
-        # crop, re-preoject and resample 
-        if proj and crop is not False:
-            print "gdalwarp -overwrite -s_srs EPSG:4326 -t_srs EPSG:"+str(EPSG)+\
-            " -ts "+str(ncol)+" "+str(nlign)+" -r average -te "+str(crop[0])+" "+str(crop[1])+" "+str(crop[2])+" "+str(crop[3])+" "\
-            +temp1+" "+outtif+" -of GTiff"
-            r = subprocess.call("gdalwarp -overwrite -s_srs EPSG:4326 -t_srs EPSG:"+str(EPSG)+\
-                " -te "+str(crop[0])+" "+str(crop[1])+" "+str(crop[2])+" "+str(crop[3])+" "\
-                +" -ts "+str(ncol)+" "+str(nlign)+" -r average "+temp1+" "+outtif+" -of GTiff", shell=True)
-            if r != 0:
-                raise Exception("gdalwarp failed")
-
-        elif crop is not False and proj is False:
-            print "gdalwarp -overwrite -s_srs EPSG:4326-ts "+str(ncol)+" "+str(nlign)+" -r average \
-            -te "+str(crop[0])+" "+str(crop[1])+" "+str(crop[2])+" "+str(crop[3])+" "+temp1+" "+outtif+" -of GTiff"
-            r = subprocess.call("gdalwarp -overwrite -s_srs EPSG:4326 -ts "+str(ncol)+" "+str(nlign)+" -r average \
-                -te "+str(crop[0])+" "+str(crop[1])+" "+str(crop[2])+" "+str(crop[3])+" "+temp1+" "+outtif+" -of GTiff", shell=True)
-            if r != 0:
-                raise Exception("gdalwarp failed")
-
-        elif proj and crop is False:
-            print "gdalwarp -overwrite -s_srs EPSG:4326 -t_srs EPSG:"+str(EPSG)+" -ts "+str(ncol)+" "+str(nlign)+" -r average "+temp1+" "+outtif+" -of GTiff"
-            r = subprocess.call("gdalwarp -overwrite -s_srs EPSG:4326 -t_srs EPSG:"+str(EPSG)+" -ts "+str(ncol)+" "+str(nlign)+" -r average "+temp1+" "+outtif+" -of GTiff", shell=True)
-            if r != 0:
-                raise Exception("gdalwarp failed")
-        
-        else:
-            print "gdalwarp -overwrite -ts "+str(ncol)+" "+str(nlign)+" -r average "+temp1+" "+outtif+" -of GTiff"
-            r = subprocess.call("gdalwarp -overwrite -ts "+str(ncol)+" "+str(nlign)+" -r average "+temp1+" "+outtif+" -of GTiff", shell=True)
-            if r != 0:
-                raise Exception("gdalwarp failed")
-
-        # del temporary files
-        cmd = 'rm -f {}'.format(temp1)
-        os.system(cmd)
+def read_rsc(rsc):
+    ''' Size and geotransform of a .ztd file from its .rsc file '''
+    lines = open(rsc).readlines()
+    nncol = np.int(lines[0].split(None, 2)[1])
+    nnlign = np.int(lines[1].split(None, 2)[1])
+    xfirst = np.float(lines[6].split(None, 2)[1])
+    yfirst = np.float(lines[7].split(None, 2)[1])
+    xstep = np.float(lines[8].split(None, 2)[1])
+    ystep = np.float(lines[9].split(None, 2)[1])
+    return nncol, nnlign, (xfirst, xstep, 0, yfirst, 0, ystep)
+
+def overlap_weights(edges, first, step, n):
+    ''' Sparse matrix averaging n source pixels of origin first and size step into the
+    destination pixels bounded by edges, each source pixel weighted by its overlap '''
+    u = (np.asarray(edges, dtype=np.float64) - first)/step
+    a, b = np.minimum(u[:-1],u[1:]), np.maximum(u[:-1],u[1:])
+    ndst = len(a)
+    kmin = np.floor(a).astype(int)
+    span = max(int(np.max(np.ceil(b) - kmin)), 1)
+    k = kmin[:,np.newaxis] + np.arange(span)[np.newaxis,:]
+    w = np.clip(np.minimum(b[:,np.newaxis], k+1) - np.maximum(a[:,np.newaxis], k), 0., None)
+    w[np.logical_or(k<0, k>=n)] = 0.
+    # average of the source pixels inside the grid, 0 outside
+    norm = np.sum(w, axis=1)
+    norm[norm==0] = 1.
+    w = w/norm[:,np.newaxis]
+    rows = np.repeat(np.arange(ndst), span)
+    keep = w.flatten()>0
+    return sparse.csr_matrix((w.flatten()[keep], (rows[keep], k.flatten()[keep])), shape=(ndst,n))
+
+def average_weights(nncol, nnlign, geotransform):
+    ''' Separable averaging weights from a .ztd grid to the data grid (no reprojection) '''
+    xfirst, xstep, _, yfirst, _, ystep = geotransform
+    if crop is not False:
+        xmin, ymin, xmax, ymax = crop
+    else:
+        xmin, xmax = min(xfirst, xfirst+nncol*xstep), max(xfirst, xfirst+nncol*xstep)
+        ymin, ymax = min(yfirst, yfirst+nnlign*ystep), max(yfirst, yfirst+nnlign*ystep)
+    wx = overlap_weights(np.linspace(xmin, xmax, ncol+1), xfirst, xstep, nncol)
+    wy = overlap_weights(np.linspace(ymax, ymin, nlign+1), yfirst, ystep, nnlign)
+    return wy, wx
+
+# resampling weights of each .ztd grid
+weights = {}
+# crop, re-project and resample options, identical for all dates
+wgs84 = osr.SpatialReference()
+wgs84.ImportFromEPSG(4326)
+wgs84 = wgs84.ExportToWkt()
+warp_options = gdal.WarpOptions(format='GTiff', srcSRS='EPSG:4326', dstSRS='EPSG:'+str(EPSG) if proj else None,
+    outputBounds=crop if crop is not False else None, width=ncol, height=nlign, resampleAlg='average')
+
+def fingerprint(filename):
+    ''' Size and modification time of a file, None if it does not exist '''
+    if filename is None or not os.path.exists(filename):
+        return None
+    return [os.path.getsize(filename), os.path.getmtime(filename)]
+
+def load_gacos(i):
+    ''' Resampled model of the image i, read from the cache if the .ztd file and the
+    resampling parameters did not change '''
+    infile = path+'{}.ztd'.format(int(idates[i]))
+    rsc = path+'{}.ztd.rsc'.format(int(idates[i]))
+    if cachedir is None:
+        return resample_gacos(infile, rsc, i)
+
+    key = hashlib.md5(repr([fingerprint(infile), fingerprint(rsc), proj, EPSG, crop, ncol, nlign, gacos2data])).hexdigest()
+    cachefile = os.path.join(cachedir, '{}_{}.npy'.format(int(idates[i]), key))
+    if os.path.exists(cachefile):
+        print 'Read ',cachefile, i
+        return np.load(cachefile)
+    model = resample_gacos(infile, rsc, i)
+    # written under a temporary name such that an interrupted run leaves no partial map
+    np.save(cachefile + '.tmp.npy', model)
+    os.rename(cachefile + '.tmp.npy', cachefile)
+    return model
+
+def resample_gacos(infile, rsc, i):
+    ''' Read the .ztd file of the image i and resample it on the data grid '''
+    print 'Read ',idates[i], i
+
+    # read .rsc
+    nncol, nnlign, geotransform = read_rsc(rsc)
+    ztd_ = np.fromfile(infile, dtype='float32').reshape(nnlign,nncol)
+
+    if not proj or EPSG == 4326:
+        # same projection: averaging is separable and precomputed for each grid
+        key = (nncol, nnlign, geotransform)
+        if key not in weights:
+            print 'Compute resampling weights for grid', geotransform
+            weights[key] = average_weights(nncol, nnlign, geotransform)
+        wy, wx = weights[key]
+        return (wy.dot(wx.dot(ztd_.T).T)*gacos2data).astype(np.float32)
+
+    # crop, re-project and resample in memory
+    temp1 = '/vsimem/{}_temp1.tif'.format(int(idates[i]))
+    outtif = '/vsimem/{}_gacos.tif'.format(int(idates[i]))
+    driver = gdal.GetDriverByName('GTiff')
+    ds = driver.Create(temp1, nncol, nnlign, 1, gdal.GDT_Float32)
+    band = ds.GetRasterBand(1)
+    band.WriteArray(ztd_)
+    ds.SetGeoTransform(geotransform)
+    ds.SetProjection(wgs84)
+    band.FlushCache()
+    dst = gdal.Warp(outtif, ds, options=warp_options)
+    if dst is None:
+        raise Exception("gdal.Warp failed for {}".format(infile))
+    model = dst.GetRasterBand(1).ReadAsArray()*gacos2data
+    del ds, band, dst
+    gdal.Unlink(temp1)
+    gdal.Unlink(outtif)
+    return model.astype(np.float32)
 
-        # open gacos
-        ds = gdal.Open(path+'{}_gacos.tif'.format(int(idates[i])), gdal.GA_ReadOnly)
-        band = ds.GetRasterBand(1)
-        gacos[:,:,i] = band.ReadAsArray()*gacos2data
-        del ds,band
+if load == 'yes':
+    # new cube filled date by date
+    gacos = np.memmap('cube_gacos',dtype=np.float32,mode='w+',shape=(nlign,ncol,N))
+    if cachedir is not None and not os.path.exists(cachedir):
+        os.makedirs(cachedir)
+    # weights of the first grid computed once before the processes are forked
+    if not proj or EPSG == 4326:
+        key = read_rsc(path+'{}.ztd.rsc'.format(int(idates[0])))
+        weights[key] = average_weights(*key)
+    if nproc > 1:
+        pool = multiprocessing.Pool(nproc)
+        for i, model in enumerate(pool.imap(load_gacos, xrange(N))):
+            gacos[:,:,i] = model
+        pool.close()
+        pool.join()
+    else:
+        for i in xrange((N)):
+            gacos[:,:,i] = load_gacos(i)
 
     # Ref atmo models to the reference image
-    cst = np.copy(gacos[:,:,imref])
+    cst = np.array(gacos[:,:,imref])
     for l in xrange((N)):
-        d = as_strided(gacos[:,:,l])
         gacos[:,:,l] = gacos[:,:,l] - cst
+    del cst
 
     # Plot
     fig = plt.figure(0,figsize=(14,10))
@@ -235,7 +324,8 @@ if load == 'yes':
     vmax = np.nanpercentile(gacos[:,:,-1],99)
     vmin = np.nanpercentile(gacos[:,:,-1],1)
     for l in xrange((N)):
-        d = as_strided(gacos[:,:,l])
+        # decimated to screen resolution such that the figure does not hold all the models
+        d = quicklook.decimate(gacos[:,:,l])
         ax = fig.add_subplot(4,int(N/4)+1,l+1)
         cax = ax.imshow(d,cmap=cmap,vmax=vmax,vmin=vmin)
         ax.set_title(idates[l],fontsize=6)
@@ -249,39 +339,43 @@ if load == 'yes':
         plt.show()
 
     # save new cube
-    fid = open('cube_gacos', 'wb')
-    gacos.flatten().astype('float32').tofile(fid)
-    fid.close()
+    gacos.flush()
+    del gacos
 
-# # load gacos cube
-gcubei = np.fromfile('cube_gacos',dtype=np.float32)
-gcube = as_strided(gcubei[:nlign*ncol*N])
-gacos = gcube.reshape((nlign,ncol,N))
+# gacos cube mapped in memory
+gacos = np.memmap('cube_gacos',dtype=np.float32,mode='r',shape=(nlign,ncol,N))
 
-# Apply correction
-maps_flat = np.zeros((nlign,ncol,N))
-for l in xrange(1,N):   
+# corrected cube mapped in memory, each date written directly by the process correcting it
+maps_flat = np.memmap('depl_cumule_gacos',dtype=np.float32,mode='w+',shape=(nlign,ncol,N))
+
+# coordinates of the lines and columns, and elevation bounds, shared by all dates
+pix_az = np.arange(nlign, dtype=np.float64)
+pix_rg = np.arange(ncol, dtype=np.float64)
+if radar is not None:
+    maxtopo,mintopo = np.nanpercentile(elev,98), np.nanpercentile(elev,2)
+else:
+    maxtopo,mintopo = 1, -1
 
-    data = as_strided(maps[:,:,l])
-    data_flat = as_strided(maps_flat[:,:,l])
-    model = as_strided(gacos[:,:,l])
+def bin_date(l):
+    ''' Select the points of the date l for the fit and, if ref is emp, compute the binned
+    statistics of the LOS as a function of the model. Returns the data and model maps,
+    the coordinates, LOS and model of the points and the bins (model, median LOS, std,
+    median line and median column of the bins) '''
+
+    data = np.array(maps[:,:,l])
+    model = np.array(gacos[:,:,l])
 
     losmin,losmax = np.nanpercentile(data,1.),np.nanpercentile(data,99.)
     gacosmin,gacosmax = np.nanpercentile(model,5),np.nanpercentile(model,95)
 
-    if radar is not None:
-        maxtopo,mintopo = np.nanpercentile(elev,98), np.nanpercentile(elev,2)
-    else:
-        maxtopo,mintopo = 1, -1
-
     # index = np.nonzero(data>2)
     # data[index] = np.float('NaN')
     # plt.imshow(data)
     # plt.show()
     # sys.exit()
 
-    funct = 0.
-    pix_lin, pix_col = np.indices((nlign,ncol))
+    # broadcast to the size of the maps in the selection
+    pix_lin, pix_col = pix_az[:,np.newaxis], pix_rg[np.newaxis,:]
     try:
         col_beg,col_end,line_beg,line_end = refzone[0],refzone[1],refzone[2],refzone[3]
     except:
@@ -308,33 +402,106 @@ for l in xrange(1,N):
     los_clean = data[index].flatten()
     model_clean = model[index].flatten()
 
+    stats = None
     if ref == 'emp':
 
         bins = np.arange(gacosmin,gacosmax,abs(gacosmax-gacosmin)/500.)
-        inds = np.digitize(model_clean,bins)
-        modelbins = []
-        losbins = []
-        losstd = []
-        xbins, ybins = [], []
-        for j in range(len(bins)-1):
-            uu = np.flatnonzero(inds == j)
-            if len(uu)>500:
-                modelbins.append(bins[j] + (bins[j+1] - bins[j])/2.)
-
-                indice = np.flatnonzero(np.logical_and(los_clean[uu]>np.percentile(\
-                    los_clean[uu],10.),los_clean[uu]<np.percentile(los_clean[uu],90.)))
-
-                losstd.append(np.std(los_clean[uu][indice]))
-                losbins.append(np.median(los_clean[uu][indice]))
-                xbins.append(np.median(x[uu][indice]))
-                ybins.append(np.median(y[uu][indice]))
-
-        losbins = np.array(losbins)
-        losstd = np.array(losstd)
-        modelbins = np.array(modelbins)
-        xbins, ybins = np.array(xbins),np.array(ybins)
-
+        # statistics of all bins at once
+        groups = binning.Groups(np.digitize(model_clean,bins))
+        # keep bins with more than 500 points
+        sel = np.logical_and(groups.labels < len(bins)-1, groups.count() > 500)
+        j = groups.labels[sel]
+        modelbins = bins[j] + (bins[j+1] - bins[j])/2.
+
+        # points between the 10th and 90th percentiles of the LOS of their bin
+        indice = groups.between(los_clean, 10., 90.)
+        losstd = groups.std(los_clean, indice)[sel]
+        losbins = groups.median(los_clean, indice)[sel]
+        xbins = groups.median(x, indice)[sel]
+        ybins = groups.median(y, indice)[sel]
+        stats = modelbins, losbins, losstd, xbins, ybins
+
+    return data, model, x, y, los_clean, model_clean, stats
+
+def date_bins(l):
+    ''' Binned statistics of the date l '''
+    return bin_date(l)[-1]
+
+def joint_fit(stats):
+    ''' Fit all dates at once: offset (and ramp) of each date and a scaling factor of the
+    model shared by all dates (or one per date if joint_scale is date), from the binned
+    statistics of the dates 1 to N-1. Returns the parameters of each date as correct_date. '''
+    nd = len(stats)
+    npar = 5 if doramp == 'yes' else 1
+    nscale = nd if joint_scale == 'date' else 1
+    rows, cols, vals, d, sig = [], [], [], [], []
+    nrow = 0
+    for k in xrange(nd):
+        modelbins, losbins, losstd, xbins, ybins = stats[k]
+        n = len(losbins)
+        if n == 0:
+            print 'No bins for date {}: offset set to 0'.format(idates[k+1])
+            continue
+        if doramp == 'yes':
+            G = np.vstack([xbins**2, xbins, ybins**2, ybins, np.ones(n)]).T
+        else:
+            G = np.ones((n,1))
+        r = nrow + np.arange(n)
+        # block of the date and column of the scaling factor
+        rows += [np.repeat(r,npar), r]
+        cols += [np.tile(k*npar + np.arange(npar),n), np.ones(n,dtype=int)*(nd*npar + (k if nscale > 1 else 0))]
+        vals += [G.flatten(), modelbins]
+        d.append(losbins); sig.append(losstd)
+        nrow += n
+    if nrow == 0:
+        print 'Error: no bins with more than 500 points for the joint fit. Exit!'
+        sys.exit()
+    d, sig = np.concatenate(d), np.concatenate(sig)
+    # bins with constant values
+    sig[sig<=0] = np.min(sig[sig>0]) if np.any(sig>0) else 1.
+    rows = np.concatenate(rows)
+    A = sparse.csr_matrix((np.concatenate(vals)/sig[rows],(rows,np.concatenate(cols))), shape=(nrow,nd*npar+nscale))
+    # normalise the columns (az**2 and the model have very different magnitudes)
+    norm = np.sqrt(np.asarray(A.multiply(A).sum(axis=0)).ravel())
+    norm[norm==0] = 1.
+    A = A.dot(sparse.diags(1./norm)).tocsc()
+    # normal equations in one sparse factorization, damped for dates without bins
+    N_ = (A.T.dot(A) + 1e-10*sparse.identity(A.shape[1])).tocsc()
+    pars = splinalg.factorized(N_)(A.T.dot(d/sig))/norm
+
+    params = []
+    for k in xrange(nd):
+        scale = pars[nd*npar + (k if nscale > 1 else 0)]
         if doramp == 'yes':
+            params.append(list(pars[k*npar:(k+1)*npar]) + [scale])
+        else:
+            params.append([0., 0., 0., 0., pars[k], scale])
+    if nscale == 1:
+        print 'Scaling factor of the GACOS models for all dates: %f'%(pars[-1])
+    return params
+
+def correct_date(l):
+    ''' Fit the GACOS model of the date l to the data (or use the parameters of the joint
+    fit), write the corrected date in the output cube and return the parameters of the fit:
+    az**2, az, r**2, r, cst, gacos (or a + b*gacos, or 0 and 1 if referenced to a pixel) '''
+    global nfigure
+
+    if joint_pars is not None and plot != 'yes':
+        # binned statistics of the joint fit: the points are only needed for the plot
+        data = np.array(maps[:,:,l])
+        model = np.array(gacos[:,:,l])
+        stats = joint_stats[l-1]
+    else:
+        data, model, x, y, los_clean, model_clean, stats = bin_date(l)
+    data_flat = maps_flat[:,:,l]
+
+    if ref == 'emp':
+        modelbins, losbins, losstd, xbins, ybins = stats
+
+        if joint_pars is not None:
+            pars = np.array(joint_pars[l-1])
+
+        elif doramp == 'yes':
             G=np.zeros((len(losbins),6))
             G[:,0] = xbins**2
             G[:,1] = xbins
@@ -347,26 +514,7 @@ for l in xrange(1,N):
             # print x0
             _func = lambda x: np.sum(((np.dot(G,x)-losbins)/losstd)**2)
             pars = opt.least_squares(_func,x0,jac='3-point',loss='cauchy').x
-            a = pars[0]; b = pars[1]; c = pars[2]; d = pars[3]; e = pars[4]; f = pars[5]
-            print 'Remove ramp %f az**2, %f az  + %f r**2 + %f r + %f + %f model for date: %i'%(a,b,c,d,e,f,idates[l])
-            funct = a*x**2 + b*x + c*y**2 + d*y + e
-            functbins = a*xbins**2 + b*xbins + c*ybins**2 + d*ybins + e
-
-            # build total G matrix
-            G=np.zeros((len(data.flatten()),6))
-            for i in xrange(nlign):
-                G[i*ncol:(i+1)*ncol,0] = i**2
-                G[i*ncol:(i+1)*ncol,1] = i
-                G[i*ncol:(i+1)*ncol,2] = np.arange(ncol)**2
-                G[i*ncol:(i+1)*ncol,3] = np.arange(ncol)
-            G[:,4] = 1
-            G[:,5] = model.flatten()
-
-            model = np.dot(G,pars).reshape(nlign,ncol)
-            model[model==0.] = 0.
-            model[np.isnan(data)] = np.float('NaN')
 
-        
         else:
             G=np.zeros((len(losbins),2))
             G[:,0] = 1
@@ -374,14 +522,20 @@ for l in xrange(1,N):
             x0 = lst.lstsq(G,losbins)[0]
             # print x0
             _func = lambda x: np.sum(((np.dot(G,x)-losbins)/losstd)**2)
-            pars = opt.least_squares(_func,x0,jac='3-point',loss='cauchy').x
-            a = pars[0]
-            b = pars[1]
-            print 'ref frame %f + %f gacos for date: %i'%(a,b,idates[l])
+            pars = np.concatenate([np.zeros(4), opt.least_squares(_func,x0,jac='3-point',loss='cauchy').x])
 
-            model = a + b*model
-            model[model==0.] = 0.
-            model[np.isnan(data)] = np.float('NaN')
+        a = pars[0]; b = pars[1]; c = pars[2]; d = pars[3]; e = pars[4]; f = pars[5]
+        if doramp == 'yes':
+            print 'Remove ramp %f az**2, %f az  + %f r**2 + %f r + %f + %f model for date: %i'%(a,b,c,d,e,f,idates[l])
+            # polynomials of the lines and of the columns broadcast on the map, plus the scaled model
+            az, rg = pix_az[:,np.newaxis], pix_rg[np.newaxis,:]
+            model = ((a*az**2 + b*az) + (c*rg**2 + d*rg + e)) + f*np.asarray(model, dtype=np.float64)
+        else:
+            print 'ref frame %f + %f gacos for date: %i'%(e,f,idates[l])
+            model = e + f*model
+        model[model==0.] = 0.
+        model[np.isnan(data)] = np.float('NaN')
+        params = pars
 
     elif ref == 'pixel':
         model = model - np.nanmean(model[ref_line-2:ref_line+2,ref_col-2:ref_col+2])
@@ -389,6 +543,7 @@ for l in xrange(1,N):
         los_clean = data
         model_clean = model
         a, b = 0., 1.
+        params = [0., 0., 0., 0., a, b]
         
         model = a + b*model
         model[model==0.] = 0.
@@ -429,7 +584,11 @@ for l in xrange(1,N):
 
         ax = fig.add_subplot(2,2,4)
 
+        funct = 0.
         if ref == 'emp':
+            if doramp == 'yes':
+                funct = a*x**2 + b*x + c*y**2 + d*y + e
+                functbins = a*xbins**2 + b*xbins + c*ybins**2 + d*ybins + e
             x = np.linspace(np.nanmax(model_clean),np.nanmin(model_clean),100)
             if doramp == 'yes':
                 ax.scatter(model_clean,los_clean - funct, s=0.005, alpha=0.1, rasterized=True)
@@ -438,7 +597,7 @@ for l in xrange(1,N):
             else:
                 cax = ax.scatter(model_clean, los_clean,s=0.005, alpha=0.1, rasterized=True)
                 ax.plot(modelbins,losbins,'-r', lw =.5)
-                ax.plot(x, a +b*x,'-r', lw =4.)
+                ax.plot(x, e + f*x,'-r', lw =4.)
         else:
             cax = ax.scatter(model_clean, los_clean,s=0.05, alpha=0.1, rasterized=True)
         
@@ -450,12 +609,48 @@ for l in xrange(1,N):
 
         fig.tight_layout()
         fig.savefig('{}-gacos-cor.eps'.format(idates[l]), format='EPS',dpi=150)
-        plt.show()
+        if nproc == 1:
+            plt.show()
+        plt.close('all')
         # sys.exit()
 
+    del data, model
+    return params
+
+# joint fit of all dates from their binned statistics, kept for the correction
+joint_stats, joint_pars = None, None
+if joint == 'yes' and ref == 'emp':
+    if nproc > 1:
+        pool = multiprocessing.Pool(nproc)
+        joint_stats = pool.map(date_bins, xrange(1,N))
+        pool.close()
+        pool.join()
+    else:
+        joint_stats = map(date_bins, xrange(1,N))
+    joint_pars = joint_fit(joint_stats)
+elif joint == 'yes':
+    print 'Joint fit only with the empirical estimation (no --ref): fit each date'
+
+# Apply correction
+if nproc > 1:
+    plt.switch_backend('Agg')
+    pool = multiprocessing.Pool(nproc)
+    fit = pool.map(correct_date, xrange(1,N))
+    pool.close()
+    pool.join()
+else:
+    fit = map(correct_date, xrange(1,N))
+
+# table of the fit parameters of each date
+fit_table = np.zeros((N,7))
+fit_table[:,0] = idates
+fit_table[1:,1:] = np.array(fit)
+np.savetxt('gacos_fit_params.txt', fit_table, header='date   |   az**2   |   az   |   r**2   |   r   |   cst   |   gacos',
+    fmt=['%i'] + ['%.8f']*6)
+
 # save new cube
-fid = open('depl_cumule_gacos', 'wb')
-maps_flat.flatten().astype('float32').tofile(fid)
+maps_flat.flush()
+del maps_flat
 
 
 
@@ -21,7 +21,9 @@ usage: invert_ramp_topo_unw.py --int_list=<path> --int_path=<path> \
 [--estim=yes/no] [--mask=<path>] [--threshold_mask=<value>] \
 [--cohpixel=<yes/no>] [--threshold_coh=<value>] \
 [--ibeg_mask=<value>] [--iend_mask=<value>] [--perc=<value>] \
-[--plot=<yes/no>] [--suffix_output=<value>]\
+[--plot=<yes/no>] [--suffix_output=<value>] [--nproc=<value>] [--blocksize=<value>] [--cache=<path>]\
+[--binned=<yes/no>] [--bin_cell=<value>] [--bin_elev=<value>] [--prefetch=<value>] [--prefetch_mem=<value>]\
+[--joint=<yes/no>] [--joint_points=<value>] \
 [<ibeg>] [<iend>] [<jbeg>] [<jend>] 
 
 --int_list PATH       Text file containing list of interferograms dates in two colums, $data1 $date2
@@ -65,6 +67,19 @@ if ivar=1 and nfit=1, add quadratic cross function of elev. (z) and azimuth to r
 --perc VALUE          Percentile of hidden LOS pixel for the estimation and clean outliers [default:98.]
 --plot yes/no         If yes, plot figures for each ints [default: no]
 --suffix_output value Suffix output file name $prefix$date1-$date2$suffix$suffix_output [default:_corrunw]
+--nproc VALUE         Number of interferograms estimated and corrected in parallel. Figures are saved but not displayed if nproc > 1 [default: 1]
+--blocksize VALUE     Number of lines read, corrected and written at once when applying the correction [default: 256]
+--cache PATH          JSON file of the estimations keyed by the size and date of the .unw and the estimation parameters. Only new or modified interferograms are estimated [default: None]
+--binned yes/no       If yes, estimate on the median LOS of bins made of coarse azimuth/range cells and elevation bins, weighted by their inter-quartile range [default: no]
+--bin_cell VALUE      Size in pixels of the azimuth/range cells for --binned [default: 50]
+--bin_elev VALUE      Number of elevation bins in each cell for --binned [default: 20]
+--prefetch VALUE      If nproc=1, number of interferograms read ahead (and written behind) in background during the computations, 0 to disable.
+The time waiting for the reads and writes is reported [default: 2]
+--prefetch_mem VALUE  Maximum memory in MB of the interferograms read ahead [default: 1024]
+--joint yes/no        If yes, estimate the ramp and phase/elevation coefficients of each acquisition (and a constant for each int.)
+in one sparse least-squares (LSQR) inversion of the points of all interferograms, such that the corrections are consistent in the network.
+No reduction of flat, nfit and ivar for short interferograms and no cache in this mode [default: no]
+--joint_points VALUE  Maximum number of points (or bins if --binned=yes) of each interferogram in the joint inversion, regularly subsampled [default: 2000]
 --ibeg VALUE          Line number bounding the estimation zone [default: 0]
 --iend VALUE          Line number bounding the estimation zone [default: nlign]
 --jbeg VALUE          Column numbers bounding the estimation zone [default: 0]
@@ -101,10 +116,18 @@ from numpy.lib.stride_tricks import as_strided
 import scipy
 import scipy.optimize as opt
 import scipy.linalg as lst
+import scipy.sparse as sparse
+import scipy.sparse.linalg as splinalg
+import scipy.sparse.csgraph as csgraph
 
 import docopt
 
 import shutil
+import multiprocessing
+import json, hashlib
+import binning
+import prefetch
+import roipac
 
 # read arguments
 arguments = docopt.docopt(__doc__)
@@ -199,6 +222,46 @@ if arguments["--suffix_output"] ==  None:
     suffout = '_corrunw'
 else:
     suffout = arguments["--suffix_output"]
+if arguments["--nproc"] ==  None:
+    nproc = 1
+else:
+    nproc = int(arguments["--nproc"])
+if arguments["--blocksize"] ==  None:
+    blocksize = 256
+else:
+    blocksize = int(arguments["--blocksize"])
+if arguments["--cache"] ==  None:
+    cachefile = None
+else:
+    cachefile = arguments["--cache"]
+if arguments["--binned"] ==  None:
+    binned = 'no'
+else:
+    binned = arguments["--binned"]
+if arguments["--bin_cell"] ==  None:
+    bin_cell = 50
+else:
+    bin_cell = int(arguments["--bin_cell"])
+if arguments["--bin_elev"] ==  None:
+    bin_elev = 20
+else:
+    bin_elev = int(arguments["--bin_elev"])
+if arguments["--prefetch"] ==  None:
+    nprefetch = 2
+else:
+    nprefetch = int(arguments["--prefetch"])
+if arguments["--prefetch_mem"] ==  None:
+    prefetch_mem = 1024
+else:
+    prefetch_mem = float(arguments["--prefetch_mem"])
+if arguments["--joint"] ==  None:
+    joint = 'no'
+else:
+    joint = arguments["--joint"]
+if arguments["--joint_points"] ==  None:
+    joint_points = 2000
+else:
+    joint_points = int(arguments["--joint_points"])
 
 
 
@@ -237,16 +300,13 @@ if master is not None:
 
 # laod elevation map
 if radar is not None:
-    ds = gdal.Open(radar, gdal.GA_ReadOnly)
-    # Get the band that have the data we want
-    ds_band2 = ds.GetRasterBand(2)
-    nlign,ncol = ds.RasterYSize, ds.RasterXSize
-    ds_band2 = ds.GetRasterBand(2)
-    elev_map = ds_band2.ReadAsArray(0, 0, ds.RasterXSize, ds.RasterYSize)
+    hgt = roipac.open_unw(radar)
+    nlign,ncol = hgt.nlign, hgt.ncol
+    elev_map = np.array(hgt.phi)
     # fid.close()
     # hardcoding max elevation?
     maxelev,minelev = np.nanpercentile(elev_map,99),np.nanpercentile(elev_map,1)
-    del ds
+    del hgt
 else:
     maxelev,minelev = 1.,-1
     elev_map = np.zeros((nlign,ncol))
@@ -295,11 +355,27 @@ if arguments["<jend>"] ==  None:
 else:
   jend = int(arguments["<jend>"])
 
-# extract range and azimuth coordinates from master or radar file
-pix_az, pix_rg = np.indices((nlign,ncol))
-# print np.shape(pix_az)
-# print np.shape(mask)
-# sys.exit()
+# static selection of the pixels for the estimation, identical for all interferograms:
+# minmax elev, mask, estimation zone and zone excluded between ibeg_mask and iend_mask
+pix_az, pix_rg = np.arange(nlign), np.arange(ncol)
+lines = np.logical_and(np.logical_and(pix_az>ibeg,pix_az<iend),
+    np.logical_or(pix_az<ibeg_mask,pix_az>iend_mask))
+cols = np.logical_and(pix_rg>jbeg,pix_rg<jend)
+static_mask = elev_map<maxelev
+static_mask &= elev_map>minelev
+static_mask &= mask>threshold_mask
+static_mask &= lines[:,np.newaxis]
+static_mask &= cols[np.newaxis,:]
+# flat indexes of the selected pixels in increasing order
+static_index = np.flatnonzero(static_mask)
+del static_mask
+print 'Number of pixels selected for the estimation (before LOS and coherence cleaning): {}'.format(len(static_index))
+
+def fingerprint(filename):
+    ''' Size and modification time of a file, None if it does not exist '''
+    if filename is None or not os.path.exists(filename):
+        return None
+    return [os.path.getsize(filename), os.path.getmtime(filename)]
 
 def estim_ramp(los,los_clean,topo_clean,x,y,order,rms,nfit,ivar):
 
@@ -1313,180 +1389,177 @@ M = 13
 # fill dates
 spint[:,0],spint[:,1] = date_1,date_2 
 
-# initilise correction cube
-corr_maps = np.zeros((nlign,ncol,kmax))
 rms = np.zeros((kmax,3))
 rms[:,0],rms[:,1] = date_1,date_2 
 
-if estim=='yes':
-
-    print 
-    #########################################
-    print '#################################'
-    print 'Empirical estimations'
-    print '#################################'
-    #########################################
-    print
-
-    for kk in xrange((kmax)):
-        date1, date2 = date_1[kk], date_2[kk]
-        idate = str(date1) + '-' + str(date2) 
-        folder = int_path + 'int_'+ str(date1) + '_' + str(date2) + '/'
-        rscfile=folder + prefix + str(date1) + '-' + str(date2) + suffix + '_' + rlook + 'rlks.unw.rsc'
-        infile=folder + prefix + str(date1) + '-' + str(date2) + suffix + '_' + rlook + 'rlks.unw'
-
-        ds = gdal.Open(infile, gdal.GA_ReadOnly)
-        # Get the band that have the data we want
-        ds_band1 = ds.GetRasterBand(1)
-        ds_band2 = ds.GetRasterBand(2)
-
-        los_map = np.zeros((nlign,ncol))
-        los_map[:ds.RasterYSize,:ds.RasterXSize] = ds_band2.ReadAsArray(0, 0, ds.RasterXSize, ds.RasterYSize)[:nlign,:ncol]
-        # los_map[los_map==0] = np.float('NaN')
-        print 
-        print 'Nlign:{}, Ncol:{}, int:{}:'.format(ds.RasterYSize, ds.RasterXSize, idate)
-
-        # load coherence or whatever
-        spacial_mask = np.ones((nlign,ncol))*np.float('NaN')
+def unwfile(kk):
+    ''' Path of the interferogram kk '''
+    date1, date2 = date_1[kk], date_2[kk]
+    return int_path + 'int_'+ str(date1) + '_' + str(date2) + '/' + prefix + str(date1) + '-' + str(date2) + suffix + '_' + rlook + 'rlks.unw'
 
-        rms_map = np.ones((nlign,ncol))
-        if rmsf=='yes':
-           rms_map[:ds.RasterYSize,:ds.RasterXSize] = ds_band1.ReadAsArray(0, 0, ds.RasterXSize, ds.RasterYSize)[:nlign,:ncol]
-           # rmsi = np.fromfile(folder + 'cor',dtype=np.float32)
-           # _rms_map = rmsi.reshape(len(rmsi)/1420,1420)
-           # if len(rmsi)/1420 < nlign:
-           #     rms_map[:len(rmsi)/1420,:1420] = _rms_map
-           # else:
-           #     rms_map = _rms_map[:nlign,:ncol]
-           k = np.nonzero(np.logical_or(rms_map==0.0, rms_map==9999))
-           rms_map[k] = float('NaN')
-        else:
-            threshold_rms = -1
-
-        # print maxelev,minelev
-        # print threshold_rms
-        # print rms_map
-        # print ibeg_mask, iend_mask
-        # print pix_az
-        # print pix_rg
-        # print ibeg, iend, jbeg, jend
-        # print mask
-        # print threshold_mask
-
-        # time.sleep(1.)
-        # clean for estimation
-        _los_map = np.copy(los_map)
-        _los_map[los_map==0] = np.float('NaN')
-        maxlos,minlos=np.nanpercentile(_los_map,perc),np.nanpercentile(_los_map,(100-perc))
-        # print maxlos,minlos
-
-
-        # print np.shape(los_map), np.shape(elev_map), np.shape(rms_map), np.shape(pix_az)
-        ## CRITICAL STEP ####
-        # select points for estimation only: minmax elev, los not NaN, rms<rmsthreshold ....
-        index = np.nonzero(
-        np.logical_and(elev_map<maxelev,
-        np.logical_and(elev_map>minelev,    
-        np.logical_and(los_map!=0, 
-        np.logical_and(los_map>minlos,
-        np.logical_and(los_map<maxlos,
-        np.logical_and(rms_map>threshold_rms, 
-        np.logical_and(pix_az>ibeg,
-        np.logical_and(pix_az<iend,
-        np.logical_and(pix_rg>jbeg,
-        np.logical_and(pix_rg<jend,
-        np.logical_and(mask>threshold_mask,
-        np.logical_and(~np.isnan(los_map),
-        np.logical_or(pix_az<ibeg_mask,pix_az>iend_mask)
-        )
-        )
-        )
-        )
-        )
-        )
-        )
-        )
-        )
-        )
-        )
-        )
-        )
-
-        spacial_mask[index] = np.copy(los_map[index])
-
-        # extract range and azimuth coordinates
-        temp = np.array(index).T
-        az = temp[:,0]; rg = temp[:,1]
-        # print az
-        # print rg
-
-        # clean maps
-        los_temp = np.matrix.copy(los_map)
-        elev_temp = np.matrix.copy(elev_map)
-        los_clean = los_temp[index].flatten()
-        elev_clean = elev_temp[index].flatten()
-        rms_clean = rms_map[index].flatten()
-        del los_temp, elev_temp
-
-        # Take care to not do high polynomial estimations for short int.
-        # find the begining of the image
-        itemp = ibeg
-        for lign in xrange(ibeg,iend,10):
-          if np.isnan(np.nanmean(_los_map[lign:lign+10,:])):
-              itemp = lign  
-          else:
-              break
-        del _los_map
-
-        # print itemp
-        # 0: ref frame [default], 1: range ramp ax+b , 2: azimutal ramp ay+b, 
-        # 3: ax+by+c, 4: ax+by+cxy+d 5: ax**2+bx+d, 6: ay**2+by+c
-        if flat>5 and iend-itemp < .6*(iend-ibeg):
-          print
-          print 'Int. too short in comparison to master, set flat to 5'
-          temp_flat=5
-        elif flat>5 and iend-itemp < .9*ncol:
-          print
-          print 'Lenght int. inferior to width, set flat to 5 and nfit to 0'
-          temp_flat=5
-        else:
-          temp_flat=flat
+def select_int(kk, data=None):
+    ''' Read the interferogram kk and select the points of the estimation. Returns the LOS
+    and coherence maps, the flat indexes of the selected pixels, the points (LOS, elevation,
+    azimuth, range and sigma, binned if --binned=yes), the length of the int. and the LOS
+    percentiles. data are the two bands of the interferogram if already read. '''
 
-        if ivar>0 and iend-itemp < .6*(iend-ibeg):
-          print
-          print 'Int. too short in comparison to master, set ivar and nfit to 0'
-          nfit_temp=0
-          ivar_temp=0
-        else:
-          nfit_temp=nfit
-          ivar_temp=ivar
-
-        # save size int to use as weight in the temporal inversion
-        spint[kk,2] = iend-itemp
+    date1, date2 = date_1[kk], date_2[kk]
+    idate = str(date1) + '-' + str(date2) 
+    infile = unwfile(kk)
+
+    if data is None:
+        # bands mapped in memory: band 1 is only read if used
+        unw = roipac.open_unw(infile)
+        data = unw.amp, unw.phi
+    amp, phi = data
+    ny, nx = np.shape(phi)
+
+    los_map = np.zeros((nlign,ncol))
+    los_map[:ny,:nx] = phi[:nlign,:ncol]
+    # los_map[los_map==0] = np.float('NaN')
+    print 
+    print 'Nlign:{}, Ncol:{}, int:{}:'.format(ny, nx, idate)
+
+    # load coherence or whatever
+    rms_map = np.ones((nlign,ncol))
+    if rmsf=='yes':
+       rms_map[:ny,:nx] = amp[:nlign,:ncol]
+       # rmsi = np.fromfile(folder + 'cor',dtype=np.float32)
+       # _rms_map = rmsi.reshape(len(rmsi)/1420,1420)
+       # if len(rmsi)/1420 < nlign:
+       #     rms_map[:len(rmsi)/1420,:1420] = _rms_map
+       # else:
+       #     rms_map = _rms_map[:nlign,:ncol]
+       k = np.nonzero(np.logical_or(rms_map==0.0, rms_map==9999))
+       rms_map[k] = float('NaN')
+       threshold = threshold_rms
+    else:
+       threshold = -1
+
+    # print maxelev,minelev
+    # print threshold_rms
+    # print rms_map
+    # print ibeg_mask, iend_mask
+    # print pix_az
+    # print pix_rg
+    # print ibeg, iend, jbeg, jend
+    # print mask
+    # print threshold_mask
 
-        # hard-coding subsample 
-        samp = 1
-        sol, corr, rms[kk,2] = estim_ramp(los_map.flatten(),
-        los_clean[::samp],elev_clean[::samp],az[::samp],rg[::samp],
-        temp_flat,rms_clean[::samp],nfit_temp,ivar_temp)
+    # time.sleep(1.)
+    # clean for estimation
+    _los_map = np.copy(los_map)
+    _los_map[los_map==0] = np.float('NaN')
+    maxlos,minlos=np.nanpercentile(_los_map,perc),np.nanpercentile(_los_map,(100-perc))
+    # print maxlos,minlos
+
+
+    # print np.shape(los_map), np.shape(elev_map), np.shape(rms_map), np.shape(pix_az)
+    ## CRITICAL STEP ####
+    # select points for estimation only: static selection, los not NaN, rms<rmsthreshold ....
+    # the conditions depending on the interferogram are evaluated on the static pixels only
+    los_static = los_map.ravel()[static_index]
+    keep = ~np.isnan(los_static)
+    keep &= los_static!=0
+    keep &= los_static>minlos
+    keep &= los_static<maxlos
+    keep &= rms_map.ravel()[static_index]>threshold
+    index = static_index[keep]
+    del los_static, keep
+
+    # extract range and azimuth coordinates
+    az, rg = np.unravel_index(index, (nlign,ncol))
+    # print az
+    # print rg
+
+    # clean maps
+    los_clean = los_map.ravel()[index]
+    elev_clean = elev_map.ravel()[index]
+    rms_clean = rms_map.ravel()[index]
+
+    if binned=='yes':
+        # robust statistics on azimuth/range cells and elevation bins
+        los_clean, elev_clean, az, rg, rms_clean = binning.bin_points(los_clean, elev_clean, az, rg,
+            cell=bin_cell, nelev=bin_elev)
+        print 'Estimation on {} bins'.format(len(los_clean))
+
+    # Take care to not do high polynomial estimations for short int.
+    # find the begining of the image
+    itemp = ibeg
+    for lign in xrange(ibeg,iend,10):
+      if np.isnan(np.nanmean(_los_map[lign:lign+10,:])):
+          itemp = lign  
+      else:
+          break
+    del _los_map
+
+    # save size int to use as weight in the temporal inversion
+    length = iend-itemp
+
+    del data, amp, phi
+    return los_map, rms_map, index, (los_clean, elev_clean, az, rg, rms_clean), length, (minlos, maxlos)
+
+def estim_int(kk, data=None):
+    ''' Empirical estimation on the interferogram kk: returns the length of the int.,
+    the 13 coefficients and the RMS of the estimation. data are the two bands of the
+    interferogram if already read. '''
 
-        print 'RMS: ',rms[kk,2]
+    date1, date2 = date_1[kk], date_2[kk]
+    folder = int_path + 'int_'+ str(date1) + '_' + str(date2) + '/'
 
-        # clean corr : non car il faut extrapoler pour l'inversion ens erie temp
-        # k = np.nonzero(np.logical_or(los_map==0.,abs(los_map)>999.))
-        # corr[k] = 0.
-        corr_maps[:,:,kk] = np.copy(corr)
+    los_map, rms_map, index, points, length, (minlos, maxlos) = select_int(kk, data)
+    los_clean, elev_clean, az, rg, rms_clean = points
+    itemp = iend-length
 
-        # print sol
-        # 0:y**3 1:y**2 2:y 3:x**3 4:x**2 5:x 6:xy**2 7:xy 8:cst 9:z 10:z**2 11:yz 12:yz**2
-        func = sol[0]*rg**3 + sol[1]*rg**2 + sol[2]*rg + sol[3]*az**3 + sol[4]*az**2 \
-        + sol[5]*az + sol[6]*(rg*az)**2 + sol[7]*rg*az + sol[11]*az*elev_clean + \
-        sol[12]*((az*elev_clean)**2)
+    if plot=='yes':
+        spacial_mask = np.ones((nlign,ncol))*np.float('NaN')
+        spacial_mask.flat[index] = los_map.flat[index]
+
+    # print itemp
+    # 0: ref frame [default], 1: range ramp ax+b , 2: azimutal ramp ay+b, 
+    # 3: ax+by+c, 4: ax+by+cxy+d 5: ax**2+bx+d, 6: ay**2+by+c
+    if flat>5 and iend-itemp < .6*(iend-ibeg):
+      print
+      print 'Int. too short in comparison to master, set flat to 5'
+      temp_flat=5
+    elif flat>5 and iend-itemp < .9*ncol:
+      print
+      print 'Lenght int. inferior to width, set flat to 5 and nfit to 0'
+      temp_flat=5
+    else:
+      temp_flat=flat
+
+    if ivar>0 and iend-itemp < .6*(iend-ibeg):
+      print
+      print 'Int. too short in comparison to master, set ivar and nfit to 0'
+      nfit_temp=0
+      ivar_temp=0
+    else:
+      nfit_temp=nfit
+      ivar_temp=ivar
+
+    # hard-coding subsample 
+    samp = 1
+    sol, corr, rmsint = estim_ramp(los_map.flatten(),
+    los_clean[::samp],elev_clean[::samp],az[::samp],rg[::samp],
+    temp_flat,rms_clean[::samp],nfit_temp,ivar_temp)
+
+    print 'RMS: ',rmsint
+
+    # clean corr : non car il faut extrapoler pour l'inversion ens erie temp
+    # k = np.nonzero(np.logical_or(los_map==0.,abs(los_map)>999.))
+    # corr[k] = 0.
+
+    # print sol
+    # 0:y**3 1:y**2 2:y 3:x**3 4:x**2 5:x 6:xy**2 7:xy 8:cst 9:z 10:z**2 11:yz 12:yz**2
+    func = sol[0]*rg**3 + sol[1]*rg**2 + sol[2]*rg + sol[3]*az**3 + sol[4]*az**2 \
+    + sol[5]*az + sol[6]*(rg*az)**2 + sol[7]*rg*az + sol[11]*az*elev_clean + \
+    sol[12]*((az*elev_clean)**2)
 
+    if plot=='yes':
         if radar is not None: 
            # plot phase/elevation
-           nfigure=nfigure+1
-           fig2 = plt.figure(nfigure,figsize=(9,4))
+           fig2 = plt.figure(figsize=(9,4))
            ax = fig2.add_subplot(1,1,1)
            z = np.linspace(np.min(elev_clean), np.max(elev_clean), 100)
            ax.scatter(elev_clean,los_clean - func, s=0.005, alpha=0.05,rasterized=True)
@@ -1504,8 +1577,7 @@ if estim=='yes':
         #corected map
         vmax = np.max(np.array([abs(maxlos),abs(minlos)]))
 
-        nfigure=nfigure+1
-        fig = plt.figure(nfigure,figsize=(11,4))
+        fig = plt.figure(figsize=(11,4))
 
         ax = fig.add_subplot(1,4,1)
         hax = ax.imshow(rms_map, cm.Greys,vmax=1,vmin=0.)
@@ -1540,23 +1612,173 @@ if estim=='yes':
 
         fig.savefig(folder + prefix +'corrections' + suffix+ '.eps', format='EPS',dpi=150)
 
-        if plot=='yes':
+        if nproc == 1:
             plt.show()
-        
-        # fill correction matrix
-        spint[kk,3:] = sol
 
-        plt.close('all')
-        del corr, los_map, rms_map
-        del los_clean, rms_clean
-        del elev_clean
-        del az, rg
-        del ds 
+    plt.close('all')
+    del corr, los_map, rms_map
+    del los_clean, rms_clean
+    del elev_clean
+    del az, rg, points
+
+    return length, sol, rmsint
+
+def image_index():
+    ''' Position of the two dates of each interferogram in the list of images '''
+    order = np.argsort(im)
+    pos1 = order[np.clip(np.searchsorted(im,date_1,sorter=order),0,nmax-1)]
+    pos2 = order[np.clip(np.searchsorted(im,date_2,sorter=order),0,nmax-1)]
+    missing = np.logical_or(im[pos1]!=date_1, im[pos2]!=date_2)
+    if np.any(missing):
+        print 'Dates of interferograms {} not in {}'.format(np.flatnonzero(missing), baseline)
+        sys.exit()
+    return pos1, pos2
+
+# terms of each acquisition in the joint estimation, the constant is estimated for each int.
+#0:y**3 1:y**2 2:y 3:x**3 4:x**2 5:x 6:xy**2 7:xy 8:cst 9:z 10:z**2 11:yz 12:yz**2
+joint_terms = [[],[2],[5],[2,5],[2,5,7],[1,2],[4,5]][flat]
+if radar is not None:
+    joint_terms = joint_terms + [[9],[9,10],[9,11],[9,11,12]][nfit + 2*ivar]
+
+def joint_int(kk, data=None):
+    ''' Points of the interferogram kk for the joint estimation: returns the length of the int.
+    and the points regularly subsampled to at most joint_points '''
+    los_map, rms_map, index, points, length, lims = select_int(kk, data)
+    samp = max(1, int(np.ceil(len(points[0])/float(joint_points))))
+    del los_map, rms_map, index
+    return length, [p[::samp] for p in points]
+
+def joint_basis(az, rg, z):
+    ''' Values of the terms of the joint estimation on the points az, rg, z '''
+    columns = {1:rg**2, 2:rg, 4:az**2, 5:az, 7:az*rg, 9:z, 10:z**2, 11:az*z, 12:(az*z)**2}
+    G = np.zeros((len(az),len(joint_terms)))
+    for t in xrange(len(joint_terms)):
+        G[:,t] = columns[joint_terms[t]]
+    return G
+
+if estim=='yes' and joint=='yes':
+
+    print 
+    #########################################
+    print '#################################'
+    print 'Joint estimation of the coefficients of the acquisitions'
+    print '#################################'
+    #########################################
+    print
+
+    pos1, pos2 = image_index()
+    # keep only the images used by the interferograms
+    used, acq = np.unique(np.concatenate([pos1,pos2]), return_inverse=True)
+    acq1, acq2 = acq[:kmax], acq[kmax:]
+    nt, nacq = len(joint_terms), len(used)
+
+    if nproc > 1:
+        plt.switch_backend('Agg')
+        pool = multiprocessing.Pool(nproc)
+        results = pool.imap(joint_int, xrange(kmax))
+    else:
+        reader = prefetch.Reader(lambda kk: roipac.read_unw(unwfile(kk)), xrange(kmax), depth=nprefetch, maxmem=prefetch_mem)
+        results = (joint_int(kk, data) for kk, data in reader)
+
+    # each point is the difference of the terms of the two acquisitions plus the constant of the int.
+    rows, cols, vals, d, sig, owner = [], [], [], [], [], []
+    npoints = 0
+    for kk, (length, (los_p, elev_p, az_p, rg_p, sig_p)) in zip(xrange(kmax), results):
+        spint[kk,2] = length
+        n = len(los_p)
+        B = joint_basis(az_p.astype(np.float64), rg_p.astype(np.float64), elev_p).ravel()
+        r = npoints + np.arange(n)
+        rows += [np.repeat(r,nt), np.repeat(r,nt), r]
+        cols += [np.tile(acq2[kk]*nt + np.arange(nt),n), np.tile(acq1[kk]*nt + np.arange(nt),n), np.ones(n,dtype=int)*(nacq*nt+kk)]
+        vals += [B, -B, np.ones(n)]
+        d.append(los_p); sig.append(sig_p); owner.append(np.ones(n,dtype=int)*kk)
+        npoints += n
+    if nproc > 1:
+        pool.close()
+        pool.join()
+    else:
+        reader.report()
+
+    rows, cols, vals = np.concatenate(rows), np.concatenate(cols), np.concatenate(vals)
+    d, sig, owner = np.concatenate(d), np.concatenate(sig), np.concatenate(owner)
+    A = sparse.csr_matrix((vals/sig[rows],(rows,cols)), shape=(npoints,nacq*nt+kmax))
+    # normalise the columns: the terms have very different magnitudes
+    norm = np.sqrt(np.asarray(A.multiply(A).sum(axis=0)).ravel())
+    norm[norm==0] = 1.
+    A = A.dot(sparse.diags(1./norm)).tocsr()
+    # the coefficients of the acquisitions are defined up to a common offset: minimum norm solution
+    out = splinalg.lsqr(A, d/sig, atol=1e-10, btol=1e-10, iter_lim=20*(nacq*nt+kmax))
+    pars = out[0]/norm
+    print 'Joint inversion of {} points of {} interferograms for {} acquisitions and {} terms: {} iterations'.format(npoints,kmax,nacq,nt,out[2])
+
+    coeffs = pars[:nacq*nt].reshape((nacq,nt))
+    spint[:,3+np.array(joint_terms,dtype=int)] = coeffs[acq2] - coeffs[acq1]
+    spint[:,3+8] = pars[nacq*nt:]
+    res = A.dot(out[0])*sig - d
+    rms[:,2] = np.sqrt(np.bincount(owner, weights=res**2, minlength=kmax)/np.maximum(np.bincount(owner, minlength=kmax),1))
+    del A, rows, cols, vals, d, sig, owner, res
+
+elif estim=='yes':
+
+    print 
+    #########################################
+    print '#################################'
+    print 'Empirical estimations'
+    print '#################################'
+    #########################################
+    print
+
+    # interferograms already estimated with the same parameters are read from the cache
+    if cachefile is not None:
+        if os.path.exists(cachefile):
+            cache = json.load(open(cachefile,'r'))
+        else:
+            cache = {}
+        params = hashlib.md5(repr([flat,nfit,ivar,fingerprint(radar),fingerprint(maskfile),threshold_mask,
+            rmsf,threshold_rms,perc,ibeg,iend,jbeg,jend,ibeg_mask,iend_mask,nlign,ncol,binned,bin_cell,bin_elev])).hexdigest()
+        keys = []
+        for kk in xrange((kmax)):
+            infile = unwfile(kk)
+            keys.append('{}:{}:{}'.format(os.path.abspath(infile), fingerprint(infile), params))
+        todo = [kk for kk in xrange(kmax) if keys[kk] not in cache]
+        print 'Read {} estimations from {}, estimate {} interferograms'.format(kmax-len(todo), cachefile, len(todo))
+    else:
+        todo = range(kmax)
+
+    if nproc > 1:
+        plt.switch_backend('Agg')
+        pool = multiprocessing.Pool(nproc)
+        results = pool.imap(estim_int, todo)
+    else:
+        # read the next interferograms during the estimation
+        reader = prefetch.Reader(lambda kk: roipac.read_unw(unwfile(kk)), todo, depth=nprefetch, maxmem=prefetch_mem)
+        results = (estim_int(kk, data) for kk, data in reader)
+    # fill correction matrix in the order of the list of interferograms
+    for kk, (length, sol, rmsint) in zip(todo, results):
+        spint[kk,2], spint[kk,3:], rms[kk,2] = length, sol, rmsint
+        if cachefile is not None:
+            cache[keys[kk]] = [float(length)] + [float(x) for x in sol] + [float(rmsint)]
+    if nproc > 1:
+        pool.close()
+        pool.join()
+    else:
+        reader.report()
+
+    if cachefile is not None:
+        for kk in xrange((kmax)):
+            row = cache[keys[kk]]
+            spint[kk,2], spint[kk,3:], rms[kk,2] = row[0], row[1:-1], row[-1]
+        # new entries are added to the older ones
+        fid = open(cachefile,'w')
+        json.dump(cache, fid)
+        fid.close()
+
+if estim=='yes':
 
     # save spint 
     np.savetxt('liste_coeff_ramps.txt', spint , header='#date1   |   dates2   |   Lenght   |   y**3   |   y**2   |   y\
-       |   **3   |   x**2   |   x   |   xy**2   |   xy   |   cst   |   z   |   z**2   |   z*az   |   z**2*az', fmt=('%i','%i','%.8f','%.8f','%.8f','%.8f','%.8f',\
-        '%.8f','%.8f','%.8f','%.8f','%3.8f','%.8f','%.8f','%.8f','%.8f'))
+       |   **3   |   x**2   |   x   |   xy**2   |   xy   |   cst   |   z   |   z**2   |   z*az   |   z**2*az', fmt=('%i','%i','%.8f','%.8e','%.8e','%.8e','%.8e',\
+        '%.8e','%.8e','%.8e','%.8e','%.8e','%.8e','%.8e','%.8e','%.8e'))
 
     # # save correction matrix
     # fid = open('corection_matrix', 'wb') 
@@ -1573,7 +1795,7 @@ print 'read input files liste_coeff_ramps.txt and corection_matrix'
 print 
 
 # load spint
-date_1,date_2,length,a,b,c,d,e,f,g,h,i,j,k,l,m=np.loadtxt('liste_coeff_ramps.txt',comments="#",unpack=True,dtype='i,i,f,f,f,f,f,f,f,f,f,f,f,f,f,f')
+date_1,date_2,length,a,b,c,d,e,f,g,h,i,j,k,l,m=np.loadtxt('liste_coeff_ramps.txt',comments="#",unpack=True,dtype='i,i,d,d,d,d,d,d,d,d,d,d,d,d,d,d')
 spint = np.vstack([date_1,date_2,length,a,b,c,d,e,f,g,h,i,j,k,l,m]).T
 rec_spint = np.copy(spint)
 
@@ -1595,18 +1817,14 @@ if tsinv=='yes':
 
     spint_inv = np.zeros((np.shape(spint)))
 
-    G_=np.zeros((kmax,nmax))
-    deltat = np.zeros((kmax))
-    for k in xrange((kmax)):
-      for n in xrange((nmax)):
-        if (date_1[k]==im[n]): 
-          G_[k,n]=-1
-          t1 = bt[n]
-        elif (date_2[k]==im[n]):
-          G_[k,n]=1
-          t2 = bt[n]
-      deltat[k] = abs(t2 -t1)
-
+    # incidence matrix interferograms/images from the position of the dates in the list of images
+    pos1, pos2 = image_index()
+    # keep only the images used by the interferograms
+    used, cols = np.unique(np.vstack([pos1,pos2]).T.flatten(), return_inverse=True)
+    rows = np.repeat(np.arange(kmax),2)
+    vals = np.tile([-1.,1.],kmax)
+    G_ = sparse.csr_matrix((vals,(rows,cols)),shape=(kmax,len(used)))
+    deltat = abs(bt[pos2] - bt[pos1])
 
     # 1) create weight based on temporal baseline: give stronger weight to short temporal baselines 
     #, where we dont expect def.
@@ -1622,32 +1840,32 @@ if tsinv=='yes':
     # sys.exit()
     sig_ = 1./w1 + 1./w2
 
-    
-    for j in xrange((12)):
-        
-        d = np.zeros(((kmax+1)))
-        sig = np.ones(((kmax+1)))
-        G = np.zeros(((kmax+1),nmax))
-    
-        d[:kmax] = as_strided(spint[:,j+3])
-        G[:kmax,:nmax] = G_ 
-        G[-1,0] = 1 # ini phi first image to 0
-        sig[:kmax] = sig_
-
-        try:
-            x0 = lst.lstsq(G,d)[0]
-            _func = lambda x: np.sum(((np.dot(G,x)-d)/sig)**2)
-            _fprime = lambda x: 2*np.dot(G.T/sig, (np.dot(G,x)-d)/sig)
-            pars = opt.fmin_slsqp(_func,x0,fprime=_fprime,iter=500,full_output=True,iprint=0)[0]
-
-            # reconstruct corr for selected int
-            spint_inv[:,j+3] = np.dot(G,pars)[:kmax]
-            # print 
-            # print spint_inv[:,j+3] - spint[:,j+3]
-            # print
-
-        except:
-            pass
+    # add a last line to ini phi first image to 0
+    G = sparse.vstack([G_, sparse.csr_matrix(([1.],([0],[0])),shape=(1,len(used)))]).tocsr()
+    sig = np.ones(((kmax+1)))
+    sig[:kmax] = sig_
+    # the 12 coefficients are inverted together: one weighted factorisation for all columns
+    d = np.zeros(((kmax+1),12))
+    d[:kmax] = spint[:,3:15]
+    Gw = sparse.diags(1./sig).dot(G).tocsc()
+    dw = d/sig[:,np.newaxis]
+
+    try:
+        # a network made of several connected subsets has no unique solution
+        ncomp = csgraph.connected_components(G_.T.dot(G_), directed=False)[0]
+        if ncomp == 1:
+            # normal equations, sparse LU decomposition
+            solve = splinalg.factorized((Gw.T.dot(Gw)).tocsc())
+            rhs = Gw.T.dot(dw)
+            pars = np.vstack([solve(rhs[:,j]) for j in xrange(12)]).T
+        else:
+            print 'Network made of {} subsets: minimum norm solution'.format(ncomp)
+            pars = lst.lstsq(Gw.toarray(),dw)[0]
+
+        # reconstruct corr for selected int
+        spint_inv[:,3:15] = G.dot(pars)[:kmax]
+    except:
+        pass
 
     spint_inv[:,:3] = spint[:,:3]
     # I dont think the cst should be inverted ??
@@ -1666,122 +1884,153 @@ print '#################################'
 print
 
 
-# apply correction
-for kk in xrange((kmax)):
+# coordinate vectors shared by all interferograms
+rg_vec = np.arange(ncol, dtype=np.float64)
+az_vec = np.arange(nlign, dtype=np.float64)
+
+def eval_ramp(sol, i, j, n, m):
+    ''' Evaluate the correction on the lines i:i+n and the columns j:j+m.
+    0:y**3 1:y**2 2:y 3:x**3 4:x**2 5:x 6:xy**2 7:xy 8:cst 9:z 10:z**2 11:yz 12:yz**2 '''
+    rg = rg_vec[np.newaxis,j:j+m]
+    az = az_vec[i:i+n,np.newaxis]
+    z = elev_map[i:i+n,j:j+m]
+    # terms in range only, azimuth only and crossed terms, by broadcasting
+    corr = (sol[0]*rg**3 + sol[1]*rg**2 + sol[2]*rg) + (sol[3]*az**3 + sol[4]*az**2 + sol[5]*az + sol[8])
+    corr += (sol[6]*az**2)*rg**2
+    corr += (sol[7]*az)*rg
+    corr += (sol[9] + sol[11]*az)*z
+    corr += (sol[10] + sol[12]*az**2)*z**2
+    return corr
+
+def apply_int(kk, data=None, writer=None):
+    ''' Apply the correction to the interferogram kk block of lines by block of lines
+    and write the corrected interferogram. data are the two bands of the interferogram
+    if already read. If writer is given, the corrected interferogram is queued to it
+    instead of being written block by block. '''
+
     date1, date2 = date_1[kk], date_2[kk]
     idate = str(date1) + '-' + str(date2) 
     folder = int_path + 'int_'+ str(date1) + '_' + str(date2) + '/'
     rscfile=folder + prefix + str(date1) + '-' + str(date2) + suffix + '_' + rlook + 'rlks.unw.rsc'
     infile=folder + prefix + str(date1) + '-' + str(date2) + suffix + '_' + rlook + 'rlks.unw'
     outfile = folder + prefix + str(date1) + '-' + str(date2) + suffix + '_' + suffout + '_' + rlook + 'rlks.unw'  
-    outrsc = folder + prefix + str(date1) + '-' + str(date2) + suffix + '_' + suffout + '_' + rlook + 'rlks.unw.rsc' 
     
-    ds = gdal.Open(infile, gdal.GA_ReadOnly)
-    # Get the band that have the data we want
-    ds_band1 = ds.GetRasterBand(1)
-    ds_band2 = ds.GetRasterBand(2)
+    if data is None:
+        # bands mapped in memory: lines are read block by block
+        unw = roipac.open_unw(infile)
+        data = unw.amp, unw.phi
+    amp, phi = data
+    ny, nx = np.shape(phi)
     # resize to master
-    # los_map, rms_map = np.zeros((nlign,ncol)),np.zeros((nlign,ncol))
-    los_map = ds_band2.ReadAsArray(0, 0, ds.RasterXSize, ds.RasterYSize)
-    rms_map = ds_band1.ReadAsArray(0, 0, ds.RasterXSize, ds.RasterYSize)
-    # time.sleep(1.)
-
-    # rms_map = np.zeros((nlign,ncol))
-    rms_map = ds_band1.ReadAsArray(0, 0, ds.RasterXSize, ds.RasterYSize)
-    # print 'Apply correction and clean coh < 0.03....'
-    # los_map[rms_map<0.03] = 0.0
-    # rms_map[rms_map<0.03] = 0.0
+    nl, nc = min(ny,nlign), min(nx,ncol)
 
     print 
-    print 'Nlign:{}, Ncol:{}, int:{}:'.format(ds.RasterYSize, ds.RasterXSize, idate)
-
-    # compute correction
-    rg = np.tile(np.arange(ds.RasterXSize), (ds.RasterYSize,1))
-    az = np.tile(np.arange(ds.RasterYSize), (ds.RasterXSize,1)).T
-
-    z = np.zeros((ds.RasterYSize, ds.RasterXSize))
-    z = elev_map[:ds.RasterYSize,:ds.RasterXSize]
+    print 'Nlign:{}, Ncol:{}, int:{}:'.format(ny, nx, idate)
 
-    
-
-    # 0:y**3 1:y**2 2:y 3:x**3 4:x**2 5:x 6:xy**2 7:xy 8:cst 9:z 10:z**2 11:yz 12:yz**2
     if tsinv=='yes':
+        sol_inv = spint_inv[kk,3:]
+    else:
+        sol_inv = spint[kk,3:]
 
-            sol = spint_inv[kk,3:]
-            corr_inv = sol[0]*rg**3 + sol[1]*rg**2 + sol[2]*rg + sol[3]*az**3 + sol[4]*az**2 \
-            + sol[5]*az + sol[6]*(rg*az)**2 + sol[7]*rg*az + sol[8] + sol[9]*z + sol[10]*(z**2) \
-            + sol[11]*az*z + sol[12]*((az*z)**2)
+    if writer is None:
+        # new ROI_PAC file written sequentially with the keys of the input .rsc
+        dst = roipac.UnwWriter(outfile, ncol, nlign, rsc=rscfile)
+    else:
+        amp_out, phi_out = np.zeros((nlign,ncol),dtype=np.float32), np.zeros((nlign,ncol),dtype=np.float32)
 
-            sol = spint[kk,3:]
-            corr = sol[0]*rg**3 + sol[1]*rg**2 + sol[2]*rg + sol[3]*az**3 + sol[4]*az**2 \
-            + sol[5]*az + sol[6]*(rg*az)**2 + sol[7]*rg*az + sol[8] + sol[9]*z + sol[10]*(z**2) \
-            + sol[11]*az*z + sol[12]*((az*z)**2)
-            
-    
-    else:   
-            
-            sol = spint[kk,3:]
-            corr_inv = sol[0]*rg**3 + sol[1]*rg**2 + sol[2]*rg + sol[3]*az**3 + sol[4]*az**2 \
-            + sol[5]*az + sol[6]*(rg*az)**2 + sol[7]*rg*az + sol[8] + sol[9]*z + sol[10]*(z**2) \
-            + sol[11]*az*z + sol[12]*((az*z)**2)
+    if plot=='yes':
+        # keep full maps for the figure only
+        los_full, flatlos_full = np.zeros((nl,nc)), np.zeros((nl,nc))
+
+    for i in xrange(0, nl, blocksize):
+        n = min(blocksize, nl-i)
+        los_map = phi[i:i+n,:nc].astype(np.float64)
+        rms_map = np.array(amp[i:i+n,:nc])
+
+        flatlos = los_map - eval_ramp(sol_inv, i, 0, n, nc)
+        # reset to 0 areas where no data (might change after time series inversion?)
+        nodata = np.logical_or(los_map==0, np.isnan(flatlos))
+        nodata |= np.isnan(rms_map)
+        flatlos[nodata], rms_map[nodata] = 0.0, 0.0
+
+        if writer is None:
+            dst.write(rms_map, flatlos)
+        else:
+            amp_out[i:i+n,:nc], phi_out[i:i+n,:nc] = rms_map, flatlos
+
+        if plot=='yes':
+            los_full[i:i+n], flatlos_full[i:i+n] = los_map, flatlos
+    if writer is None:
+        dst.close()
+    else:
+        writer.put(roipac.write_unw, outfile, amp_out, phi_out, rscfile)
 
+    if plot=='yes':
+        corr_inv = eval_ramp(sol_inv, 0, 0, nl, nc)
+        if tsinv=='yes':
+            corr = eval_ramp(spint[kk,3:], 0, 0, nl, nc)
+        else:
             corr = corr_inv
 
-    # reset to 0 areas where no data (might change after time series inversion?)
-    flatlos = los_map-corr_inv
-    flatlos[los_map==0], rms_map[los_map==0] = 0.0, 0.0
-    flatlos[isnan(flatlos)],rms_map[isnan(flatlos)] = 0.0, 0.0
-    flatlos[isnan(los_map)],rms_map[isnan(los_map)] = 0.0, 0.0
-    rms_map[isnan(rms_map)],flatlos[isnan(rms_map)] = 0.0, 0.0
-
-    # create new GDAL image with driver ROI_PAC
-    drv = gdal.GetDriverByName("roi_pac")
-    dst_ds = drv.Create(outfile, ncol, nlign, 2, gdal.GDT_Float32)
-    dst_band1 = dst_ds.GetRasterBand(1)
-    dst_band2 = dst_ds.GetRasterBand(2)
-    dst_band1.WriteArray(rms_map,0,0)
-    dst_band2.WriteArray(flatlos,0,0)
-    shutil.copy(rscfile,outrsc)
-
-    nfigure=nfigure+1
-    fig = plt.figure(nfigure,figsize=(9,4))
-
-    _los_map = np.copy(flatlos)
-    _los_map[los_map==0] = np.float('NaN')
-    maxlos,minlos=np.nanpercentile(_los_map,perc),np.nanpercentile(_los_map,(100-perc))
-    vmax = np.max(np.array([abs(maxlos),abs(minlos)]))
-    # vmax = np.percentile(los_map, 98)
+        fig = plt.figure(figsize=(9,4))
 
-    ax = fig.add_subplot(1,4,1)
-    cax = ax.imshow(los_map,cmap=cm.gist_rainbow,vmax=vmax,vmin=-vmax,alpha=0.7,interpolation='bilinear')
-    ax.set_title('LOS')
-    setp( ax.get_xticklabels(), visible=None)
+        _los_map = np.copy(flatlos_full)
+        _los_map[los_full==0] = np.float('NaN')
+        maxlos,minlos=np.nanpercentile(_los_map,perc),np.nanpercentile(_los_map,(100-perc))
+        vmax = np.max(np.array([abs(maxlos),abs(minlos)]))
+        # vmax = np.percentile(los_map, 98)
 
-    ax = fig.add_subplot(1,4,2)
-    cax = ax.imshow(corr,cmap=cm.gist_rainbow,vmax=vmax,vmin=-vmax,alpha=0.7,interpolation='bilinear')
-    ax.set_title('RAMP+TOPO ORIG')
-    setp( ax.get_xticklabels(), visible=None)
+        ax = fig.add_subplot(1,4,1)
+        cax = ax.imshow(los_full,cmap=cm.gist_rainbow,vmax=vmax,vmin=-vmax,alpha=0.7,interpolation='bilinear')
+        ax.set_title('LOS')
+        setp( ax.get_xticklabels(), visible=None)
+
+        ax = fig.add_subplot(1,4,2)
+        cax = ax.imshow(corr,cmap=cm.gist_rainbow,vmax=vmax,vmin=-vmax,alpha=0.7,interpolation='bilinear')
+        ax.set_title('RAMP+TOPO ORIG')
+        setp( ax.get_xticklabels(), visible=None)
 
-    ax = fig.add_subplot(1,4,3)
-    cax = ax.imshow(corr_inv,cmap=cm.gist_rainbow,vmax=vmax,vmin=-vmax,alpha=0.7,interpolation='bilinear')
-    ax.set_title('RAMP+TOPO RECONST.')
-    setp( ax.get_xticklabels(), visible=None)
+        ax = fig.add_subplot(1,4,3)
+        cax = ax.imshow(corr_inv,cmap=cm.gist_rainbow,vmax=vmax,vmin=-vmax,alpha=0.7,interpolation='bilinear')
+        ax.set_title('RAMP+TOPO RECONST.')
+        setp( ax.get_xticklabels(), visible=None)
 
-    ax = fig.add_subplot(1,4,4)
-    cax = ax.imshow(flatlos,cmap=cm.gist_rainbow,vmax=vmax,vmin=-vmax,alpha=0.7,interpolation='bilinear')
-    ax.set_title('CORR LOS RECONST.')
-    setp( ax.get_xticklabels(), visible=None)
-    fig.colorbar(cax, orientation='vertical',aspect=10)
-    fig.tight_layout()
+        ax = fig.add_subplot(1,4,4)
+        cax = ax.imshow(flatlos_full,cmap=cm.gist_rainbow,vmax=vmax,vmin=-vmax,alpha=0.7,interpolation='bilinear')
+        ax.set_title('CORR LOS RECONST.')
+        setp( ax.get_xticklabels(), visible=None)
+        fig.colorbar(cax, orientation='vertical',aspect=10)
+        fig.tight_layout()
 
+        fig.savefig(folder + prefix + 'reconstruc_corrections' + suffix + '.eps', format='EPS',dpi=150)
 
-    fig.savefig(folder + prefix + 'reconstruc_corrections' + suffix + '.eps', format='EPS',dpi=150)
+        if nproc == 1:
+            plt.show()
 
-    if plot=='yes':
-        plt.show()
+        plt.close('all')
+        del corr, corr_inv, los_full, flatlos_full, _los_map
 
-    plt.close('all')
+    del data, amp, phi
+    del los_map, rms_map, flatlos
+    return idate
 
-    del dst_ds, ds, drv
-    del los_map, rms_map
+# apply correction
+if nproc > 1:
+    plt.switch_backend('Agg')
+    pool = multiprocessing.Pool(nproc)
+    pool.map(apply_int, xrange(kmax))
+    pool.close()
+    pool.join()
+elif nprefetch > 0:
+    # read the next interferograms and write the corrected ones during the corrections
+    reader = prefetch.Reader(lambda kk: roipac.read_unw(unwfile(kk)), xrange(kmax), depth=nprefetch, maxmem=prefetch_mem)
+    writer = prefetch.Writer(depth=nprefetch)
+    for kk, data in reader:
+        apply_int(kk, data, writer)
+    writer.close()
+    reader.report()
+    writer.report()
+else:
+    for kk in xrange((kmax)):
+        apply_int(kk)
 
@@ -37,6 +37,7 @@ import matplotlib.pyplot as plt
 import matplotlib.cm as cm
 from pylab import setp
 from osgeo import gdal
+import roipac
 
 # Initialize a matplotlib figure
 fig, ax = plt.subplots(1,figsize=(10,11))
@@ -44,32 +45,33 @@ fig, ax = plt.subplots(1,figsize=(10,11))
 # read arguments
 arguments = docopt.docopt(__doc__)
 infile = arguments["--infile"]
-# Open phiset (image)
-ds = gdal.Open(infile, gdal.GA_ReadOnly)
-
 # Ok, assume this is a roipac image, so we can rely on the file extension
 # to know how to display the phi (in the real world, we would probably write
 # different programs)
 ds_extension = os.path.splitext(sys.argv[1])[1]
 
-# Get the band that have the phi we want
-if ds_extension == ".unw":
-    phase_band = ds.GetRasterBand(2)
-    amp_band = ds.GetRasterBand(1)
+if ds_extension in [".unw", ".hgt"]:
+    # two-band file mapped in memory: only the lines displayed are read
+    unw = roipac.open_unw(infile)
+    nlign, ncol = unw.nlign, unw.ncol
+    print("> Size:     ", ncol,'x',nlign,'x',2)
 else:
-	phase_band = ds.GetRasterBand(1)
+    # Open phiset (image)
+    ds = gdal.Open(infile, gdal.GA_ReadOnly)
+    phase_band = ds.GetRasterBand(1)
+    nlign, ncol = ds.RasterYSize, ds.RasterXSize
 
-# Attributes
-print("> Driver:   ", ds.GetDriver().ShortName)
-print("> Size:     ", ds.RasterXSize,'x',ds.RasterYSize,'x',ds.RasterCount)
-print("> Datatype: ", gdal.GetDataTypeName(phase_band.DataType))
+    # Attributes
+    print("> Driver:   ", ds.GetDriver().ShortName)
+    print("> Size:     ", ds.RasterXSize,'x',ds.RasterYSize,'x',ds.RasterCount)
+    print("> Datatype: ", gdal.GetDataTypeName(phase_band.DataType))
 
 if arguments["<ibeg>"] ==  None:
     ibeg = 0
 else:
     ibeg = int(arguments["<ibeg>"])
 if arguments["<iend>"] ==  None:
-    iend = ds.RasterYSize
+    iend = nlign
 else:
     iend = int(arguments["<iend>"])
 if arguments["<jbeg>"] ==  None:
@@ -77,31 +79,26 @@ if arguments["<jbeg>"] ==  None:
 else:
     jbeg = int(arguments["<jbeg>"])
 if arguments["<jend>"] ==  None:
-    jend = ds.RasterXSize
+    jend = ncol
 else:
     jend = int(arguments["<jend>"])
 
-# Read phi in numpy array, resampled by a factor of 4
-#   Resampling is nearest neighbour with that function: hardly acceptable,
-#   but easy for a simple demo!
-if ds_extension == ".unw":
-	phi = phase_band.ReadAsArray(0, 0,
-                           ds.RasterXSize, ds.RasterYSize,
-                           ds.RasterXSize, ds.RasterYSize)
-	amp = amp_band.ReadAsArray(0, 0,
-                           ds.RasterXSize, ds.RasterYSize,
-                           ds.RasterXSize, ds.RasterYSize)
-	
+if ds_extension in [".unw", ".hgt"]:
 	# cut image
-	cutphi = as_strided(phi[ibeg:iend,jbeg:jend])
-	cutamp = as_strided(amp[ibeg:iend,jbeg:jend])
+	cutphi = np.array(unw.phi[ibeg:iend,jbeg:jend])
+	cutamp = np.array(unw.amp[ibeg:iend,jbeg:jend])
+	del unw
 
 else:
+	# Read phi in numpy array, resampled by a factor of 4
+	#   Resampling is nearest neighbour with that function: hardly acceptable,
+	#   but easy for a simple demo!
 	phase = phase_band.ReadAsArray(0, 0,
                            ds.RasterXSize, ds.RasterYSize,
                            ds.RasterXSize, ds.RasterYSize)
 	
 	cutphase = as_strided(phase[ibeg:iend,jbeg:jend])	
+	del ds
 
 #phi = np.nan_to_num(phi)
 #amp = np.nan_to_num(amp)
@@ -143,10 +140,6 @@ setp( ax.get_xticklabels(), visible=False)
 cbar = fig.colorbar(cax, orientation='vertical',aspect=9,fraction=0.02,pad=0.06)
 # cbar = fig.colorbar(hax, orientation='vertical',aspect=10,fraction=0.02,pad=0.01)
 
-# Close dataset (if this was a new image, it would be written at this moment)
-# This will free memory for the display stuff
-del ds
-
 # Display the data
 fig.canvas.set_window_title(sys.argv[1])
 ##ax.set_rasterized(True)
@@ -48,6 +48,7 @@ import matplotlib as mpl
 
 # docopt (command line parser)
 import docopt
+import binning
 
 # read arguments
 arguments = docopt.docopt(__doc__)
@@ -183,21 +184,13 @@ vmin = np.nanpercentile(ilos,.1)
 # plot profile
 if plotdem is 'yes':
     bins = np.arange(min(iyp),max(iyp),2)
-    inds = np.digitize(iyp,bins)
-    distance=[]
-    moy_topo=[]
-    std_topo=[]
-    moy_los= []
-    std_los=[]
-    for j in range(len(bins)-1):
-        uu = np.flatnonzero(inds == j)
-        if len(uu)>0:
-            distance.append(bins[j] + (bins[j+1] - bins[j])/2.)
-            std_los.append(np.std(ilos[uu]))
-            moy_los.append(np.mean(ilos[uu]))
-            std_topo.append(np.std(itopo[uu]))
-            moy_topo.append(np.mean(itopo[uu]))
-    distance, moy_topo, std_topo, moy_los, std_los = np.array(distance), np.array(moy_topo), np.array(std_topo), np.array(moy_los), np.array(std_los)
+    # statistics of all bins at once
+    groups = binning.Groups(np.digitize(iyp,bins))
+    sel = groups.labels < len(bins)-1
+    j = groups.labels[sel]
+    distance = bins[j] + (bins[j+1] - bins[j])/2.
+    std_los, moy_los = groups.std(ilos)[sel], groups.mean(ilos)[sel]
+    std_topo, moy_topo = groups.std(itopo)[sel], groups.mean(itopo)[sel]
     
     fig = plt.figure(10, figsize=(14,8))
     ax1 = plt.subplot2grid((3,2), (0,0), colspan=2)
@@ -228,17 +221,12 @@ if plotdem is 'yes':
 
 else: 
     bins = np.arange(min(iyp),max(iyp),2)
-    inds = np.digitize(iyp,bins)
-    distance = []
-    moy_los= []
-    std_los=[]
-    for j in range(len(bins)-1):
-        uu = np.flatnonzero(inds == j)
-        if len(uu)>0:
-            distance.append(bins[j] + (bins[j+1] - bins[j])/2.)
-            std_los.append(np.std(ilos[uu]))
-            moy_los.append(np.mean(ilos[uu]))
-    distance, moy_los, std_los = np.array(distance), np.array(moy_los), np.array(std_los)
+    # statistics of all bins at once
+    groups = binning.Groups(np.digitize(iyp,bins))
+    sel = groups.labels < len(bins)-1
+    j = groups.labels[sel]
+    distance = bins[j] + (bins[j+1] - bins[j])/2.
+    std_los, moy_los = groups.std(ilos)[sel], groups.mean(ilos)[sel]
 
     # maxpro = moy_los.max() + 4*np.mean(std_los)
     # minpro = moy_los.min() - 4*np.mean(std_los)
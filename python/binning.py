@@ -0,0 +1,144 @@
+# -*- coding: utf-8 -*-
+############################################
+#
+# PyGdalSAR: An InSAR post-processing package
+# written in Python-Gdal
+#
+############################################
+# Author        : Simon DAOUT (Oxford)
+############################################
+
+"""\
+binning.py
+-------------
+Aggregation of the points selected for an empirical phase/elevation and ramp estimation.
+Points are grouped by coarse azimuth/range cells and elevation bins. Each bin is replaced by
+the median of its LOS, the mean of its coordinates and elevation, and an uncertainty derived
+from the inter-quartile range of its LOS, such that the fit runs on a few thousand robust
+points whatever the size of the image.
+
+    los_b, elev_b, az_b, rg_b, sig_b = binning.bin_points(los, elev, az, rg, cell=50, nelev=20)
+
+Groups computes statistics of values grouped by any label (e.g. the bin number given by
+np.digitize) for all groups at once, by sorting the points by group instead of selecting
+the points of each group in turn.
+
+    groups = binning.Groups(np.digitize(model, bins))
+    trim = groups.between(los, 10., 90.)
+    count, med, std = groups.count(), groups.median(los, trim), groups.std(los, trim)
+"""
+
+from __future__ import print_function
+import numpy as np
+
+def bin_points(los, elev, az, rg, cell=50, nelev=20, minpoints=5):
+    ''' Group points by cells of cell x cell pixels and nelev elevation bins.
+    Bins with less than minpoints points are dropped.
+    Returns median LOS, mean elevation, mean azimuth, mean range and sigma of the bins,
+    with sigma = IQR/1.349/sqrt(number of points) '''
+    los, elev = np.asarray(los, dtype=np.float64), np.asarray(elev, dtype=np.float64)
+    az, rg = np.asarray(az), np.asarray(rg)
+    if len(los) == 0:
+        return los, elev, az, rg, np.ones(0)
+
+    # bin number of each point
+    ncell_rg = int(np.max(rg)) // cell + 1
+    group = (az.astype(np.int64) // cell) * ncell_rg + rg.astype(np.int64) // cell
+    emin, emax = np.min(elev), np.max(elev)
+    if emax > emin:
+        ebin = np.minimum(((elev - emin) / (emax - emin) * nelev).astype(np.int64), nelev-1)
+        group = group * nelev + ebin
+
+    # sort by bin, then by LOS inside each bin
+    order = np.lexsort((los, group))
+    group, los_sorted = group[order], los[order]
+    start = np.concatenate(([0], np.flatnonzero(np.diff(group)) + 1))
+    count = np.diff(np.concatenate((start, [len(group)])))
+    keep = count >= minpoints
+    start, count = start[keep], count[keep]
+
+    # order statistics of the LOS in each bin
+    median = (los_sorted[start + (count-1)//2] + los_sorted[start + count//2]) / 2.
+    q1 = los_sorted[start + (count-1)//4]
+    q3 = los_sorted[start + (3*(count-1))//4]
+    sigma = (q3 - q1) / 1.349 / np.sqrt(count)
+    # bins with constant values
+    positive = sigma > 0
+    if np.any(positive):
+        sigma[~positive] = np.min(sigma[positive])
+    else:
+        sigma[:] = 1.
+
+    # mean coordinates and elevation of each bin
+    label = np.cumsum(np.concatenate(([0], (np.diff(group) != 0).astype(np.int64))))
+    nb = label[-1] + 1
+    norm = np.bincount(label, minlength=nb).astype(np.float64)
+    sel = label[start]
+    elev_bins = (np.bincount(label, weights=elev[order], minlength=nb) / norm)[sel]
+    az_bins = (np.bincount(label, weights=az[order], minlength=nb) / norm)[sel]
+    rg_bins = (np.bincount(label, weights=rg[order], minlength=nb) / norm)[sel]
+
+    return median, elev_bins, az_bins, rg_bins, sigma
+
+class Groups:
+    ''' Statistics of values grouped by labels, for all groups at once. Groups are sorted by
+    label (labels attribute). Statistics are computed on the points where mask is True if
+    given, and are NaN for groups without points. '''
+
+    def __init__(self, labels):
+        self.labels, self.group = np.unique(np.asarray(labels).ravel(), return_inverse=True)
+        self.ngroups = len(self.labels)
+
+    def _select(self, values, mask):
+        values = np.asarray(values, dtype=np.float64).ravel()
+        if mask is None:
+            return self.group, values
+        return self.group[mask], values[mask]
+
+    def count(self, mask=None):
+        ''' Number of points of each group '''
+        group = self.group if mask is None else self.group[mask]
+        return np.bincount(group, minlength=self.ngroups)
+
+    def mean(self, values, mask=None):
+        group, values = self._select(values, mask)
+        count = np.bincount(group, minlength=self.ngroups).astype(np.float64)
+        with np.errstate(invalid='ignore', divide='ignore'):
+            return np.bincount(group, weights=values, minlength=self.ngroups) / count
+
+    def std(self, values, mask=None):
+        ''' Standard deviation (normalized by the number of points as np.std) '''
+        group, values = self._select(values, mask)
+        count = np.bincount(group, minlength=self.ngroups).astype(np.float64)
+        with np.errstate(invalid='ignore', divide='ignore'):
+            mean = np.bincount(group, weights=values, minlength=self.ngroups) / count
+            return np.sqrt(np.bincount(group, weights=(values - mean[group])**2, minlength=self.ngroups) / count)
+
+    def percentile(self, values, q, mask=None):
+        ''' q-th percentile with linear interpolation (as np.percentile) '''
+        group, values = self._select(values, mask)
+        order = np.lexsort((values, group))
+        values = values[order]
+        count = np.bincount(group, minlength=self.ngroups)
+        start = np.cumsum(count) - count
+        result = np.ones(self.ngroups) * np.nan
+        full = count > 0
+        pos = (count[full] - 1) * q / 100.
+        lo = np.floor(pos).astype(np.int64)
+        hi = np.minimum(lo + 1, count[full] - 1)
+        low, high = values[start[full] + lo], values[start[full] + hi]
+        result[full] = low + (high - low) * (pos - lo)
+        return result
+
+    def median(self, values, mask=None):
+        return self.percentile(values, 50., mask)
+
+    def expand(self, stat):
+        ''' Value of a statistic of the groups at each point '''
+        return np.asarray(stat)[self.group]
+
+    def between(self, values, qmin, qmax):
+        ''' Points strictly between the qmin-th and qmax-th percentiles of their group '''
+        values = np.asarray(values).ravel()
+        return np.logical_and(values > self.expand(self.percentile(values, qmin)),
+            values < self.expand(self.percentile(values, qmax)))
@@ -0,0 +1,151 @@
+# -*- coding: utf-8 -*-
+############################################
+#
+# PyGdalSAR: An InSAR post-processing package
+# written in Python-Gdal
+#
+############################################
+# Author        : Simon DAOUT (Oxford)
+############################################
+
+"""\
+prefetch.py
+-------------
+Read-ahead and asynchronous write of files processed one after the other. A background
+thread loads the next items into a bounded queue (at most depth items and maxmem bytes
+ahead, the size of an item being reserved before it is loaded from the size of the
+previous one), while the outputs are written by an other thread, such that computations overlap
+with I/O. The time spent waiting for inputs or for the writer (stall) is reported.
+
+    reader = prefetch.Reader(roipac.read_unw, files, depth=2, maxmem=1024)
+    writer = prefetch.Writer(depth=2)
+    for infile, (amp, phi) in reader:
+        writer.put(roipac.write_unw, outfile, amp, phi - model)
+    writer.close()
+    reader.report(); writer.report()
+"""
+
+from __future__ import print_function
+import threading
+import time
+try:
+    import Queue as queue
+except ImportError:
+    import queue
+import numpy as np
+
+def _nbytes(data):
+    if isinstance(data, np.ndarray):
+        return data.nbytes
+    if isinstance(data, (list, tuple)):
+        return sum([_nbytes(d) for d in data])
+    return 0
+
+class Reader:
+    ''' Iterate over (item, load(item)) in the order of items. Items are loaded by a
+    background thread at most depth items and maxmem MB ahead (one item at least). The memory
+    of an item is reserved before loading it, estimated by the size of the previous item.
+    depth=0 loads the items in the calling thread. '''
+
+    def __init__(self, load, items, depth=2, maxmem=1024):
+        self.load = load
+        self.items = list(items)
+        self.depth = depth
+        self.maxmem = maxmem*1024**2
+        self.stall = 0.
+        self.inflight = 0
+        self.cond = threading.Condition()
+
+    def _work(self):
+        estimate = 0
+        for item in self.items:
+            # wait for the memory of the item before loading it
+            with self.cond:
+                while self.inflight > 0 and self.inflight + estimate > self.maxmem:
+                    self.cond.wait()
+                self.inflight += estimate
+            try:
+                data = self.load(item)
+                error = None
+            except Exception as e:
+                data, error = None, e
+            size = _nbytes(data)
+            with self.cond:
+                self.inflight += size - estimate
+            estimate = size
+            self.queue.put((item, data, size, error))
+
+    def __iter__(self):
+        if self.depth == 0:
+            for item in self.items:
+                t = time.time()
+                data = self.load(item)
+                self.stall += time.time() - t
+                yield item, data
+            return
+        self.queue = queue.Queue(self.depth)
+        thread = threading.Thread(target=self._work)
+        thread.daemon = True
+        thread.start()
+        for i in range(len(self.items)):
+            t = time.time()
+            item, data, size, error = self.queue.get()
+            self.stall += time.time() - t
+            with self.cond:
+                self.inflight -= size
+                self.cond.notify()
+            if error is not None:
+                raise error
+            yield item, data
+        thread.join()
+
+    def report(self):
+        print('Time waiting for inputs: {:.1f} s'.format(self.stall))
+
+class Writer:
+    ''' Call the write functions in a background thread, at most depth calls ahead.
+    depth=0 writes in the calling thread. Errors are raised by close(). '''
+
+    def __init__(self, depth=2):
+        self.depth = depth
+        self.stall = 0.
+        self.errors = []
+        if depth > 0:
+            self.queue = queue.Queue(depth)
+            self.thread = threading.Thread(target=self._work)
+            self.thread.daemon = True
+            self.thread.start()
+
+    def _work(self):
+        while True:
+            job = self.queue.get()
+            if job is None:
+                break
+            function, args = job
+            try:
+                function(*args)
+            except Exception as e:
+                self.errors.append('{}: {}'.format(args[0], e))
+
+    def put(self, function, *args):
+        ''' Queue function(*args), args[0] being the name of the output '''
+        t = time.time()
+        if self.depth > 0:
+            self.queue.put((function, args))
+        else:
+            function(*args)
+        self.stall += time.time() - t
+
+    def close(self):
+        ''' Wait for all queued outputs to be written '''
+        t = time.time()
+        if self.depth > 0:
+            self.queue.put(None)
+            self.thread.join()
+            self.depth = 0
+        self.stall += time.time() - t
+        if len(self.errors) > 0:
+            raise IOError('Writing failed for ' + ', '.join(self.errors))
+
+    def report(self):
+        print('Time waiting for outputs: {:.1f} s'.format(self.stall))
@@ -0,0 +1,198 @@
+# -*- coding: utf-8 -*-
+############################################
+#
+# PyGdalSAR: An InSAR post-processing package
+# written in Python-Gdal
+#
+############################################
+# Author        : Simon DAOUT (Oxford)
+############################################
+
+"""\
+quicklook.py
+-------------
+Background rendering of decimated quick-look figures. Figure jobs (mosaics of maps or
+scatter plots) are decimated to screen resolution in the calling process and queued to a
+separate process that draws them with the Agg backend and saves rasterized PNG or PDF files.
+
+    renderer = quicklook.Renderer(enabled=True, fmt='png')
+    renderer.mosaic('maps', [map1, map2], titles=['20030101','20040101'], vmin=-1, vmax=1)
+    renderer.mosaic('cube', (cube[:,:,l] for l in range(N)), ncols=N)
+    ax = renderer.axes()
+    ax.scatter(x, y, s=0.01); ax.plot(xfit, yfit, '-r')
+    renderer.scatter('phase-topo', [ax])
+    renderer.close()
+"""
+
+from __future__ import print_function
+import multiprocessing
+import numpy as np
+
+def decimate(data, maxpix=500):
+    ''' Decimate a 2D array by a constant step such that its largest dimension is at most maxpix '''
+    data = np.asarray(data)
+    step = int(np.ceil(max(data.shape)/float(maxpix)))
+    if step > 1:
+        data = data[::step,::step]
+    return np.array(data, dtype=np.float32)
+
+class Axes:
+    ''' Record scatter and plot calls of an axe to be drawn later by the renderer.
+    Scatter clouds are decimated to at most maxpoints points. '''
+
+    def __init__(self, enabled=True, maxpoints=20000):
+        self.enabled = enabled
+        self.maxpoints = maxpoints
+        self.calls = []
+
+    def scatter(self, x, y, **kwargs):
+        if not self.enabled:
+            return
+        x, y = np.asarray(x).flatten(), np.asarray(y).flatten()
+        step = int(np.ceil(len(x)/float(self.maxpoints)))
+        if step > 1:
+            x, y = x[::step], y[::step]
+        self.calls.append(('scatter', (np.array(x,dtype=np.float32), np.array(y,dtype=np.float32)), kwargs))
+
+    def plot(self, *args, **kwargs):
+        if not self.enabled:
+            return
+        args = [np.array(a, dtype=np.float32) if not isinstance(a, str) else a for a in args]
+        self.calls.append(('plot', args, kwargs))
+
+    def set_title(self, *args, **kwargs):
+        if self.enabled:
+            self.calls.append(('set_title', args, kwargs))
+
+    def set_xlabel(self, *args, **kwargs):
+        if self.enabled:
+            self.calls.append(('set_xlabel', args, kwargs))
+
+    def set_ylabel(self, *args, **kwargs):
+        if self.enabled:
+            self.calls.append(('set_ylabel', args, kwargs))
+
+def _as_list(value, n):
+    if isinstance(value, (list, tuple, np.ndarray)):
+        return list(value)
+    return [value]*n
+
+def _draw_mosaic(plt, cm, job):
+    n = len(job['panels'])
+    nrows, ncols = job['nrows'], job['ncols']
+    vmins, vmaxs = _as_list(job['vmin'], n), _as_list(job['vmax'], n)
+    titles, rowlabels = job['titles'], job['rowlabels']
+    cmap = cm.get_cmap(job['cmap'])
+    cmap.set_bad('white')
+
+    fig = plt.figure(figsize=job['figsize'])
+    fig.subplots_adjust(hspace=0.001, wspace=0.001)
+    for l in range(n):
+        if job['panels'][l] is None:
+            continue
+        ax = fig.add_subplot(nrows, ncols, l+1)
+        cax = ax.imshow(job['panels'][l], cmap=cmap, vmax=vmaxs[l], vmin=vmins[l], interpolation='nearest')
+        if titles is not None and titles[l] is not None:
+            ax.set_title(titles[l], fontsize=6)
+        if rowlabels is not None and l % ncols == 0:
+            ax.set_ylabel(rowlabels[l // ncols])
+        plt.setp(ax.get_xticklabels(), visible=False)
+        plt.setp(ax.get_yticklabels(), visible=False)
+        if job['colorbar'] == 'each':
+            fig.colorbar(cax, orientation='vertical', shrink=0.2)
+    if job['colorbar'] == 'one' and n > 0:
+        fig.colorbar(cax, ax=fig.axes, orientation='vertical', aspect=10)
+    if job['suptitle'] is not None:
+        plt.suptitle(job['suptitle'])
+    return fig
+
+def _draw_scatter(plt, job):
+    n = len(job['axes'])
+    nrows, ncols = job['nrows'], job['ncols']
+    fig = plt.figure(figsize=job['figsize'])
+    for l in range(n):
+        ax = fig.add_subplot(nrows, ncols, l+1)
+        for name, args, kwargs in job['axes'][l]:
+            getattr(ax, name)(*args, **kwargs)
+        if job['titles'] is not None and job['titles'][l] is not None:
+            ax.set_title(job['titles'][l], fontsize=6)
+    if job['suptitle'] is not None:
+        plt.suptitle(job['suptitle'])
+    return fig
+
+def _worker(queue, fmt, dpi):
+    ''' Rendering process: draw and save queued jobs until None is received '''
+    import matplotlib
+    matplotlib.use('Agg')
+    import matplotlib.pyplot as plt
+    import matplotlib.cm as cm
+
+    while True:
+        job = queue.get()
+        if job is None:
+            break
+        try:
+            if job['kind'] == 'mosaic':
+                fig = _draw_mosaic(plt, cm, job)
+            else:
+                fig = _draw_scatter(plt, job)
+            fig.savefig('{}.{}'.format(job['filename'], fmt), format=fmt, dpi=dpi)
+            plt.close(fig)
+        except Exception as e:
+            print('Rendering of {} failed: {}'.format(job['filename'], e))
+
+class Renderer:
+    ''' Queue figure jobs to a separate rendering process.
+    If enabled is False, all calls are ignored and no process is started. '''
+
+    def __init__(self, enabled=True, fmt='png', maxpix=500, maxpoints=20000, dpi=150, queue_size=4):
+        self.enabled = enabled
+        self.fmt = fmt
+        self.maxpix = maxpix
+        self.maxpoints = maxpoints
+        if enabled:
+            self.queue = multiprocessing.Queue(queue_size)
+            self.process = multiprocessing.Process(target=_worker, args=(self.queue, fmt, dpi))
+            self.process.daemon = True
+            self.process.start()
+
+    def axes(self):
+        ''' Return an axe recording scatter and plot calls '''
+        return Axes(enabled=self.enabled, maxpoints=self.maxpoints)
+
+    def mosaic(self, filename, panels, titles=None, vmin=None, vmax=None, cmap='jet', suptitle=None,
+        nrows=None, ncols=None, figsize=(14,10), colorbar='one', rowlabels=None):
+        ''' Queue a mosaic of maps, saved in filename.fmt. panels is a list or a generator,
+        consumed one panel at a time and only if rendering is enabled. vmin and vmax are
+        scalars or lists of one value per panel. colorbar is 'one', 'each' or None. '''
+        if not self.enabled:
+            return
+        panels = [decimate(p, self.maxpix) if p is not None else None for p in panels]
+        n = len(panels)
+        if nrows is None:
+            nrows = 4
+        if ncols is None:
+            ncols = int(np.ceil(n/float(nrows)))
+        self.queue.put({'kind':'mosaic', 'filename':filename, 'panels':panels, 'titles':titles,
+            'vmin':vmin, 'vmax':vmax, 'cmap':cmap, 'suptitle':suptitle, 'nrows':nrows, 'ncols':ncols,
+            'figsize':figsize, 'colorbar':colorbar, 'rowlabels':rowlabels})
+
+    def scatter(self, filename, axes, titles=None, suptitle=None, nrows=None, ncols=None, figsize=(14,10)):
+        ''' Queue a figure made of the recorded axes, saved in filename.fmt '''
+        if not self.enabled or len(axes) == 0:
+            return
+        n = len(axes)
+        if nrows is None:
+            nrows = 4
+        if ncols is None:
+            ncols = int(np.ceil(n/float(nrows)))
+        self.queue.put({'kind':'scatter', 'filename':filename, 'axes':[ax.calls for ax in axes],
+            'titles':titles, 'suptitle':suptitle, 'nrows':nrows, 'ncols':ncols, 'figsize':figsize})
+
+    def close(self):
+        ''' Wait for all queued figures to be written '''
+        if not self.enabled:
+            return
+        self.queue.put(None)
+        self.process.join()
+        self.enabled = False
@@ -0,0 +1,135 @@
+# -*- coding: utf-8 -*-
+############################################
+#
+# PyGdalSAR: An InSAR post-processing package
+# written in Python-Gdal
+#
+############################################
+# Author        : Simon DAOUT (Oxford)
+############################################
+
+"""\
+rasterwriter.py
+-------------
+Block-wise writer of float32 outputs. GeoTIFFs are tiled, DEFLATE compressed with the
+floating point predictor and get internal overviews. Sources (in-memory or memmapped
+arrays) are converted to float32 one strip of lines at a time and written by a pool of
+background threads, so that several outputs are written concurrently.
+
+    writer = rasterwriter.Writer(gt=gt, proj=proj)
+    writer.tif('lin_coeff.tif', m)
+    writer.stack('coeff_stack.tif', [m1, m2], descriptions=['ref', 'lin'])
+    writer.r4('depl_cumule_flat', cube)
+    writer.r4('depl_cumule_dseas', cube, sub=models)
+    writer.close()
+
+Arrays given to the writer must not be modified before close() returns.
+"""
+
+from __future__ import print_function
+import threading
+try:
+    import Queue as queue
+except ImportError:
+    import queue
+import numpy as np
+
+OPTIONS = ['TILED=YES', 'COMPRESS=DEFLATE', 'PREDICTOR=3', 'BIGTIFF=IF_SAFER']
+
+def overview_levels(nlign, ncol, blocksize=256):
+    ''' Decimation factors of the overviews, down to the size of one block '''
+    levels, level = [], 2
+    while max(nlign, ncol) // level >= blocksize:
+        levels.append(level)
+        level *= 2
+    return levels
+
+def write_tif(filename, arrays, gt=None, proj=None, descriptions=None, nodata=None,
+    blocksize=256, overviews=True):
+    ''' Write a list of 2D arrays in a tiled compressed GeoTIFF with one band per array '''
+    import gdal
+    nlign, ncol = arrays[0].shape[:2]
+    driver = gdal.GetDriverByName('GTiff')
+    options = OPTIONS + ['BLOCKXSIZE={}'.format(blocksize), 'BLOCKYSIZE={}'.format(blocksize)]
+    if len(arrays) > 1:
+        options.append('INTERLEAVE=BAND')
+    ds = driver.Create(filename, ncol, nlign, len(arrays), gdal.GDT_Float32, options)
+    if gt is not None:
+        ds.SetGeoTransform(gt)
+    if proj is not None:
+        ds.SetProjection(proj)
+    for b in range(len(arrays)):
+        band = ds.GetRasterBand(b+1)
+        if nodata is not None:
+            band.SetNoDataValue(nodata)
+        if descriptions is not None:
+            band.SetDescription(str(descriptions[b]))
+        # one strip of tiles at a time
+        for i in range(0, nlign, blocksize):
+            band.WriteArray(np.asarray(arrays[b][i:i+blocksize], dtype=np.float32), 0, i)
+        band.FlushCache()
+    if overviews:
+        levels = overview_levels(nlign, ncol, blocksize)
+        if len(levels) > 0:
+            ds.BuildOverviews('AVERAGE', levels)
+    ds.FlushCache()
+    del ds
+
+def write_r4(filename, data, blocksize=256, sub=None):
+    ''' Write an array (map or BIP cube), minus sub if given, as raw float32, one strip of
+    lines at a time '''
+    fid = open(filename, 'wb')
+    for i in range(0, data.shape[0], blocksize):
+        block = data[i:i+blocksize]
+        if sub is not None:
+            block = np.asarray(block) - np.asarray(sub[i:i+blocksize])
+        np.asarray(block, dtype=np.float32).tofile(fid)
+    fid.close()
+
+class Writer:
+    ''' Write outputs in background threads. Errors are raised by close(). '''
+
+    def __init__(self, gt=None, proj=None, nthreads=2, blocksize=256, overviews=True, queue_size=8):
+        self.gt, self.proj = gt, proj
+        self.blocksize = blocksize
+        self.overviews = overviews
+        self.errors = []
+        self.queue = queue.Queue(queue_size)
+        self.threads = [threading.Thread(target=self._work) for t in range(nthreads)]
+        for thread in self.threads:
+            thread.daemon = True
+            thread.start()
+
+    def _work(self):
+        while True:
+            job = self.queue.get()
+            if job is None:
+                break
+            function, args, kwargs = job
+            try:
+                function(*args, **kwargs)
+            except Exception as e:
+                self.errors.append('{}: {}'.format(args[0], e))
+
+    def tif(self, filename, data, nodata=None):
+        ''' Queue a single band GeoTIFF '''
+        self.stack(filename, [data], nodata=nodata)
+
+    def stack(self, filename, arrays, descriptions=None, nodata=None):
+        ''' Queue a multi-band GeoTIFF with one band per array '''
+        self.queue.put((write_tif, (filename, list(arrays)), {'gt':self.gt, 'proj':self.proj,
+            'descriptions':descriptions, 'nodata':nodata, 'blocksize':self.blocksize, 'overviews':self.overviews}))
+
+    def r4(self, filename, data, sub=None):
+        ''' Queue a raw float32 file of data, or of data - sub computed strip by strip '''
+        self.queue.put((write_r4, (filename, data), {'blocksize':self.blocksize, 'sub':sub}))
+
+    def close(self):
+        ''' Wait for all queued outputs to be written '''
+        for thread in self.threads:
+            self.queue.put(None)
+        for thread in self.threads:
+            thread.join()
+        self.threads = []
+        if len(self.errors) > 0:
+            raise IOError('Writing failed for ' + ', '.join(self.errors))
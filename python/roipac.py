@@ -0,0 +1,123 @@
+# -*- coding: utf-8 -*-
+############################################
+#
+# PyGdalSAR: An InSAR post-processing package
+# written in Python-Gdal
+#
+############################################
+# Author        : Simon DAOUT (Oxford)
+############################################
+
+"""\
+roipac.py
+-------------
+Direct access to ROI_PAC two-band files (.unw, .hgt): float32 BIL files, each line made of
+ncol values of the first band (amplitude) followed by ncol values of the second band (phase),
+with the size given by WIDTH and FILE_LENGTH in the .rsc sidecar. Bands are exposed as strided
+np.memmap views, such that only the lines used are read, and files are written in one
+sequential pass.
+
+    unw = roipac.open_unw('int.unw')
+    phi = unw.phi[ibeg:iend]                    # reads these lines of band 2 only
+    amp, phi = roipac.read_unw('int.unw')       # reads the whole file at once
+    roipac.write_unw('out.unw', amp, phi, rsc='int.unw.rsc')
+"""
+
+from __future__ import print_function
+import os
+import numpy as np
+
+def read_rsc(filename):
+    ''' Read the keys of the .rsc file of filename (or of the .rsc file itself) in a dict of strings '''
+    if not filename.endswith('.rsc'):
+        filename = filename + '.rsc'
+    rsc = {}
+    for line in open(filename, 'r'):
+        fields = line.split()
+        if len(fields) >= 2:
+            rsc[fields[0]] = ' '.join(fields[1:])
+    return rsc
+
+def _dtype(rsc):
+    ''' BIG_ENDIAN or MSB files are big-endian, all others little-endian '''
+    if rsc.get('BYTE_ORDER', 'LITTLE_ENDIAN').upper().startswith(('B','MSB')):
+        return np.dtype('>f4')
+    return np.dtype('<f4')
+
+class UnwFile:
+    ''' Two-band ROI_PAC file mapped in memory: amp and phi are (nlign,ncol) views '''
+
+    def __init__(self, filename, mode='r'):
+        self.filename = filename
+        self.rsc = read_rsc(filename)
+        self.ncol, self.nlign = int(self.rsc['WIDTH']), int(self.rsc['FILE_LENGTH'])
+        self.data = np.memmap(filename, dtype=_dtype(self.rsc), mode=mode, shape=(self.nlign,2,self.ncol))
+        self.amp = self.data[:,0,:]
+        self.phi = self.data[:,1,:]
+
+    def close(self):
+        del self.amp, self.phi, self.data
+
+def open_unw(filename, mode='r'):
+    ''' Map a two-band ROI_PAC file in memory without reading it '''
+    return UnwFile(filename, mode)
+
+def read_unw(filename):
+    ''' Read both bands of a two-band ROI_PAC file in one sequential read.
+    Returns (amp, phi) as float32 views on the data read '''
+    rsc = read_rsc(filename)
+    ncol, nlign = int(rsc['WIDTH']), int(rsc['FILE_LENGTH'])
+    data = np.fromfile(filename, dtype=_dtype(rsc), count=nlign*2*ncol).reshape((nlign,2,ncol))
+    if data.dtype != np.float32:
+        data = data.astype(np.float32)
+    return data[:,0,:], data[:,1,:]
+
+def write_rsc(filename, ncol, nlign, rsc=None):
+    ''' Write the .rsc file of filename with the keys of rsc (dict or .rsc path) and the size.
+    Files are always written little-endian, the byte order of rsc is not copied '''
+    if isinstance(rsc, str):
+        rsc = read_rsc(rsc)
+    keys = [] if rsc is None else [k for k in rsc if k not in ['WIDTH', 'FILE_LENGTH', 'BYTE_ORDER']]
+    fid = open(filename + '.rsc', 'w')
+    fid.write('{:<40} {}\n'.format('WIDTH', ncol))
+    fid.write('{:<40} {}\n'.format('FILE_LENGTH', nlign))
+    for k in keys:
+        fid.write('{:<40} {}\n'.format(k, rsc[k]))
+    fid.close()
+
+class UnwWriter:
+    ''' Write a two-band ROI_PAC file sequentially, block of lines by block of lines.
+    Blocks narrower than ncol are padded with zeros, missing lines are filled with zeros by close(). '''
+
+    def __init__(self, filename, ncol, nlign, rsc=None):
+        self.filename = filename
+        self.ncol, self.nlign = ncol, nlign
+        self.written = 0
+        write_rsc(filename, ncol, nlign, rsc)
+        self.fid = open(filename, 'wb')
+
+    def write(self, amp, phi):
+        ''' Append the lines of the two bands '''
+        n, m = np.shape(phi)
+        n = min(n, self.nlign - self.written)
+        m = min(m, self.ncol)
+        block = np.zeros((n,2,self.ncol), dtype='<f4')
+        block[:,0,:m] = amp[:n,:m]
+        block[:,1,:m] = phi[:n,:m]
+        block.tofile(self.fid)
+        self.written += n
+
+    def close(self):
+        if self.written < self.nlign:
+            np.zeros((self.nlign - self.written,2,self.ncol), dtype='<f4').tofile(self.fid)
+            self.written = self.nlign
+        self.fid.close()
+
+def write_unw(filename, amp, phi, rsc=None, blocksize=256):
+    ''' Write both bands of a two-band ROI_PAC file in one sequential pass.
+    rsc is a dict or a .rsc file whose keys are copied in the new .rsc file '''
+    nlign, ncol = np.shape(phi)
+    writer = UnwWriter(filename, ncol, nlign, rsc)
+    for i in range(0, nlign, blocksize):
+        writer.write(amp[i:i+blocksize], phi[i:i+blocksize])
+    writer.close()
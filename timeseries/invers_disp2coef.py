@@ -16,12 +16,16 @@ Spatial and temporal inversions of the time series delay maps (used depl_cumule
 At each iteration, (1) estimation of spatial ramps, (2) linear decomposition in time based on a library of temporal functions (linear, heaviside, logarithm, seasonal),
 (3) estimation of RMS that will be then used as weight for the next iteration. Possibility to also to correct for a term proportional to the topography.
 
-Usage: invers_disp2coef.py [--cube=<path>] [--lectfile=<path>] [--list_images=<path>] [--aps=<path>] [--interseismic=<yes/no>] [--threshold_rmsd=<value>] \
+Usage: invers_disp2coef.py [--cube=<path>] [--lectfile=<path>] [--list_images=<path>] [--aps=<path>] [--cov=<path/yes>] [--robust=<huber/tukey>] [--robust_iter=<value>] [--robust_mask=<yes/no>] \
+[--smooth=<values>] [--smooth_weight=<value>] [--smooth_tile=<value>] \
+[--interseismic=<yes/no>] [--threshold_rmsd=<value>] \
 [--coseismic=<values>] [--postseismic=<values>]  [--seasonal=<yes/no>] [--slowslip=<values>] [--semianual=<yes/no>]  [--dem=<yes/no>] [--vector=<path>] \
+[--detect=<values>] [--detect_tcar=<value>] [--detect_max=<value>] [--detect_threshold=<value>] \
 [--flat=<0/1/2/3/4/5/6/7/8/9>] [--nfit=<0/1>] [--ivar=<0/1>] [--niter=<value>]  [--spatialiter=<yes/no>]  [--sampling=<value>] [--imref=<value>] [--mask=<path>] \
 [--rampmask=<yes/no>] [--threshold_mask=<value>] [--scale_mask=<value>] [--topofile=<path>] [--aspect=<path>] [--perc_topo=<value>] [--perc_los=<value>] \
+[--binned=<yes/no>] [--bin_cell=<value>] [--bin_elev=<value>] \
 [--tempmask=<yes/no>] [--cond=<value>] [--ineq=<value>] [--rmspixel=<path>] [--threshold_rms=<path>] \
-[--crop=<values>] [--fulloutput=<yes/no>] [--geotiff=<path>] [--plot=<yes/no>] \
+[--crop=<values>] [--sweep=<path>] [--fulloutput=<yes/no>] [--geotiff=<path>] [--coeffstack=<yes/no>] [--plot=<yes/no>] [--figformat=<png/pdf>] \
 [<ibeg>] [<iend>] [<jbeg>] [<jend>]
 
 invers_disp2coef.py -h | --help
@@ -32,6 +36,16 @@ Options:
 --lectfile PATH         Path to the lect.in file (output of invers_pixel) [default: lect.in]
 --list_images PATH      Path to list images file made of 5 columns containing for each images 1) number 2) Doppler freq (not read) 3) date in YYYYMMDD format 4) numerical date 5) perpendicular baseline [default: images_retenues]
 --aps PATH              Path to the APS file giving an input error to each dates [default: No weigthing if no spatial estimation or misfit spatial estimation used as input uncertianties]
+--cov PATH              Full N x N covariance between dates for the temporal inversion (generalized least-square). Path to a text file or yes to estimate it
+from the residuals of the previous iteration (at the first iteration, diagonal covariance given by aps) [default: None]
+--robust VALUE          Robust temporal inversion: iteratively reweighted least-square with huber or tukey weights on the residuals of each pixel
+normalised by their median absolute deviation. Samples with weights < 0.5 are counted as rejected [default: None]
+--robust_iter VALUE     Number of reweighting passes of the robust inversion [default: 3]
+--robust_mask YES/NO    If yes, save the weights of the robust inversion in the cube depl_cumule_weights [default: no]
+--smooth VALUES         Couple neighbouring pixels by a Laplacian smoothing of the given coefficient maps (e.g. lin,coswt,sinwt).
+Solved tile by tile with conjugate gradient on the normal equations of all pixels [default: None]
+--smooth_weight VALUE   Weight of the smoothing, relative to the median diagonal of the normal equations of the pixels [default: 1.]
+--smooth_tile VALUE     Number of lines of the tiles of the smoothing, solved with halos of tile/10 lines [default: 200]
 --rmspixel PATH         Path to the RMS map that gives an error for each pixel (e.g RMSpixel, output of invers_pixel) [default: None]
 --threshold_rms VALUE   Threshold on rmsmap for spatial estimations [default: 1.]
 --interseismic YES/NO   Add a linear function in the inversion
@@ -41,6 +55,11 @@ Options:
 --postseismic PATH      Add logarithmic transients to each coseismic step, indicate characteristic time of the log function, must be a serie of values of the same lenght than coseismic (e.g 1.,1.). To not associate postseismic function to a give coseismic step, put None (e.g None,1.)
 --slowslip   VALUE      Add slow-slip function in the inversion (as defined by Larson et al., 2004). Indicate median and characteristic time of the events (e.g. 2004.,1,2006,0.5), default: None
 --vector PATH           Path to the vector text file containing a value for each dates [default: None]
+--detect VALUES         Detect steps in the time series among a list of candidate times (e.g 2004.,2004.5,2005.) or a range start:end:step (e.g 2004:2008:0.1).
+Functions are selected for each pixel by greedy forward selection on top of the decomposition [default: None]
+--detect_tcar VALUE     If not None, also test a logarithmic transient of characteristic time tcar at each candidate time [default: None]
+--detect_max VALUE      Maximal number of detected functions per pixel [default: 2]
+--detect_threshold VALUE Minimal fraction of the weighted misfit explained by a detected function [default: 0.5]
 --seasonal YES/NO       If yes, add seasonal terms in the inversion
 --semianual YES/NO      If yes, add semianual terms in the inversion
 --dem Yes/No            If yes, add term proportional to the perpendicular baseline in the inversion
@@ -64,13 +83,23 @@ while for the next itarations, uncertainties are equals to the global RMS of the
 --aspect PATH           Path to aspect file in r4 or tif format: take into account the slope orientation in the phase/topo relationship [default: None].
 --perc_los VALUE        Percentile of hidden LOS pixel for the spatial estimations to clean outliers [default:98.]
 --perc_topo VALUE       Percentile of topography ranges for the spatial estimations to remove some very low valleys or peaks [default:90.]
+--binned YES/NO         If yes, spatial estimations on the median LOS of bins made of coarse azimuth/range cells and elevation bins,
+weighted by their inter-quartile range [default: no]
+--bin_cell VALUE        Size in pixels of the azimuth/range cells for --binned [default: 50]
+--bin_elev VALUE        Number of elevation bins in each cell for --binned [default: 20]
 --crop VALUE            Define a region of interest for the temporal decomposition [default: 0,nlign,0,ncol]
 --cond VALUE            Condition value for optimization: Singular value smaller than cond*largest_singular_value are considered zero [default: 1.0e-10]
 --ineq VALUE            If yes, add ineguality constraints in the inversion: use least square result without post-seismic functions
 as a first guess to iterate the inversion. Force postseismic to be the same sign and inferior than coseismic steps of the first guess [default: no].
+--sweep PATH            Path to a JSON file containing a list of parameter sets, e.g. [{"name": "flat3", "--flat": 3}, {"--flat": 5, "--nfit": 1}].
+Each set overwrites the command line options and is run in its own subdirectory (name or set<number>). Inputs are read once and
+spatial estimations are shared between sets with the same spatial parameters. RMS of the residuals and mean APS of each set are
+saved in sweep_summary.txt. Figures are saved but not displayed [default: None]
 --fulloutput YES/NO     If yes produce maps of models, residuals, ramps, as well as flatten cube without seasonal and linear term [default: no]
 --geotiff PATH          Path to Geotiff to save outputs in tif format. If None save output are saved as .r4 files [default: .r4]
---plot YES/NO           Display plots [default: yes]
+--coeffstack YES/NO     If yes and geotiff is not None, also save all coefficients and uncertainties in coeff_stack.tif and sigcoeff_stack.tif [default: no]
+--plot YES/NO           Display plots. Map mosaics are decimated to screen resolution and written in background. If no, no figure is built [default: yes]
+--figformat VALUE       Format of the map mosaics: png or pdf [default: png]
 --ibeg VALUE            Line numbers bounding the ramp estimation zone [default: 0]
 --iend VALUE            Line numbers bounding the ramp estimation zone [default: nlign]
 --jbeg VALUE            Column numbers bounding the ramp estimation zone [default: 0]
@@ -94,12 +123,16 @@ from numpy.lib.stride_tricks import as_strided
 import scipy
 import scipy.optimize as opt
 import scipy.linalg as lst
+import scipy.sparse as sparse
+import scipy.sparse.linalg as splinalg
 
 # from nsbas import gdal, osr
 import gdal, osr
 
 # basic
 import math,sys,getopt
+import tempfile, shutil
+import json, hashlib
 from os import path, environ
 import os
 
@@ -116,6 +149,11 @@ import datetime
 # docopt (command line parser)
 import docopt
 
+# background rendering of figures
+import quicklook
+import rasterwriter
+import binning
+
 np.warnings.filterwarnings('ignore')
 
 ################################
@@ -258,12 +296,89 @@ class vector(pattern):
     def g(self,index):
         return self.func[index]
 
+def read_input(path):
+    '''Read a r4 or tif file as a flat array, or return the array preloaded by the sweep mode'''
+    if path in preloaded:
+        return preloaded[path]
+    extension = os.path.splitext(path)[1]
+    if extension == ".tif":
+      ds = gdal.Open(path, gdal.GA_ReadOnly)
+      band = ds.GetRasterBand(1)
+      data = band.ReadAsArray().flatten()
+      del ds
+    else:
+      fid = open(path,'r')
+      data = np.fromfile(fid,dtype=np.float32)
+      fid.close()
+    return data
+
 ################################
 # Initialization
 ################################
 
 # read arguments
 arguments = docopt.docopt(__doc__)
+
+# sweep mode: run each set of parameters in a child process sharing the inputs read once
+preloaded = {}
+sweepcache = None
+if arguments["--sweep"] is not None:
+    sets = json.load(open(arguments["--sweep"]))
+    root = os.getcwd()
+
+    # absolute paths as each set is run in its own directory
+    defaults = {"--cube":"depl_cumule", "--lectfile":"lect.in", "--list_images":"images_retenues"}
+    paths = ["--cube","--lectfile","--list_images","--aps","--cov","--rmspixel","--mask","--topofile","--aspect","--vector","--geotiff"]
+    for key in defaults:
+        if arguments[key] is None:
+            arguments[key] = defaults[key]
+    for key in paths:
+        if arguments[key] is not None and arguments[key] != 'yes':
+            arguments[key] = os.path.abspath(arguments[key])
+
+    print
+    print 'Sweep: read inputs once for {} sets...'.format(len(sets))
+    for key in ["--cube","--mask","--topofile","--aspect","--rmspixel"]:
+        if arguments[key] is not None:
+            preloaded[arguments[key]] = read_input(arguments[key])
+
+    summary = []
+    for s in xrange(len(sets)):
+        params = dict(sets[s])
+        name = str(params.pop("name","set{}".format(s)))
+        outdir = os.path.join(root,name)
+        if not os.path.exists(outdir):
+            os.makedirs(outdir)
+        pid = os.fork()
+        if pid == 0:
+            # child: overwrite options and run the rest of the script in outdir
+            for key in params:
+                option = key if key.startswith('--') else '--'+key
+                if option not in arguments:
+                    print 'Error: unknown option {} in set {}. Exit!'.format(option,name)
+                    os._exit(1)
+                value = str(params[key])
+                if option in paths and value != 'yes':
+                    value = os.path.abspath(value)
+                arguments[option] = value
+            os.chdir(outdir)
+            sweepcache = os.path.join(root,'sweep_cache')
+            break
+        status = os.waitpid(pid,0)[1]
+        if status == 0 and os.path.exists(os.path.join(outdir,'sweep_result.txt')):
+            rmsres, meanaps = np.loadtxt(os.path.join(outdir,'sweep_result.txt'))
+        else:
+            rmsres, meanaps = float('NaN'), float('NaN')
+        print 'Set {}: RMS {}, mean APS {}'.format(name,rmsres,meanaps)
+        summary.append('{} {:.6f} {:.6f} {}'.format(name,rmsres,meanaps,json.dumps(params,sort_keys=True)))
+    else:
+        # parent: all sets are done
+        fid = open('sweep_summary.txt','w')
+        fid.write('# name rms aps parameters\n')
+        fid.write('\n'.join(summary)+'\n')
+        fid.close()
+        sys.exit()
+
 if arguments["--lectfile"] ==  None:
     infile = "lect.in"
 else:
@@ -312,6 +427,26 @@ else:
 sse_time = sse[::2]
 sse_car = sse[1::2]
 
+if arguments["--detect"] ==  None:
+    detect = []
+elif ':' in arguments["--detect"]:
+    start,end,step = map(float,arguments["--detect"].split(':'))
+    detect = list(np.arange(start,end+step/2.,step))
+else:
+    detect = map(float,arguments["--detect"].replace(',',' ').split())
+if arguments["--detect_tcar"] ==  None:
+    detect_tcar = None
+else:
+    detect_tcar = float(arguments["--detect_tcar"])
+if arguments["--detect_max"] ==  None:
+    detect_max = 2
+else:
+    detect_max = int(arguments["--detect_max"])
+if arguments["--detect_threshold"] ==  None:
+    detect_threshold = 0.5
+else:
+    detect_threshold = float(arguments["--detect_threshold"])
+
 if arguments["--vector"] != None:
     vect = arguments["--vector"]
 else:
@@ -414,6 +549,46 @@ if arguments["--ineq"] ==  None:
     ineq = 'no'
 else:
     ineq = arguments["--ineq"]
+if arguments["--cov"] ==  None:
+    covf = None
+else:
+    covf = arguments["--cov"]
+    if ineq=='yes':
+        print 'Error: inequality constraints are not implemented with a full covariance. Exit!'
+        sys.exit()
+if arguments["--robust"] ==  None:
+    robust = None
+else:
+    robust = arguments["--robust"]
+    if robust not in ['huber','tukey']:
+        print 'Error: robust must be huber or tukey. Exit!'
+        sys.exit()
+    if ineq=='yes' or covf is not None:
+        print 'Error: robust inversion is not implemented with inequality constraints or a full covariance. Exit!'
+        sys.exit()
+if arguments["--smooth"] ==  None:
+    smooth = []
+else:
+    smooth = arguments["--smooth"].replace(',',' ').split()
+if arguments["--smooth_weight"] ==  None:
+    smooth_weight = 1.
+else:
+    smooth_weight = float(arguments["--smooth_weight"])
+if arguments["--smooth_tile"] ==  None:
+    smooth_tile = 200
+else:
+    smooth_tile = int(arguments["--smooth_tile"])
+if len(smooth) > 0 and ineq=='yes':
+    print 'Error: smoothing is not implemented with inequality constraints. Exit!'
+    sys.exit()
+if arguments["--robust_iter"] ==  None:
+    robust_iter = 3
+else:
+    robust_iter = int(arguments["--robust_iter"])
+if arguments["--robust_mask"] ==  None:
+    robust_mask = 'no'
+else:
+    robust_mask = arguments["--robust_mask"]
 if arguments["--threshold_rmsd"] ==  None:
     maxrmsd = 0.
 else:
@@ -427,6 +602,13 @@ if arguments["--plot"] ==  None:
     plot = 'yes'
 else:
     plot = arguments["--plot"]
+# figures of sweep sets are saved but not displayed
+if sweepcache is not None and plot=='yes':
+    plot = 'save'
+if arguments["--figformat"] ==  None:
+    figformat = 'png'
+else:
+    figformat = arguments["--figformat"]
 
 if arguments["--cube"] ==  None:
     cubef = "depl_cumule"
@@ -442,6 +624,11 @@ else:
     proj = georef.GetProjection()
     driver = gdal.GetDriverByName('GTiff')
 
+if arguments["--coeffstack"] ==  None:
+    coeffstack = 'no'
+else:
+    coeffstack = arguments["--coeffstack"]
+
 if arguments["--ivar"] == None:
     ivar = 0
 elif int(arguments["--ivar"]) <  2:
@@ -467,6 +654,18 @@ if arguments["--perc_los"] ==  None:
     perc_los = 98.
 else:
     perc_los = float(arguments["--perc_los"])
+if arguments["--binned"] ==  None:
+    binned = 'no'
+else:
+    binned = arguments["--binned"]
+if arguments["--bin_cell"] ==  None:
+    bin_cell = 50
+else:
+    bin_cell = int(arguments["--bin_cell"])
+if arguments["--bin_elev"] ==  None:
+    bin_elev = 20
+else:
+    bin_elev = int(arguments["--bin_elev"])
 
 
 if len(cos) > 0:
@@ -481,15 +680,24 @@ if len(cos) > 0:
 cmap = cm.jet
 cmap.set_bad('white')
 
+# start rendering process before loading the cube
+renderer = quicklook.Renderer(enabled=(plot!='no'),fmt=figformat)
+
 # load images_retenues file
 nb,idates,dates,base=np.loadtxt(listim, comments='#', usecols=(0,1,3,5), unpack=True,dtype='i,i,f,f')
 
 N=len(dates)
+
+if covf is not None and covf!='yes':
+    cov = np.loadtxt(covf, comments='#', dtype='f')
+    if cov.shape != (N,N):
+        print 'Error: covariance must be a {} x {} matrix. Exit!'.format(N,N)
+        sys.exit()
 print 'Number images: ', N
 datemin, datemax = np.int(np.nanmin(dates)), np.int(np.nanmax(dates))+1
 
 # lect cube
-cubei = np.fromfile(cubef,dtype=np.float32)
+cubei = read_input(cubef)
 
 # extract
 cube = as_strided(cubei[:nlign*ncol*N])
@@ -522,16 +730,7 @@ nfigure=0
 # open mask file
 mask = np.zeros((nlign,ncol))
 if maskfile is not None:
-    extension = os.path.splitext(maskfile)[1]
-    if extension == ".tif":
-      ds = gdal.Open(maskfile, gdal.GA_ReadOnly)
-      band = ds.GetRasterBand(1)
-      maski = band.ReadAsArray().flatten()*scale
-      del ds
-    else:
-      fid = open(maskfile,'r')
-      maski = np.fromfile(fid,dtype=np.float32)*scale
-      fid.close()
+    maski = read_input(maskfile)*scale
     maski = maski[:nlign*ncol]
     mask = maski.reshape((nlign,ncol))
 
@@ -539,17 +738,7 @@ if maskfile is not None:
 elev = np.zeros((nlign,ncol))
 # open elevation map
 if radar is not None:
-    extension = os.path.splitext(radar)[1]
-    if extension == ".tif":
-      ds = gdal.Open(radar, gdal.GA_ReadOnly)
-      band = ds.GetRasterBand(1)
-      elevi = band.ReadAsArray().flatten()
-      del ds
-    else:
-      fid = open(radar,'r')
-      elevi = np.fromfile(fid,dtype=np.float32)
-      fid.close()
-
+    elevi = read_input(radar)
     elevi = elevi[:nlign*ncol]
     # fig = plt.figure(10)
     # plt.imshow(elevi.reshape(nlign,ncol)[ibeg:iend,jbeg:jend])
@@ -563,17 +752,7 @@ if radar is not None:
 
 
 if aspect is not None:
-    extension = os.path.splitext(aspect)[1]
-    if extension == ".tif":
-      ds = gdal.Open(aspect, gdal.GA_ReadOnly)
-      band = ds.GetRasterBand(1)
-      aspecti = band.ReadAsArray().flatten()
-      # print ds.RasterYSize, ds.RasterXSize
-      del ds
-    else:
-      fid = open(aspect,'r')
-      aspecti = np.fromfile(fid,dtype=np.float32)
-      fid.close()
+    aspecti = read_input(aspect)
     aspecti = aspecti[:nlign*ncol]
     slope = aspecti.reshape((nlign,ncol))
     slope[np.isnan(maps[:,:,-1])] = float('NaN')
@@ -586,20 +765,15 @@ if aspect is not None:
     # sys.exit()
 
 if rmsf is not None:
-    rmsmap = np.fromfile(rmsf,dtype=np.float32).reshape((nlign,ncol))
+    rmsmap = read_input(rmsf).reshape((nlign,ncol))
     rmsmap = rmsmap[:nlign,:ncol]
     kk = np.nonzero(np.logical_or(rmsmap==0.0, rmsmap>999.))
     rmsmap[kk] = float('NaN')
     kk = np.nonzero(rmsmap>seuil_rms)
     spacial_mask = np.copy(rmsmap)
     spacial_mask[kk] = float('NaN')
-    fig = plt.figure(nfigure,figsize=(9,4))
-    nfigure = nfigure + 1
-    ax = fig.add_subplot(1,1,1)
-    cax = ax.imshow(spacial_mask,cmap=cmap)
-    ax.set_title('Mask on spatial estimation based on RMSpixel')
-    setp( ax.get_xticklabels(), visible=False)
-    fig.colorbar(cax, orientation='vertical',aspect=10)
+    renderer.mosaic('rmspixel',[spacial_mask],nrows=1,ncols=1,figsize=(9,4),
+        suptitle='Mask on spatial estimation based on RMSpixel')
     del spacial_mask
     # if plot=='yes':
     #    plt.show()
@@ -618,37 +792,38 @@ if rmsf is not None:
 #sys.exit()
 
 # plot bperp vs time
-fig = plt.figure(nfigure,figsize=(10,4))
-nfigure = nfigure + 1
-ax = fig.add_subplot(1,2,1)
-# convert idates to num
-x = [date2num(datetime.datetime.strptime('{}'.format(d),'%Y%m%d')) for d in idates]
-# format the ticks
-ax.xaxis.set_major_formatter(mdates.DateFormatter("%Y/%m/%d"))
-ax.plot(x,base,"ro",label='Baseline history of the {} images'.format(N))
-ax.plot(x,base,"green")
-# rotates and right aligns the x labels, and moves the bottom of the
-# axes up to make room for them
-fig.autofmt_xdate()
-ax.set_xlabel('Time (Year/month/day)')
-ax.set_ylabel('Perpendicular Baseline')
-plt.legend(loc='best')
-
-ax = fig.add_subplot(1,2,2)
-ax.plot(np.mod(dates,1),base,"ro",label='Baseline seasonality of the {} images'.format(N))
-plt.legend(loc='best')
-
-fig.savefig('baseline.eps', format='EPS',dpi=150)
+if plot!='no':
+    fig = plt.figure(nfigure,figsize=(10,4))
+    nfigure = nfigure + 1
+    ax = fig.add_subplot(1,2,1)
+    # convert idates to num
+    x = [date2num(datetime.datetime.strptime('{}'.format(d),'%Y%m%d')) for d in idates]
+    # format the ticks
+    ax.xaxis.set_major_formatter(mdates.DateFormatter("%Y/%m/%d"))
+    ax.plot(x,base,"ro",label='Baseline history of the {} images'.format(N))
+    ax.plot(x,base,"green")
+    # rotates and right aligns the x labels, and moves the bottom of the
+    # axes up to make room for them
+    fig.autofmt_xdate()
+    ax.set_xlabel('Time (Year/month/day)')
+    ax.set_ylabel('Perpendicular Baseline')
+    plt.legend(loc='best')
+
+    ax = fig.add_subplot(1,2,2)
+    ax.plot(np.mod(dates,1),base,"ro",label='Baseline seasonality of the {} images'.format(N))
+    plt.legend(loc='best')
+
+    fig.savefig('baseline.eps', format='EPS',dpi=150)
 np.savetxt('bp_t.in', np.vstack([dates,base]).T, fmt='%.6f')
 
 if vect is not None:
     v = np.loadtxt(vect, comments='#', unpack = False, dtype='f')
-    fig = plt.figure(nfigure,figsize=(6,4))
-    nfigure = nfigure + 1
-    ax = fig.add_subplot(1,1,1)
-    ax.plot(v,label='Vector')
-    plt.legend(loc='best')
     if plot=='yes':
+        fig = plt.figure(nfigure,figsize=(6,4))
+        nfigure = nfigure + 1
+        ax = fig.add_subplot(1,1,1)
+        ax.plot(v,label='Vector')
+        plt.legend(loc='best')
         plt.show()
     # sys.exit()
 
@@ -720,58 +895,21 @@ if maskfile is not None:
             d[kk] = np.float('NaN')
 
     # plots
-    nfigure+=1
-    fig = plt.figure(nfigure,figsize=(7,6))
     vmax = np.abs([np.nanmedian(mask_flat) + nanstd(mask_flat),\
         np.nanmedian(mask_flat) - nanstd(mask_flat)]).max()
     vmin = -vmax
-
-    ax = fig.add_subplot(1,3,1)
-    cax = ax.imshow(mask,cmap=cmap,vmax=vmax,vmin=vmin)
-    ax.set_title('Original Mask')
-    setp( ax.get_xticklabels(), visible=False)
-
-    ax = fig.add_subplot(1,3,2)
-    cax = ax.imshow(mask_flat,cmap=cmap,vmax=vmax,vmin=vmin)
-    ax.set_title('Flat Mask')
-    setp( ax.get_xticklabels(), visible=False)
-    #cbar = fig.colorbar(cax, orientation='vertical',aspect=10)
-
-    ax = fig.add_subplot(1,3,3)
-    cax = ax.imshow(mask_flat_clean,cmap=cmap,vmax=vmax,vmin=vmin)
-    ax.set_title('Final Mask')
-    setp( ax.get_xticklabels(), visible=False)
-    #cbar = fig.colorbar(cax, orientation='vertical',aspect=10)
-    fig.savefig('mask.eps', format='EPS',dpi=150)
+    renderer.mosaic('mask',[mask,mask_flat,mask_flat_clean],titles=['Original Mask','Flat Mask','Final Mask'],
+        vmin=vmin,vmax=vmax,nrows=1,ncols=3,figsize=(7,6),colorbar=None)
     del mask_flat_clean
 
-    if plot=='yes':
-        plt.show()
-    # sys.exit()
-
 
 # plot diplacements maps
-nfigure+=1
-fig = plt.figure(nfigure,figsize=(14,10))
-fig.subplots_adjust(wspace=0.001)
 vmax = np.abs([np.nanmedian(maps[:,:,-1]) + 1.*np.nanstd(maps[:,:,-1]),\
     np.nanmedian(maps[:,:,-1]) - 1.*np.nanstd(maps[:,:,-1])]).max()
 vmin = -vmax
 
-for l in xrange((N)):
-    d = as_strided(maps[ibeg:iend,jbeg:jend,l])
-    #ax = fig.add_subplot(1,N,l+1)
-    ax = fig.add_subplot(4,int(N/4)+1,l+1)
-    #cax = ax.imshow(d,cmap=cmap,vmax=vmax,vmin=vmin)
-    cax = ax.imshow(d,cmap=cmap,vmax=vmax,vmin=vmin)
-    ax.set_title(idates[l],fontsize=6)
-    setp( ax.get_xticklabels(), visible=False)
-    setp( ax.get_yticklabels(), visible=False)
-
-plt.suptitle('Time series maps')
-fig.colorbar(cax, orientation='vertical',aspect=10)
-fig.tight_layout()
-fig.savefig('maps.eps', format='EPS',dpi=150)
+renderer.mosaic('maps',(maps[ibeg:iend,jbeg:jend,l] for l in xrange((N))),titles=idates,
+    vmin=vmin,vmax=vmax,ncols=int(N/4)+1,suptitle='Time series maps')
 
 # plt.show()
 #sys.exit()
@@ -872,6 +1010,14 @@ for l in xrange((Mker)):
     kernels[l].m = np.ones((iend-ibeg,jend-jbeg))*np.float('NaN')
     kernels[l].sigmam = np.ones((iend-ibeg,jend-jbeg))*np.float('NaN')
 
+# index of the smoothed coefficients
+reductions = [basis[l].reduction for l in xrange(Mbasis)] + [kernels[l].reduction for l in xrange(Mker)]
+for name in smooth:
+    if name not in reductions:
+        print 'Error: {} is not one of the functions {}. Exit!'.format(name,reductions)
+        sys.exit()
+indexsmooth = [reductions.index(name) for name in smooth]
+
 # initialize qual
 if apsf=='no':
     inaps=np.ones((N)) # no weigthing for the first itertion
@@ -976,8 +1122,206 @@ def consInvert(A,b,sigmad,ineq='no',cond=1.0e-10, iter=2000,acc=1e-10):
 
     return fsoln,sigmam
 
+def covInvert(A,B,L,cond=1.0e-10):
+    '''Solves the generalized least-square problem for all pixels sharing the same design matrix.
+
+    Minimize:
+
+    (Ax-b)^T Cd^-1 (Ax-b) for each column b of B
+
+    with L the Cholesky factor of Cd: A and B are pre-whitened once by L.
+    '''
+
+    Aw = lst.solve_triangular(L,A,lower=True)
+    Bw = lst.solve_triangular(L,B,lower=True)
+    fsoln = lst.lstsq(Aw,Bw,cond=cond)[0]
+
+    # sigma m **2 =  misfit**2 * diag([Gw.TGw]-1) for each pixel
+    try:
+       varx = np.linalg.inv(np.dot(Aw.T,Aw))
+       res2 = np.sum(pow((Bw-np.dot(Aw,fsoln)),2),axis=0)
+       scale = 1./(A.shape[0]-A.shape[1])
+       sigmam = np.sqrt(scale*np.outer(np.diag(varx),res2))
+    except:
+       sigmam = np.ones(fsoln.shape)*float('NaN')
+
+    return fsoln,sigmam
+
+def robustInvert(A,B,L,norm='huber',niter=3,cond=1.0e-10):
+    '''Solves the robust least-square problem for all pixels sharing the same design matrix.
+
+    Iteratively reweighted least-square: at each pass, the residuals of each pixel are normalised
+    by their median absolute deviation and weighted by the huber or tukey function.
+    The weighted normal equations of all pixels are solved at once.
+
+    Returns the solutions, uncertainties and weights of each sample (dates x pixels)
+    '''
+
+    Aw = lst.solve_triangular(L,A,lower=True)
+    Bw = lst.solve_triangular(L,B,lower=True)
+    fsoln = lst.lstsq(Aw,Bw,cond=cond)[0]
+    w = np.ones(Bw.shape)
+
+    for it in xrange(niter):
+        res = Bw - np.dot(Aw,fsoln)
+        mad = 1.4826*np.median(np.abs(res - np.median(res,axis=0)),axis=0)
+        u = res/np.maximum(mad,1e-10)
+        if norm == 'huber':
+            c = 1.345
+            w = np.minimum(1.,c/np.maximum(np.abs(u),1e-10))
+        else:
+            c = 4.685
+            w = (1-(u/c)**2)**2
+            w[np.abs(u)>=c] = 0.
+        # weighted normal equations of each pixel
+        Ap = np.einsum('km,kp,kn->pmn',Aw,w,Aw)
+        bp = np.einsum('km,kp->pm',Aw,w*Bw)
+        varx = np.linalg.pinv(Ap,rcond=cond)
+        fsoln = np.einsum('pmn,pn->mp',varx,bp)
+
+    # sigma m **2 =  weighted misfit**2 * diag([Gw.TWGw]-1) for each pixel
+    if niter > 0 and A.shape[0] > A.shape[1]:
+        res2 = np.sum(w*pow((Bw-np.dot(Aw,fsoln)),2),axis=0)
+        scale = 1./(A.shape[0]-A.shape[1])
+        sigmam = np.sqrt(scale*res2*np.diagonal(varx,axis1=1,axis2=2).T)
+    else:
+        sigmam = covInvert(A,B,L,cond=cond)[1]
+
+    return fsoln,sigmam,w
+
+def laplacian(n):
+    '''Laplacian matrix of a path of n nodes'''
+    if n == 1:
+        return sparse.csr_matrix((1,1))
+    d = 2*np.ones((n))
+    d[0], d[-1] = d[0]-1, d[-1]-1
+    return sparse.diags([-np.ones((n-1)),d,-np.ones((n-1))],[-1,0,1])
+
+def smoothInvert(A,b,index,lamb,tile=200,halo=20,tol=1e-6):
+    '''Solves the normal equations of all pixels of a grid coupled by a smoothing penalty.
+
+    Minimize:
+
+    sum_p (m_p^T A_p m_p - 2 b_p^T m_p) + lamb * sum_(p,q neighbours) sum_(c in index) (m_p[c]-m_q[c])^2
+
+    with A (ny x nx x M x M) and b (ny x nx x M) the normal equations of each pixel.
+    The grid is solved by tiles of lines with halos using conjugate gradient preconditioned
+    by the inverse of the diagonal blocks.
+    '''
+
+    ny,nx,M = b.shape
+    E = np.zeros((M))
+    E[index] = 1.
+    m = np.zeros((ny,nx,M))
+
+    for t0 in xrange(0,ny,tile):
+        t1 = min(t0+tile,ny)
+        i0, i1 = max(t0-halo,0), min(t1+halo,ny)
+        npix = (i1-i0)*nx
+        Ab = np.array(A[i0:i1]).reshape(npix,M,M)
+        bb = np.array(b[i0:i1]).reshape(npix*M)
+        # regularize pixels without data
+        Ab = Ab + 1e-6*max(np.max(np.einsum('pmm->p',Ab)),1.)*np.eye(M)
+
+        # block diagonal normal equations + smoothing of the tile
+        Lg = sparse.kron(laplacian(i1-i0),sparse.eye(nx)) + sparse.kron(sparse.eye(i1-i0),laplacian(nx))
+        K = sparse.bsr_matrix((Ab,np.arange(npix),np.arange(npix+1)),shape=(npix*M,npix*M)) \
+            + lamb*sparse.kron(Lg,sparse.diags(E))
+
+        # block-Jacobi preconditioner
+        P = np.linalg.inv(Ab + lamb*Lg.diagonal()[:,np.newaxis,np.newaxis]*np.diag(E))
+        precond = splinalg.LinearOperator(K.shape,matvec=lambda x: np.einsum('pmn,pn->pm',P,x.reshape(npix,M)).flatten())
+
+        x,info = splinalg.cg(K.tocsr(),bb,x0=precond.matvec(bb),tol=tol,maxiter=10*M*max(i1-i0,nx),M=precond)
+        if info > 0:
+            print 'Smoothing: conjugate gradient did not converge for lines {}-{}'.format(t0,t1)
+        m[t0:t1] = x.reshape(i1-i0,nx,M)[t0-i0:t1-i0]
+
+    return m
+
+def detectInvert(A,H,B,L,nmax=2,threshold=0.5):
+    '''Greedy forward selection (orthogonal matching pursuit) of candidate functions.
+
+    For each column b of B, select at most nmax columns of H such that each selected column
+    explains more than threshold of the misfit of ||L^-1 (Ax-b)||^2 left by A and the previously
+    selected columns. All pixels sharing A, H and L are processed together.
+
+    Returns the indexes of the selected columns (nmax x pixels, -1 if none)
+    '''
+
+    Aw = lst.solve_triangular(L,A,lower=True)
+    Hw = lst.solve_triangular(L,H,lower=True)
+    Bw = lst.solve_triangular(L,B,lower=True)
+
+    npix = B.shape[1]
+    sel = -np.ones((nmax,npix)).astype(int)
+    active = np.ones((npix)).astype(bool)
+    for s in xrange(nmax):
+        # group pixels with the same previously selected functions
+        if s == 0:
+            keys, groups = np.zeros((1,0)).astype(int), np.zeros((npix)).astype(int)
+        else:
+            keys, groups = np.unique(sel[:s].T,axis=0,return_inverse=True)
+        for g in xrange(len(keys)):
+            pix = np.flatnonzero(np.logical_and(groups==g,active))
+            if len(pix) == 0:
+                continue
+            # project candidates and data orthogonally to the current functions
+            Q = lst.orth(np.hstack([Aw,Hw[:,keys[g]]]))
+            Hp = Hw - np.dot(Q,np.dot(Q.T,Hw))
+            res = Bw[:,pix] - np.dot(Q,np.dot(Q.T,Bw[:,pix]))
+            norm = np.sum(Hp**2,axis=0)
+            # candidates already spanned by the current functions cannot be selected
+            norm[norm < 1e-8*np.max(np.sum(Hw**2,axis=0))] = np.inf
+            score = np.dot(Hp.T,res)**2/norm[:,np.newaxis]
+            best = np.argmax(score,axis=0)
+            gain = score[best,np.arange(len(pix))]
+            ok = gain > threshold*np.sum(res**2,axis=0)
+            sel[s,pix[ok]] = best[ok]
+            active[pix[~ok]] = False
+
+    return sel
+
+def estimCov(res):
+    '''Estimates the covariance between dates from the residuals (pixels x dates) of the time decomposition.
+    Missing pairs are ignored and the covariance is forced to be positive definite.'''
+
+    valid = ~np.isnan(res)
+    res = np.where(valid,res,0.)
+    npairs = np.dot(valid.T.astype(float),valid.astype(float))
+    Cd = np.dot(res.T,res)/np.maximum(npairs,1)
+    w,v = np.linalg.eigh(Cd)
+    w = np.maximum(w,1e-6*np.max(np.abs(w)))
+    return np.dot(v*w,v.T)
+
+def cholCov(Cd,k,source):
+    '''Cholesky factor of the covariance between the dates k. Exit if it is not positive definite,
+    source describing where the covariance comes from.'''
+    try:
+        return np.linalg.cholesky(Cd[np.ix_(k,k)])
+    except np.linalg.LinAlgError:
+        print 'Error: the covariance between dates {} ({}) is not positive definite. Exit!'.format(
+            ' '.join(map(str,idates[k])),source)
+        sys.exit()
+
+# spatial estimations of the first iteration shared by the sets of a sweep
+if sweepcache is not None:
+    # all options that change maps or the spatial estimation
+    key = hashlib.md5(repr([cubef,nlign,ncol,listim,imref,flat,nfit,ivar,perc_topo,perc_los,maskfile,rampmask,seuil,scale,
+        tempmask,radar,aspect,rmsf,seuil_rms,ibegref,iendref,jbegref,jendref,binned,bin_cell,bin_elev])).hexdigest()
+    spatialcache = os.path.join(sweepcache,key)
+else:
+    spatialcache = None
+
 # initialization
 maps_flata = np.copy(maps)
+
+if len(smooth) > 0:
+    # normal equations of each pixel of the sampled grid, kept on disk
+    nys, nxs = len(xrange(ibeg,iend,sampling)), len(xrange(jbeg,jend,sampling))
+    tmpdir = tempfile.mkdtemp(dir='.')
+    normA = np.memmap(os.path.join(tmpdir,'normA'),dtype=np.float64,mode='w+',shape=(nys,nxs,M,M))
+    normb = np.memmap(os.path.join(tmpdir,'normb'),dtype=np.float64,mode='w+',shape=(nys,nxs,M))
 models = np.zeros((nlign,ncol,N))
 
 # prepare flatten maps
@@ -986,6 +1330,10 @@ maps_topo = np.zeros((nlign,ncol,N))
 maps_noramps = np.zeros((nlign,ncol,N))
 rms = np.zeros((N))
 
+# weights of the robust inversion, refilled at each iteration
+if robust is not None and robust_mask=='yes':
+    weights = np.empty((nlign,ncol,N),dtype=np.float32)
+
 for ii in xrange(niter):
     print
     print '---------------'
@@ -2938,13 +3286,18 @@ for ii in xrange(niter):
 
       return ramp, flata, topo, rms, noramps
 
-    # if radar file just initialise figure
-    if radar is not None:
-      nfigure +=1
-      fig = plt.figure(nfigure,figsize=(14,10))
+    # if radar file just initialise recorded axes of the phase/topo figure
+    phase_topo = []
     
     # if iteration = 0 or spatialiter > 0, then spatial estimation
-    if (ii==0) or (spatialiter=='yes') :
+    if ii==0 and spatialcache is not None and os.path.exists(spatialcache):
+      print
+      print 'Load spatial estimations from', spatialcache
+      maps_ramp[:], maps_flata[:], maps_topo[:], maps_noramps[:] = [np.load(os.path.join(spatialcache,'{}.npy'.format(name)),mmap_mode='r')
+          for name in ['ramp','flata','topo','noramps']]
+      rms[:] = np.load(os.path.join(spatialcache,'rms.npy'))
+
+    elif (ii==0) or (spatialiter=='yes') :
 
       # Loop over the dates
       for l in xrange((N)):
@@ -2974,7 +3327,9 @@ for ii in xrange(niter):
               topo_map_temp = np.matrix.copy(elev[ibegref:iendref,jbegref:jendref])
               maxtopo,mintopo = np.nanpercentile(topo_map_temp,perc_topo),np.nanpercentile(topo_map_temp,100-perc_topo)
               # initialize plot
-              ax = fig.add_subplot(4,int(N/4)+1,l+1)
+              ax = renderer.axes()
+              ax.set_title(idates[l],fontsize=6)
+              phase_topo.append(ax)
           else:
               topo_map_temp = np.ones((iendref-ibegref,jendref-jbegref))
               maxtopo,mintopo = 2, 0
@@ -3017,6 +3372,11 @@ for ii in xrange(niter):
           rms_clean = rms_map_temp[index].flatten()
           topo_clean = topo_map_temp[index].flatten()
 
+          if binned=='yes':
+              # robust statistics on azimuth/range cells and elevation bins
+              los_clean, topo_clean, x, y, rms_clean = binning.bin_points(los_clean, topo_clean, x, y,
+                  cell=bin_cell, nelev=bin_elev)
+
           # print itemp, iendref
           #4: ax+by+cxy+d 5: ax**2+bx+cy+d, 6: ay**2+by+cx+d, 7: ay**2+by+cx**2+dx+e, 8: ay**2+by+cx**3+dx**2+ex+f
           if flat>5 and iendref-itemp < .6*(iendref-ibegref):
@@ -3059,63 +3419,32 @@ for ii in xrange(niter):
           del maps_temp
 
       # plot corrected ts
-      nfigure +=1
-      figd = plt.figure(nfigure,figsize=(14,10))
-      figd.subplots_adjust(hspace=0.001,wspace=0.001)
-      for l in xrange((N)):
-          axd = figd.add_subplot(4,int(N/4)+1,l+1)
-          caxd = axd.imshow(maps_flata[ibeg:iend,jbeg:jend,l],cmap=cmap,vmax=vmax,vmin=vmin)
-          axd.set_title(idates[l],fontsize=6)
-          setp(axd.get_xticklabels(), visible=False)
-          setp(axd.get_yticklabels(), visible=False)
-      setp(axd.get_xticklabels(), visible=False)
-      setp(axd.get_yticklabels(), visible=False)
-      figd.colorbar(caxd, orientation='vertical',aspect=10)
-      figd.suptitle('Corrected time series maps')
-      fig.tight_layout()
-      figd.savefig('maps_flat.eps', format='EPS',dpi=150)
+      renderer.mosaic('maps_flat',(maps_flata[ibeg:iend,jbeg:jend,l] for l in xrange((N))),titles=idates,
+          vmin=vmin,vmax=vmax,ncols=int(N/4)+1,suptitle='Corrected time series maps')
 
       if radar is not None:
-          fig.savefig('phase-topo.eps', format='EPS',dpi=150)
-          nfigure +=1
-          figtopo = plt.figure(nfigure,figsize=(14,10))
-          figtopo.subplots_adjust(hspace=.001,wspace=0.001)
-          for l in xrange((N)):
-              axtopo = figtopo.add_subplot(4,int(N/4)+1,l+1)
-              caxtopo = axtopo.imshow(maps_topo[ibeg:iend,jbeg:jend,l]+maps_ramp[ibeg:iend,jbeg:jend,l],cmap=cmap,vmax=vmax,vmin=vmin)
-              axtopo.set_title(idates[l],fontsize=6)
-              setp(axtopo.get_xticklabels(), visible=False)
-              setp(axtopo.get_yticklabels(), visible=False)
-              setp(axtopo.get_xticklabels(), visible=False)
-              setp(axtopo.get_yticklabels(), visible=False)
-          figtopo.colorbar(caxtopo, orientation='vertical',aspect=10)
-          figtopo.suptitle('Time series RAMPS+TOPO')
-          fig.tight_layout()
-          figtopo.savefig('tropo.eps', format='EPS',dpi=150)
-          
+          renderer.scatter('phase-topo',phase_topo,ncols=int(N/4)+1)
+          renderer.mosaic('tropo',(maps_topo[ibeg:iend,jbeg:jend,l]+maps_ramp[ibeg:iend,jbeg:jend,l] for l in xrange((N))),
+              titles=idates,vmin=vmin,vmax=vmax,ncols=int(N/4)+1,suptitle='Time series RAMPS+TOPO')
 
       else:
           # plot corrected ts
-          nfigure +=1
-          figref = plt.figure(nfigure,figsize=(14,10))
-          figref.subplots_adjust(hspace=0.001,wspace=0.001)
-          for l in xrange((N)):
-              axref = figref.add_subplot(4,int(N/4)+1,l+1)
-              caxref = axref.imshow(maps_ramp[ibeg:iend,jbeg:jend,l],cmap=cmap,vmax=vmax,vmin=vmin)
-              axref.set_title(idates[l],fontsize=6)
-              setp(axref.get_xticklabels(), visible=False)
-              setp(axref.get_yticklabels(), visible=False)
-          setp(axref.get_xticklabels(), visible=False)
-          setp(axref.get_yticklabels(), visible=False)
-          figref.suptitle('Time series RAMPS')
-          figref.colorbar(caxref, orientation='vertical',aspect=10)
-          fig.tight_layout()
-          figref.savefig('maps_ramps.eps', format='EPS',dpi=150)
-          
-
-      if plot=='yes':
-        plt.show()
-      plt.close('all')
+          renderer.mosaic('maps_ramps',(maps_ramp[ibeg:iend,jbeg:jend,l] for l in xrange((N))),titles=idates,
+              vmin=vmin,vmax=vmax,ncols=int(N/4)+1,suptitle='Time series RAMPS')
+      del phase_topo
+
+      if ii==0 and spatialcache is not None:
+          # written in a temporary directory renamed once complete, such that an interrupted set leaves no partial cache
+          if not os.path.exists(sweepcache):
+              os.makedirs(sweepcache)
+          cachetmp = tempfile.mkdtemp(dir=sweepcache)
+          for name,data in zip(['ramp','flata','topo','noramps','rms'],[maps_ramp,maps_flata,maps_topo,maps_noramps,rms]):
+              np.save(os.path.join(cachetmp,'{}.npy'.format(name)),data)
+          try:
+              os.rename(cachetmp,spatialcache)
+          except OSError:
+              # cache written by an other set in the meantime
+              shutil.rmtree(cachetmp)
     
     # save rms
     if (apsf=='no' and ii==0):
@@ -3158,116 +3487,295 @@ for ii in xrange(niter):
     # cols = [100,117,843,189,43]
     # for i,j in zip(ligns,cols):
 
-    for i in xrange(ibeg,iend,sampling):
-        for j in xrange(jbeg,jend,sampling):
-            #print j
+    if robust is not None:
+        # count rejected pixels per date
+        rejected = np.zeros((N)).astype(int)
+        if robust_mask=='yes':
+            weights.fill(float('NaN'))
+
+    if covf is None and robust is None and len(smooth) == 0:
+        for i in xrange(ibeg,iend,sampling):
+            for j in xrange(jbeg,jend,sampling):
+                #print j
+
+                # Initialisation
+                mdisp=np.ones((N))*float('NaN')
+                #!!!!!
+                disp = as_strided(maps_flata[i,j,:])
+                # disp = as_strided(maps[i,j,:])
+                # print disp
+
+                k = np.flatnonzero(~np.isnan(disp)) # invers of isnan
+                # do not take into account NaN data
+                kk = len(k)
+                tabx = dates[k]
+                taby = disp[k]
+                bp = base[k]
+
+                # Inisilize m to zero
+                m = np.zeros((M))
+                sigmam = np.ones((M))*float('NaN')
+
+                if kk > N/6:
+                    G=np.zeros((kk,M))
+                    # Build G family of function k1(t),k2(t),...,kn(t): #
+                    #                                                   #
+                    #           |k1(0) .. kM(0)|                        #
+                    # Gfamily = |k1(1) .. kM(1)|                        #
+                    #           |..    ..  ..  |                        #
+                    #           |k1(N) .. kM(N)|                        #
+                    #                                                   #
+
+                    rmsd = maxrmsd + 1
+
+                    if inter=='yes' and iteration is True:
+                        Glin=np.zeros((kk,2+Mker))
+                        for l in xrange((2)):
+                            Glin[:,l]=basis[l].g(tabx)
+                        for l in xrange((Mker)):
+                            Glin[:,2+l]=kernels[l].g(k)
+
+                        mt,sigmamt = consInvert(Glin,taby,inaps[k],cond=rcond)
+
+                        # compute rmsd
+                        mdisp[k] = np.dot(Glin,mt)
+                        # sum sur toutes les dates
+                        # rmsd = np.sum(abs((disp[k] - mdisp[k])/inaps[k]))/kk  S
+                        rmsd = np.sqrt(np.sum(pow((disp[k] - mdisp[k]),2))/kk)
+                        # print i,j,rmsd,maxrmsd
+
+                    G=np.zeros((kk,M))
+                    for l in xrange((Mbasis)):
+                        G[:,l]=basis[l].g(tabx)
+                    for l in xrange((Mker)):
+                        G[:,Mbasis+l]=kernels[l].g(k)
+
+                    # if only ref + seasonal: ref + cos + sin
+                    if rmsd >= maxrmsd or inter!='yes':
+                        mt,sigmamt = consInvert(G,taby,inaps[k],cond=rcond,ineq=ineq)
+
+                    # rebuild full vectors
+                    if Mker>0:
+                        m[Mbasis:],sigmam[Mbasis:] = mt[-Mker:],sigmamt[-Mker:]
+                        m[:mt.shape[0]-Mker],sigmam[:mt.shape[0]-Mker] = mt[:-Mker],sigmamt[:-Mker]
+                    else:
+                        sigmam[:mt.shape[0]] = sigmamt
+                        m[:mt.shape[0]] = mt
+                    # print m
+                    # print
+
+                    # save m
+                    for l in xrange((Mbasis)):
+                        basis[l].m[i-ibeg,j-jbeg] = m[l]
+                        basis[l].sigmam[i-ibeg,j-jbeg] = sigmam[l]
 
-            # Initialisation
-            mdisp=np.ones((N))*float('NaN')
-            #!!!!!
-            disp = as_strided(maps_flata[i,j,:])
-            # disp = as_strided(maps[i,j,:])
-            # print disp
+                    for l in xrange((Mker)):
+                        kernels[l].m[i-ibeg,j-jbeg] = m[Mbasis+l]
+                        kernels[l].sigmam[i-ibeg,j-jbeg] = sigmam[Mbasis+l]
 
-            k = np.flatnonzero(~np.isnan(disp)) # invers of isnan
-            # do not take into account NaN data
-            kk = len(k)
-            tabx = dates[k]
-            taby = disp[k]
-            bp = base[k]
+                    # forward model in original order
+                    mdisp[k] = np.dot(G,m)
 
-            # Inisilize m to zero
-            m = np.zeros((M))
-            sigmam = np.ones((M))*float('NaN')
+                    # compute aps for each dates
+                    # aps_tmp = pow((disp[k]-mdisp[k])/inaps[k],2)
+                    aps_tmp = abs((disp[k]-mdisp[k]))/inaps[k]
 
-            if kk > N/6:
-                G=np.zeros((kk,M))
-                # Build G family of function k1(t),k2(t),...,kn(t): #
-                #                                                   #
-                #           |k1(0) .. kM(0)|                        #
-                # Gfamily = |k1(1) .. kM(1)|                        #
-                #           |..    ..  ..  |                        #
-                #           |k1(N) .. kM(N)|                        #
-                #                                                   #
+                    # # remove NaN value for next iterations (but normally no NaN?)
+                    index = np.flatnonzero(np.logical_or(np.isnan(aps_tmp),aps_tmp==0))
+                    aps_tmp[index] = 1.0 # 1 is a bad misfit
 
-                rmsd = maxrmsd + 1
+                    # save total aps of the map
+                    aps[k] = aps[k] + aps_tmp
 
-                if inter=='yes' and iteration is True:
-                    Glin=np.zeros((kk,2+Mker))
-                    for l in xrange((2)):
-                        Glin[:,l]=basis[l].g(tabx)
-                    for l in xrange((Mker)):
-                        Glin[:,2+l]=kernels[l].g(k)
+                    # count number of pixels per dates
+                    n_aps[k] = n_aps[k] + 1.0
 
-                    mt,sigmamt = consInvert(Glin,taby,inaps[k],cond=rcond)
+                    # save new aps for each maps
+                    # maps_aps[i,j,k] = aps_tmp
 
-                    # compute rmsd
-                    mdisp[k] = np.dot(Glin,mt)
-                    # sum sur toutes les dates
-                    # rmsd = np.sum(abs((disp[k] - mdisp[k])/inaps[k]))/kk  S
-                    rmsd = np.sqrt(np.sum(pow((disp[k] - mdisp[k]),2))/kk)
-                    # print i,j,rmsd,maxrmsd
+                    # fill maps models
+                    models[i,j,:] = mdisp
 
-                G=np.zeros((kk,M))
-                for l in xrange((Mbasis)):
-                    G[:,l]=basis[l].g(tabx)
-                for l in xrange((Mker)):
-                    G[:,Mbasis+l]=kernels[l].g(k)
-
-                # if only ref + seasonal: ref + cos + sin
-                if rmsd >= maxrmsd or inter!='yes':
-                    mt,sigmamt = consInvert(G,taby,inaps[k],cond=rcond,ineq=ineq)
-
-                # rebuild full vectors
-                if Mker>0:
-                    m[Mbasis:],sigmam[Mbasis:] = mt[-Mker:],sigmamt[-Mker:]
-                    m[:mt.shape[0]-Mker],sigmam[:mt.shape[0]-Mker] = mt[:-Mker],sigmamt[:-Mker]
-                else:
-                    sigmam[:mt.shape[0]] = sigmamt
-                    m[:mt.shape[0]] = mt
-                # print m
-                # print
+                    # Build seasonal and linear models
+                    if inter=='yes':
+                        models_detrends[i,j,k] = models_detrends[i,j,k] + np.dot(G[:,indexinter],m[indexinter])
+
+                    if inter=='yes':
+                        models_trends[i,j,k] = models_trends[i,j,k] + np.dot(G[:,indexinter],m[indexinter])
+                    if vect != None:
+                        models_trends[i,j,k] = models_trends[i,j,k] + np.dot(G[:,indexvect],m[indexvect])
+
+    else:
+        # covariance between dates for this iteration
+        if covf is None:
+            Cd = np.diag(inaps**2)
+            covsource = 'APS of the dates, weights of the IRLS inversion'
+        elif covf=='yes':
+            if ii==0:
+                Cd = np.diag(inaps**2)
+                covsource = 'APS of the dates, first iteration of --cov=yes'
+            else:
+                Cd = estimCov(rescov)
+                covsource = 'estimated from the residuals by --cov=yes'
+                del rescov
+        else:
+            Cd = np.copy(cov)
+            covsource = '--cov file {}'.format(covf)
+        if covf is not None:
+            np.savetxt('cov_{}.txt'.format(ii), Cd, fmt='%.6e')
+
+        # Cholesky factor and design matrices for each pattern of NaN dates
+        chol = {}
+        if len(smooth) > 0:
+            normA[:], normb[:] = 0., 0.
+            inverted = np.zeros((nys,nxs)).astype(bool)
+        cols = np.arange(jbeg,jend,sampling)
+        # process the sampled grid by blocks of lines
+        nlines = 100
+        for i0 in xrange(ibeg,iend,sampling*nlines):
+            lines = np.arange(i0,min(i0+sampling*nlines,iend),sampling)
+            ipix, jpix = np.repeat(lines,len(cols)), np.tile(cols,len(lines))
+            disps = maps_flata[ipix,jpix,:]
+            valid = ~np.isnan(disps)
+            # do not take into account pixels with too many NaN
+            keep = np.flatnonzero(np.sum(valid,axis=1) > N/6)
+            if len(keep) == 0:
+                continue
+            patterns, groups = np.unique(valid[keep],axis=0,return_inverse=True)
+
+            for g in xrange(len(patterns)):
+                pix = keep[groups==g]
+                key = patterns[g].tostring()
+                if key not in chol:
+                    k = np.flatnonzero(patterns[g])
+                    tabx = dates[k]
+                    G=np.zeros((len(k),M))
+                    for l in xrange((Mbasis)):
+                        G[:,l]=basis[l].g(tabx)
+                    for l in xrange((Mker)):
+                        G[:,Mbasis+l]=kernels[l].g(k)
+                    L = cholCov(Cd,k,covsource)
+                    chol[key] = (k,G,L)
+                k,G,L = chol[key]
+                kk = len(k)
+                taby = disps[pix][:,k].T
+
+                m = np.zeros((M,len(pix)))
+                sigmam = np.ones((M,len(pix)))*float('NaN')
+
+                # first try inversion without coseismic and postseismic
+                w = np.ones((kk,len(pix)))
+                full = np.ones((len(pix))).astype(bool)
+                if inter=='yes' and iteration is True:
+                    indexlin = range(2) + range(Mbasis,M)
+                    if robust is None:
+                        mt,sigmamt = covInvert(G[:,indexlin],taby,L,cond=rcond)
+                    else:
+                        mt,sigmamt,w = robustInvert(G[:,indexlin],taby,L,norm=robust,niter=robust_iter,cond=rcond)
+                    rmsd = np.sqrt(np.sum(pow((taby - np.dot(G[:,indexlin],mt)),2),axis=0)/kk)
+                    full = rmsd >= maxrmsd
+                    m[np.ix_(indexlin,~full)],sigmam[np.ix_(indexlin,~full)] = mt[:,~full],sigmamt[:,~full]
+
+                if np.any(full):
+                    if robust is None:
+                        mt,sigmamt = covInvert(G,taby[:,full],L,cond=rcond)
+                    else:
+                        mt,sigmamt,w[:,full] = robustInvert(G,taby[:,full],L,norm=robust,niter=robust_iter,cond=rcond)
+                    m[:,full],sigmam[:,full] = mt,sigmamt
 
                 # save m
                 for l in xrange((Mbasis)):
-                    basis[l].m[i-ibeg,j-jbeg] = m[l]
-                    basis[l].sigmam[i-ibeg,j-jbeg] = sigmam[l]
+                    basis[l].m[ipix[pix]-ibeg,jpix[pix]-jbeg] = m[l]
+                    basis[l].sigmam[ipix[pix]-ibeg,jpix[pix]-jbeg] = sigmam[l]
 
                 for l in xrange((Mker)):
-                    kernels[l].m[i-ibeg,j-jbeg] = m[Mbasis+l]
-                    kernels[l].sigmam[i-ibeg,j-jbeg] = sigmam[Mbasis+l]
+                    kernels[l].m[ipix[pix]-ibeg,jpix[pix]-jbeg] = m[Mbasis+l]
+                    kernels[l].sigmam[ipix[pix]-ibeg,jpix[pix]-jbeg] = sigmam[Mbasis+l]
 
                 # forward model in original order
-                mdisp[k] = np.dot(G,m)
+                mdisp = np.dot(G,m)
 
                 # compute aps for each dates
-                # aps_tmp = pow((disp[k]-mdisp[k])/inaps[k],2)
-                aps_tmp = abs((disp[k]-mdisp[k]))/inaps[k]
-
-                # # remove NaN value for next iterations (but normally no NaN?)
-                index = np.flatnonzero(np.logical_or(np.isnan(aps_tmp),aps_tmp==0))
-                aps_tmp[index] = 1.0 # 1 is a bad misfit
-
-                # save total aps of the map
-                aps[k] = aps[k] + aps_tmp
-
-                # count number of pixels per dates
-                n_aps[k] = n_aps[k] + 1.0
-
-                # save new aps for each maps
-                # maps_aps[i,j,k] = aps_tmp
+                aps_tmp = abs(taby-mdisp)/inaps[k][:,np.newaxis]
+                aps_tmp[np.logical_or(np.isnan(aps_tmp),aps_tmp==0)] = 1.0 # 1 is a bad misfit
+                aps[k] = aps[k] + np.sum(aps_tmp,axis=1)
+                n_aps[k] = n_aps[k] + len(pix)
 
                 # fill maps models
-                models[i,j,:] = mdisp
+                ig, jg = ipix[pix][:,np.newaxis], jpix[pix][:,np.newaxis]
+                models[ipix[pix],jpix[pix],:] = float('NaN')
+                models[ig,jg,k] = mdisp.T
+
+                # save normal equations of the selected functions
+                if len(smooth) > 0:
+                    Aw = lst.solve_triangular(L,G,lower=True)
+                    Bw = lst.solve_triangular(L,taby,lower=True)
+                    Ap = np.einsum('km,kp,kn->pmn',Aw,w,Aw)
+                    bp = np.einsum('km,kp->pm',Aw,w*Bw)
+                    if not np.all(full):
+                        idx = np.flatnonzero(~full)[:,np.newaxis]
+                        exclude = np.array([l for l in xrange(M) if l not in indexlin])
+                        Ap[idx,exclude,:], Ap[idx,:,exclude], bp[idx,exclude] = 0., 0., 0.
+                        Ap[idx,exclude,exclude] = 1.
+                    isub, jsub = (ipix[pix]-ibeg)/sampling, (jpix[pix]-jbeg)/sampling
+                    normA[isub,jsub], normb[isub,jsub] = Ap, bp
+                    inverted[isub,jsub] = True
+
+                if robust is not None:
+                    rejected[k] = rejected[k] + np.sum(w<0.5,axis=1)
+                    if robust_mask=='yes':
+                        weights[ig,jg,k] = w.T
 
                 # Build seasonal and linear models
                 if inter=='yes':
-                    models_detrends[i,j,k] = models_detrends[i,j,k] + np.dot(G[:,indexinter],m[indexinter])
+                    models_detrends[ig,jg,k] = models_detrends[ig,jg,k] + np.outer(m[indexinter],G[:,indexinter])
+                    models_trends[ig,jg,k] = models_trends[ig,jg,k] + np.outer(m[indexinter],G[:,indexinter])
+                if vect != None:
+                    models_trends[ig,jg,k] = models_trends[ig,jg,k] + np.outer(m[indexvect],G[:,indexvect])
 
-                if inter=='yes':
-                    models_trends[i,j,k] = models_trends[i,j,k] + np.dot(G[:,indexinter],m[indexinter])
+        if len(smooth) > 0:
+            print
+            print 'Smoothing of {}...'.format(', '.join(smooth))
+            diag = np.einsum('pqmm->pq',normA)[inverted]/M
+            msmooth = smoothInvert(normA,normb,indexsmooth,smooth_weight*np.median(diag),
+                tile=smooth_tile,halo=max(smooth_tile/10,1))
+            msmooth[~inverted] = float('NaN')
+
+            # save m of the sampled grid
+            for l in xrange((Mbasis)):
+                basis[l].m[::sampling,::sampling][inverted] = msmooth[:,:,l][inverted]
+            for l in xrange((Mker)):
+                kernels[l].m[::sampling,::sampling][inverted] = msmooth[:,:,Mbasis+l][inverted]
+
+            # forward models with the smoothed coefficients
+            G=np.zeros((N,M))
+            for l in xrange((Mbasis)):
+                G[:,l]=basis[l].g(dates)
+            for l in xrange((Mker)):
+                G[:,Mbasis+l]=kernels[l].g(np.arange(N))
+            nodata = np.isnan(maps_flata[ibeg:iend:sampling,jbeg:jend:sampling,:][inverted])
+            mdisp = np.dot(msmooth[inverted],G.T)
+            mdisp[nodata] = float('NaN')
+            models[ibeg:iend:sampling,jbeg:jend:sampling,:][inverted] = mdisp
+            if inter=='yes':
+                mdisp = np.outer(msmooth[inverted][:,indexinter],G[:,indexinter])
+                mdisp[nodata] = 0.
+                models_detrends[ibeg:iend:sampling,jbeg:jend:sampling,:][inverted] = mdisp
                 if vect != None:
-                    models_trends[i,j,k] = models_trends[i,j,k] + np.dot(G[:,indexvect],m[indexvect])
+                    mdisp = mdisp + np.outer(msmooth[inverted][:,indexvect],G[:,indexvect])
+                    mdisp[nodata] = 0.
+                models_trends[ibeg:iend:sampling,jbeg:jend:sampling,:][inverted] = mdisp
+            elif vect != None:
+                mdisp = np.outer(msmooth[inverted][:,indexvect],G[:,indexvect])
+                mdisp[nodata] = 0.
+                models_trends[ibeg:iend:sampling,jbeg:jend:sampling,:][inverted] = mdisp
+            del msmooth, mdisp
+
+        # residuals of the sampled grid for the covariance of the next iteration
+        if covf=='yes' and ii < niter-1:
+            rescov = (maps_flata[ibeg:iend:sampling,jbeg:jend:sampling,:] - models[ibeg:iend:sampling,jbeg:jend:sampling,:]).reshape(-1,N)
+            rescov = rescov[~np.all(models[ibeg:iend:sampling,jbeg:jend:sampling,:]==0,axis=2).flatten()]
+        del chol
 
     # convert aps in rad
     aps = aps/n_aps
@@ -3281,6 +3789,13 @@ for ii in xrange(niter):
     for l in xrange(N):
         print idates[l], aps[l], n_aps[l]
     np.savetxt('aps_{}.txt'.format(ii), aps.T, fmt=('%.6f'))
+
+    if robust is not None:
+        print
+        print 'Dates      # of rejected points'
+        for l in xrange(N):
+            print idates[l], rejected[l]
+        np.savetxt('rejected_{}.txt'.format(ii), np.vstack([idates,rejected]).T, fmt=('%i','%i'))
     # set apsf is yes for iteration
     apsf=='yes'
     # update aps for next iterations
@@ -3288,33 +3803,42 @@ for ii in xrange(niter):
 
 # del maps_aps
 
+# result of the set of a sweep: RMS of the residuals and mean APS
+if sweepcache is not None:
+    res = maps_flata[ibeg:iend:sampling,jbeg:jend:sampling,:] - models[ibeg:iend:sampling,jbeg:jend:sampling,:]
+    res = res[~np.all(models[ibeg:iend:sampling,jbeg:jend:sampling,:]==0,axis=2)]
+    np.savetxt('sweep_result.txt', [[np.sqrt(np.nanmean(res**2)),np.nanmean(aps)]], fmt='%.6f')
+    del res
+
+if len(smooth) > 0:
+    del normA, normb
+    shutil.rmtree(tmpdir)
+
 #######################################################
 # Save new cubes
 #######################################################
 
-# create new cube
-cube_flata = maps_flata[ibeg:iend,jbeg:jend,:].flatten()
-cube_noramps = maps_noramps[ibeg:iend,jbeg:jend,:].flatten()
+# outputs are written block by block in background
+if geotiff is not None:
+    writer = rasterwriter.Writer(gt=gt,proj=proj)
+else:
+    writer = rasterwriter.Writer()
 
-fid = open('depl_cumule_flat', 'wb')
-cube_flata.flatten().astype('float32').tofile(fid)
-fid.close()
+# create new cube
+writer.r4('depl_cumule_flat',maps_flata[ibeg:iend,jbeg:jend,:])
 
 if fulloutput=='yes':
     if (seasonal=='yes' or semianual=='yes') and (vect != None or inter=='yes'):
-        fid = open('depl_cumule_dseas', 'wb')
-        (maps_flata - models_trends).flatten().astype('float32').tofile(fid)
-        fid.close()
+        writer.r4('depl_cumule_dseas',maps_flata,sub=models_trends)
 
     if inter=='yes':
-        fid = open('depl_cumule_dtrend', 'wb')
-        (maps_flata - models_detrends).flatten().astype('float32').tofile(fid)
-        fid.close()
+        writer.r4('depl_cumule_dtrend',maps_flata,sub=models_detrends)
 
     if flat>0:
-        fid = open('depl_cumule_noramps', 'wb')
-        cube_noramps.flatten().astype('float32').tofile(fid)
-        fid.close()
+        writer.r4('depl_cumule_noramps',maps_noramps[ibeg:iend,jbeg:jend,:])
+
+if robust is not None and robust_mask=='yes':
+    writer.r4('depl_cumule_weights',weights[ibeg:iend,jbeg:jend,:])
 
 # # save APS
 # print
@@ -3327,28 +3851,12 @@ if fulloutput=='yes':
     if not os.path.exists(outdir):
         os.makedirs(outdir)
 
-# plot displacements models and residuals
-nfigure +=1
-figres = plt.figure(nfigure,figsize=(14,10))
-figres.subplots_adjust(hspace=.001,wspace=0.001)
-
-nfigure +=1
-fig = plt.figure(nfigure,figsize=(14,10))
-fig.subplots_adjust(hspace=.001,wspace=0.01)
-
-nfigure +=1
-figall = plt.figure(nfigure,figsize=(20,9))
-figall.subplots_adjust(hspace=0.00001,wspace=0.001)
-
-nfigure +=1
-figclr = plt.figure(nfigure)
+# plot displacements models and residuals: collect decimated panels
+# rows of the time series figure: DATA, RAMP, TROPO, FLATTEN DATA, MODEL, RES
+panels_all = [[] for r in xrange(6)]
 
 # plot color map
-ax = figclr.add_subplot(1,1,1)
-cax = ax.imshow(maps[:,:,-1],cmap=cmap,vmax=vmax,vmin=vmin)
-setp( ax.get_xticklabels(), visible=False)
-cbar = figclr.colorbar(cax, orientation='horizontal',aspect=5)
-figclr.savefig('colorscale.eps', format='EPS',dpi=150)
+renderer.mosaic('colorscale',[maps[:,:,-1]],vmin=vmin,vmax=vmax,nrows=1,ncols=1,figsize=(6,6))
 
 # vmax = np.abs([np.nanmedian(data) + 2*nanstd(data),np.nanmedian(data) - 2*nanstd(data)]).max()
 # vmin = -vmax
@@ -3366,61 +3874,9 @@ for l in xrange((N)):
     ramp = as_strided(maps_ramp[ibeg:iend,jbeg:jend,l])
     tropo = as_strided(maps_topo[ibeg:iend,jbeg:jend,l])
 
-    ax = fig.add_subplot(4,int(N/4)+1,l+1)
-    axres = figres.add_subplot(4,int(N/4)+1,l+1)
-
-    axall = figall.add_subplot(6,N,l+1)
-    axall.imshow(data,cmap=cmap,vmax=vmax,vmin=vmin)
-    axall.set_title(idates[l],fontsize=6)
-    setp(axall.get_xticklabels(), visible=False)
-    setp(axall.get_yticklabels(), visible=False)
-    if l==0:
-        axall.set_ylabel('DATA')
-    axall = figall.add_subplot(6,N,l+1+N)
-    axall.imshow(ramp,cmap=cmap,vmax=vmax,vmin=vmin)
-    setp(axall.get_xticklabels(), visible=False)
-    setp(axall.get_yticklabels(), visible=False)
-    if l==0:
-        axall.set_ylabel('RAMP')
-    axall = figall.add_subplot(6,N,l+1+2*N)
-    axall.imshow(tropo,cmap=cmap,vmax=vmax,vmin=vmin)
-    setp(axall.get_xticklabels(), visible=False)
-    setp(axall.get_yticklabels(), visible=False)
-    if l==0:
-        axall.set_ylabel('TROP0')
-    axall = figall.add_subplot(6,N,l+1+3*N)
-    axall.imshow(data_flat,cmap=cmap,vmax=vmax,vmin=vmin)
-    setp(axall.get_xticklabels(), visible=False)
-    setp(axall.get_yticklabels(), visible=False)
-    if l==0:
-        axall.set_ylabel('FLATTEN DATA')
-    axall = figall.add_subplot(6,N,l+1+4*N)
-    axall.imshow(model,cmap=cmap,vmax=vmax,vmin=vmin)
-    setp(axall.get_xticklabels(), visible=False)
-    setp(axall.get_yticklabels(), visible=False)
-    if l==0:
-        axall.set_ylabel('MODEL')
-    axall = figall.add_subplot(6,N,l+1+5*N)
-    axall.imshow(res,cmap=cmap,vmax=vmax,vmin=vmin)
-    setp(axall.get_xticklabels(), visible=False)
-    setp(axall.get_yticklabels(), visible=False)
-    if l==0:
-        axall.set_ylabel('RES')
-
-    cax = ax.imshow(model,cmap=cmap,vmax=vmax,vmin=vmin)
-    caxres = axres.imshow(res,cmap=cmap,vmax=vmax,vmin=vmin)
-
-    ax.set_title(idates[l],fontsize=6)
-    axres.set_title(idates[l],fontsize=6)
-
-    setp(ax.get_xticklabels(), visible=False)
-    setp(ax.get_yticklabels(), visible=False)
-
-    setp(axres.get_xticklabels(), visible=False)
-    setp(axres.get_yticklabels(), visible=False)
-
-    fig.tight_layout()
-
+    if plot!='no':
+        for r,panel in enumerate([data,ramp,tropo,data_flat,model,res]):
+            panels_all[r].append(quicklook.decimate(panel,renderer.maxpix))
 
     # ############
     # # SAVE .R4 #
@@ -3430,64 +3886,26 @@ for l in xrange((N)):
     if fulloutput=='yes':
 
         if geotiff is not None:
-
-            ds = driver.Create(outdir+'{}_flat.tif'.format(idates[l]), jend-jbeg, iend-ibeg, 1, gdal.GDT_Float32)
-            band = ds.GetRasterBand(1)
-            band.WriteArray(data_flat)
-            ds.SetGeoTransform(gt)
-            ds.SetProjection(proj)
-            band.FlushCache()
-
-            ds = driver.Create(outdir+'{}_ramp_tropo.tif'.format(idates[l]), jend-jbeg, iend-ibeg, 1, gdal.GDT_Float32)
-            band = ds.GetRasterBand(1)
-            band.WriteArray(ramp+tropo)
-            ds.SetGeoTransform(gt)
-            ds.SetProjection(proj)
-            band.FlushCache()
-
-            ds = driver.Create(outdir+'{}_model.tif'.format(idates[l]), jend-jbeg, iend-ibeg, 1, gdal.GDT_Float32)
-            band = ds.GetRasterBand(1)
-            band.WriteArray(model)
-            ds.SetGeoTransform(gt)
-            ds.SetProjection(proj)
-            band.FlushCache()
-
-            # ds = driver.Create(outdir+'{}_res.tif'.format(idates[l]), jend-jbeg, iend-ibeg, 1, gdal.GDT_Float32)
-            # band = ds.GetRasterBand(1)
-            # band.WriteArray(res)
-            # ds.SetGeoTransform(gt)
-            # ds.SetProjection(proj)
-            # band.FlushCache()
+            writer.tif(outdir+'{}_flat.tif'.format(idates[l]),data_flat)
+            writer.tif(outdir+'{}_ramp_tropo.tif'.format(idates[l]),ramp+tropo)
+            writer.tif(outdir+'{}_model.tif'.format(idates[l]),model)
+            # writer.tif(outdir+'{}_res.tif'.format(idates[l]),res)
 
         else:
-
-            fid = open(outdir+'{}_flat.r4'.format(idates[l]), 'wb')
-            data_flat.flatten().astype('float32').tofile(fid)
-            fid.close()
-
+            writer.r4(outdir+'{}_flat.r4'.format(idates[l]),data_flat)
             # save ramp maps
-            fid = open(outdir+'{}_ramp_tropo.r4'.format(idates[l]), 'wb')
-            (ramp+tropo).flatten().astype('float32').tofile(fid)
-            fid.close()
-
+            writer.r4(outdir+'{}_ramp_tropo.r4'.format(idates[l]),ramp+tropo)
             # save model maps
-            fid = open(outdir+'{}_model.r4'.format(idates[l]), 'wb')
-            model.flatten().astype('float32').tofile(fid)
-            fid.close()
-
+            writer.r4(outdir+'{}_model.r4'.format(idates[l]),model)
             # save residual maps
-            fid = open(outdir+'{}_res.r4'.format(idates[l]), 'wb')
-            res.flatten().astype('float32').tofile(fid)
-            # fid.close()
+            writer.r4(outdir+'{}_res.r4'.format(idates[l]),res)
 
 
-fig.suptitle('Time series models')
-figres.suptitle('Time series residuals')
-figall.suptitle('Time series inversion')
-fig.savefig('models.eps', format='EPS',dpi=150)
-figres.savefig('residuals.eps', format='EPS',dpi=150)
-figall.savefig('timeseries.eps', format='EPS',dpi=150)
-#plt.show()
+renderer.mosaic('models',panels_all[4],titles=idates,vmin=vmin,vmax=vmax,ncols=int(N/4)+1,suptitle='Time series models')
+renderer.mosaic('residuals',panels_all[5],titles=idates,vmin=vmin,vmax=vmax,ncols=int(N/4)+1,suptitle='Time series residuals')
+renderer.mosaic('timeseries',[panel for row in panels_all for panel in row],titles=list(idates)+[None]*(5*N),vmin=vmin,vmax=vmax,nrows=6,ncols=N,
+    figsize=(20,9),colorbar=None,rowlabels=['DATA','RAMP','TROP0','FLATTEN DATA','MODEL','RES'],suptitle='Time series inversion')
+del panels_all
 
 
 #######################################################
@@ -3495,58 +3913,126 @@ figall.savefig('timeseries.eps', format='EPS',dpi=150)
 #######################################################
 
 
-if geotiff is not None:
-    for l in xrange((Mbasis)):
-        ds = driver.Create('{}_coeff.tif'.format(basis[l].reduction), jend-jbeg, iend-ibeg, 1, gdal.GDT_Float32)
-        band = ds.GetRasterBand(1)
-        band.WriteArray(basis[l].m)
-        ds.SetGeoTransform(gt)
-        ds.SetProjection(proj)
-        band.FlushCache()
-        del ds
-
-        ds = driver.Create('{}_sigcoeff.tif'.format(basis[l].reduction), jend-jbeg, iend-ibeg, 1, gdal.GDT_Float32)
-        band = ds.GetRasterBand(1)
-        band.WriteArray(basis[l].sigmam)
-        ds.SetGeoTransform(gt)
-        ds.SetProjection(proj)
-        band.FlushCache()
-        del ds
-
-    for l in xrange((Mker)):
-        ds = driver.Create('{}_coeff.tif'.format(kernels[l].reduction), jend-jbeg, iend-ibeg, 1, gdal.GDT_Float32)
-        band = ds.GetRasterBand(1)
-        band.WriteArray(kernels[l].m)
-        ds.SetGeoTransform(gt)
-        ds.SetProjection(proj)
-        band.FlushCache()
-        del ds
-
-        ds = driver.Create('{}_sigcoeff.tif'.format(kernels[l].reduction), jend-jbeg, iend-ibeg, 1, gdal.GDT_Float32)
-        band = ds.GetRasterBand(1)
-        band.WriteArray(kernels[l].sigmam)
-        ds.SetGeoTransform(gt)
-        ds.SetProjection(proj)
-        band.FlushCache()
-        del ds
+functions = basis + kernels
+for l in xrange((M)):
+    if geotiff is not None:
+        writer.tif('{}_coeff.tif'.format(functions[l].reduction),functions[l].m)
+        writer.tif('{}_sigcoeff.tif'.format(functions[l].reduction),functions[l].sigmam)
+    else:
+        writer.r4('{}_coeff.r4'.format(functions[l].reduction),functions[l].m)
+        writer.r4('{}_sigcoeff.r4'.format(functions[l].reduction),functions[l].sigmam)
 
-else:
-    for l in xrange((Mbasis)):
-        fid = open('{}_coeff.r4'.format(basis[l].reduction), 'wb')
-        basis[l].m.flatten().astype('float32').tofile(fid)
-        fid.close()
-        fid = open('{}_sigcoeff.r4'.format(basis[l].reduction), 'wb')
-        basis[l].sigmam.flatten().astype('float32').tofile(fid)
-        fid.close()
-    for l in xrange((Mker)):
-        fid = open('{}_coeff.r4'.format(kernels[l].reduction), 'wb')
-        kernels[l].m.flatten().astype('float32').tofile(fid)
-        fid.close()
-        fid = open('{}_sigcoeff.r4'.format(kernels[l].reduction), 'wb')
-        kernels[l].sigmam.flatten().astype('float32').tofile(fid)
-        fid.close()
+if geotiff is not None and coeffstack=='yes':
+    writer.stack('coeff_stack.tif',[functions[l].m for l in xrange(M)],
+        descriptions=[functions[l].reduction for l in xrange(M)])
+    writer.stack('sigcoeff_stack.tif',[functions[l].sigmam for l in xrange(M)],
+        descriptions=[functions[l].reduction for l in xrange(M)])
 
 
+#######################################################
+# Detection of steps
+#######################################################
+
+if len(detect) > 0:
+    print
+    print 'Detection of steps among {} candidate times...'.format(len(detect))
+    print
+
+    # library of candidate functions
+    candidates = [coseismic(name='step {}'.format(t),reduction='step',date=t) for t in detect]
+    if detect_tcar is not None:
+        candidates = candidates + [postseismic(name='log {}'.format(t),reduction='log',date=t,tcar=detect_tcar) for t in detect]
+    Nc = len(candidates)
+    epochs = np.array([candidates[l].to for l in xrange(Nc)])
+    types = np.array([candidates[l].reduction=='log' for l in xrange(Nc)]).astype(int)
+
+    # time, amplitude and type (0: step, 1: log) of the detected functions, ordered in time
+    detect_time = np.ones((detect_max,iend-ibeg,jend-jbeg))*float('NaN')
+    detect_amp = np.ones((detect_max,iend-ibeg,jend-jbeg))*float('NaN')
+    detect_type = np.ones((detect_max,iend-ibeg,jend-jbeg))*float('NaN')
+    histo = np.zeros((Nc))
+
+    cols = np.arange(jbeg,jend,sampling)
+    nlines = 100
+    for i0 in xrange(ibeg,iend,sampling*nlines):
+        lines = np.arange(i0,min(i0+sampling*nlines,iend),sampling)
+        ipix, jpix = np.repeat(lines,len(cols)), np.tile(cols,len(lines))
+        disps = maps_flata[ipix,jpix,:]
+        valid = ~np.isnan(disps)
+        keep = np.flatnonzero(np.sum(valid,axis=1) > N/6)
+        if len(keep) == 0:
+            continue
+        patterns, groups = np.unique(valid[keep],axis=0,return_inverse=True)
+
+        for g in xrange(len(patterns)):
+            pix = keep[groups==g]
+            k = np.flatnonzero(patterns[g])
+            tabx = dates[k]
+            taby = disps[pix][:,k].T
+            G=np.zeros((len(k),M))
+            for l in xrange((Mbasis)):
+                G[:,l]=basis[l].g(tabx)
+            for l in xrange((Mker)):
+                G[:,Mbasis+l]=kernels[l].g(k)
+            H=np.zeros((len(k),Nc))
+            for l in xrange((Nc)):
+                H[:,l]=candidates[l].g(tabx)
+            # weights of the last iteration
+            if covf is not None:
+                L = cholCov(Cd,k,covsource)
+            else:
+                L = np.diag(inaps[k])
+
+            sel = detectInvert(G,H,taby,L,nmax=detect_max,threshold=detect_threshold)
+            histo = histo + np.bincount(sel[sel>=0],minlength=Nc)
+
+            # joint inversion of the decomposition and the selected functions
+            keys, subgroups = np.unique(sel.T,axis=0,return_inverse=True)
+            for sg in xrange(len(keys)):
+                index = keys[sg][keys[sg]>=0]
+                if len(index) == 0:
+                    continue
+                subpix = pix[subgroups==sg]
+                mt = covInvert(np.hstack([G,H[:,index]]),taby[:,subgroups==sg],L,cond=rcond)[0]
+                isub, jsub = ipix[subpix]-ibeg, jpix[subpix]-jbeg
+                for r,l in enumerate(np.argsort(epochs[index])):
+                    detect_time[r,isub,jsub] = epochs[index[l]]
+                    detect_amp[r,isub,jsub] = mt[M+l]
+                    detect_type[r,isub,jsub] = types[index[l]]
+
+    print 'Time      # of steps     # of log'
+    histo = histo.reshape(-1,len(detect))
+    if detect_tcar is None:
+        histo = np.vstack([histo,np.zeros((len(detect)))])
+    for l in xrange(len(detect)):
+        print detect[l], int(histo[0,l]), int(histo[1,l])
+    np.savetxt('detect_histo.txt', np.vstack([detect,histo]).T, header='time #steps #log', fmt=('%.6f','%i','%i'))
+
+    for r in xrange(detect_max):
+        if geotiff is not None:
+            writer.tif('detect{}_time.tif'.format(r),detect_time[r])
+            writer.tif('detect{}_amp.tif'.format(r),detect_amp[r])
+            writer.tif('detect{}_type.tif'.format(r),detect_type[r])
+        else:
+            writer.r4('detect{}_time.r4'.format(r),detect_time[r])
+            writer.r4('detect{}_amp.r4'.format(r),detect_amp[r])
+            writer.r4('detect{}_type.r4'.format(r),detect_type[r])
+
+    # plot detected times and amplitudes
+    vmax = np.nanpercentile(np.abs(detect_amp),98.)
+    renderer.mosaic('detect',list(detect_time)+list(detect_amp),
+        titles=['time {}'.format(r) for r in xrange(detect_max)]+['amplitude {}'.format(r) for r in xrange(detect_max)],
+        vmin=[min(detect)]*detect_max+[-vmax]*detect_max,vmax=[max(detect)]*detect_max+[vmax]*detect_max,
+        nrows=2,ncols=detect_max,colorbar='each',suptitle='Detected functions')
+    ax = renderer.axes()
+    ax.plot(detect,histo[0],'-o',label='steps')
+    if detect_tcar is not None:
+        ax.plot(detect,histo[1],'-o',label='log')
+    ax.set_xlabel('Time (yr)')
+    ax.set_ylabel('# of pixels')
+    renderer.scatter('detect_histo',[ax],nrows=1,ncols=1,figsize=(8,4))
+    del candidates
+
 #######################################################
 # Compute Amplitude and phase seasonal
 #######################################################
@@ -3563,56 +4049,15 @@ if seasonal == 'yes':
     sigphi = (sigcosine*abs(sine)+sigsine*abs(cosine))/(sigcosine**2+sigsine**2)
 
     if geotiff is not None:
-        ds = driver.Create('ampwt_coeff.tif', jend-jbeg, iend-ibeg, 1, gdal.GDT_Float32)
-        band = ds.GetRasterBand(1)
-        band.WriteArray(amp)
-        ds.SetGeoTransform(gt)
-        ds.SetProjection(proj)
-        band.FlushCache()
-        del ds
-
-        ds = driver.Create('ampwt_sigcoeff.tif', jend-jbeg, iend-ibeg, 1, gdal.GDT_Float32)
-        band = ds.GetRasterBand(1)
-        band.WriteArray(sigamp)
-        ds.SetGeoTransform(gt)
-        ds.SetProjection(proj)
-        band.FlushCache()
-        del ds
-
+        writer.tif('ampwt_coeff.tif',amp)
+        writer.tif('ampwt_sigcoeff.tif',sigamp)
+        writer.tif('phiwt_coeff.tif',phi)
+        writer.tif('phiwt_sigcoeff.tif',sigphi)
     else:
-        fid = open('ampwt_coeff.r4', 'wb')
-        amp.flatten().astype('float32').tofile(fid)
-        fid.close()
-
-        fid = open('ampwt_sigcoeff.r4', 'wb')
-        sigamp.flatten().astype('float32').tofile(fid)
-        fid.close()
-
-    if geotiff is not None:
-        ds = driver.Create('phiwt_coeff.tif', jend-jbeg, iend-ibeg, 1, gdal.GDT_Float32)
-        band = ds.GetRasterBand(1)
-        band.WriteArray(phi)
-        ds.SetGeoTransform(gt)
-        ds.SetProjection(proj)
-        band.FlushCache()
-        del ds
-
-        ds = driver.Create('phiwt_sigcoeff.tif', jend-jbeg, iend-ibeg, 1, gdal.GDT_Float32)
-        band = ds.GetRasterBand(1)
-        band.WriteArray(sigphi)
-        ds.SetGeoTransform(gt)
-        ds.SetProjection(proj)
-        band.FlushCache()
-        del ds
-
-    else:
-        fid = open('phiwt_coeff.r4', 'wb')
-        phi.flatten().astype('float32').tofile(fid)
-        fid.close()
-
-        fid = open('phiwt_sigcoeff.r4', 'wb')
-        sigphi.flatten().astype('float32').tofile(fid)
-        fid.close()
+        writer.r4('ampwt_coeff.r4',amp)
+        writer.r4('ampwt_sigcoeff.r4',sigamp)
+        writer.r4('phiwt_coeff.r4',phi)
+        writer.r4('phiwt_sigcoeff.r4',sigphi)
 
 if semianual == 'yes':
     cosine = as_strided(basis[indexsemi].m)
@@ -3626,113 +4071,36 @@ if semianual == 'yes':
     sigphi = (sigcosine*abs(sine)+sigsine*abs(cosine))/(sigcosine**2+sigsine**2)
 
     if geotiff is not None:
-        ds = driver.Create('ampw2t_coeff.tif', jend-jbeg, iend-ibeg, 1, gdal.GDT_Float32)
-        band = ds.GetRasterBand(1)
-        band.WriteArray(amp)
-        ds.SetGeoTransform(gt)
-        ds.SetProjection(proj)
-        band.FlushCache()
-        del ds
-
-        ds = driver.Create('ampw2t_sigcoeff.tif', jend-jbeg, iend-ibeg, 1, gdal.GDT_Float32)
-        band = ds.GetRasterBand(1)
-        band.WriteArray(sigamp)
-        ds.SetGeoTransform(gt)
-        ds.SetProjection(proj)
-        band.FlushCache()
-        del ds
-
+        writer.tif('ampw2t_coeff.tif',amp)
+        writer.tif('ampw2t_sigcoeff.tif',sigamp)
+        writer.tif('phiw2t_coeff.tif',phi)
+        writer.tif('phiw2t_sigcoeff.tif',sigphi)
     else:
-        fid = open('ampw2t_coeff.r4', 'wb')
-        amp.flatten().astype('float32').tofile(fid)
-        fid.close()
-
-        fid = open('ampw2t_sigcoeff.r4', 'wb')
-        sigamp.flatten().astype('float32').tofile(fid)
-        fid.close()
-
-    if geotiff is not None:
-        ds = driver.Create('phiw2t_coeff.tif', jend-jbeg, iend-ibeg, 1, gdal.GDT_Float32)
-        band.WriteArray(phi)
-        ds.SetGeoTransform(gt)
-        ds.SetProjection(proj)
-        band.FlushCache()
-        del ds
-
-        ds = driver.Create('phiw2t_sigcoeff.tif', jend-jbeg, iend-ibeg, 1, gdal.GDT_Float32)
-        band.WriteArray(sigphi)
-        ds.SetGeoTransform(gt)
-        ds.SetProjection(proj)
-        band.FlushCache()
-        del ds
-
-    else:
-        fid = open('phiw2t_coeff.r4', 'wb')
-        phi.flatten().astype('float32').tofile(fid)
-        fid.close()
-
-        fid = open('phiw2t_sigcoeff.r4', 'wb')
-        sigphi.flatten().astype('float32').tofile(fid)
-        fid.close()
+        writer.r4('ampw2t_coeff.r4',amp)
+        writer.r4('ampw2t_sigcoeff.r4',sigamp)
+        writer.r4('phiw2t_coeff.r4',phi)
+        writer.r4('phiw2t_sigcoeff.r4',sigphi)
 
 
 #######################################################
 # Plot
 #######################################################
 
-# plot ref term
-vmax = np.abs([np.nanpercentile(basis[0].m,98.),np.nanpercentile(basis[0].m,2.)]).max()
-vmin = -vmax
-
-nfigure +=1
-fig=plt.figure(nfigure,figsize=(14,12))
-
-ax = fig.add_subplot(1,M,1)
-cax = ax.imshow(basis[0].m,cmap=cmap,vmax=vmax,vmin=vmin)
-cbar = fig.colorbar(cax, orientation='vertical',shrink=0.2)
-setp(ax.get_xticklabels(), visible=False)
-setp(ax.get_yticklabels(), visible=False)
-
-# plot linear term
-vmax = np.abs([np.nanpercentile(basis[1].m,98.),np.nanpercentile(basis[1].m,2.)]).max()
-vmin = -vmax
-
-ax = fig.add_subplot(1,M,2)
-cax = ax.imshow(basis[1].m,cmap=cmap,vmax=vmax,vmin=vmin)
-ax.set_title(basis[1].reduction)
-cbar = fig.colorbar(cax, orientation='vertical',shrink=0.2)
-setp(ax.get_xticklabels(), visible=False)
-setp(ax.get_yticklabels(), visible=False)
-
-# plot others
-for l in range(2,Mbasis):
-    vmax = np.abs([np.nanpercentile(basis[l].m,98.),np.nanpercentile(basis[l].m,2.)]).max()
-    vmin = -vmax
-
-    ax = fig.add_subplot(1,M,l+1)
-    cax = ax.imshow(basis[l].m,cmap=cmap,vmax=vmax,vmin=vmin)
-    ax.set_title(basis[l].reduction)
-    # add colorbar
-    cbar = fig.colorbar(cax, orientation='vertical',shrink=0.2)
-    setp(ax.get_xticklabels(), visible=False)
-    setp(ax.get_yticklabels(), visible=False)
-
-for l in xrange(Mker):
-    vmax = np.abs([np.nanpercentile(kernels[l].m,98.),np.nanpercentile(kernels[l].m,2.)]).max()
-    vmin = -vmax
-
-    ax = fig.add_subplot(1,M,Mbasis+l+1)
-    cax = ax.imshow(kernels[l].m,cmap=cmap,vmax=vmax,vmin=vmin)
-    ax.set_title(kernels[l].reduction)
-    setp(ax.get_xticklabels(), visible=False)
-    setp(ax.get_yticklabels(), visible=False)
-    cbar = fig.colorbar(cax, orientation='vertical',shrink=0.2)
-
-plt.suptitle('Time series decomposition')
-
-nfigure += 1
-fig.tight_layout()
-fig.savefig('inversion.eps', format='EPS',dpi=150)
+# plot ref, linear and other terms, each with its own colorscale
+panels, titles, vmins, vmaxs = [], [], [], []
+for l in xrange(M):
+    m, reduction = functions[l].m, functions[l].reduction
+    vmax = np.abs([np.nanpercentile(m,98.),np.nanpercentile(m,2.)]).max()
+    panels.append(m); titles.append(reduction if l>0 else None)
+    vmins.append(-vmax); vmaxs.append(vmax)
+
+renderer.mosaic('inversion',panels,titles=titles,vmin=vmins,vmax=vmaxs,nrows=1,ncols=M,
+    figsize=(14,12),colorbar='each',suptitle='Time series decomposition')
+del panels
+
+# wait for all figures and outputs to be written
+renderer.close()
+writer.close()
 
 if plot=='yes':
     plt.show()
@@ -0,0 +1,483 @@
+#!/usr/bin/env python2
+# -*- coding: utf-8 -*-
+############################################
+#
+# PyGdalSAR: An InSAR post-processing package
+# written in Python-Gdal
+#
+############################################
+# Author        : Simon DAOUT (Oxford)
+############################################
+
+"""\
+invers_disp2coef_joint.py
+-------------
+Joint temporal decomposition of several time series (e.g. ascending and descending tracks) resampled on a common grid
+into East, Up (and optionally North) components. For each pixel, all dates of all tracks are inverted in one system:
+los_t(k) = ref_t + sum_f (e_t*E_f + n_t*N_f + u_t*U_f)*f(k), where (e_t,n_t,u_t) is the LOS unit vector of track t
+and f the temporal basis functions (linear, seasonal, heaviside...). The cubes are streamed by blocks of lines, so that
+memory does not depend on the size of the cubes.
+
+Usage: invers_disp2coef_joint.py --cubes=<paths> --list_images=<paths> --east=<paths> --up=<paths> [--north=<paths>] \
+[--lectfile=<path>] [--imref=<values>] [--interseismic=<yes/no>] [--seasonal=<yes/no>] [--semianual=<yes/no>] \
+[--coseismic=<values>] [--postseismic=<values>] [--crop=<values>] [--tile=<value>] [--cond=<value>] [--geotiff=<path>] [--plot=<yes/no>]
+
+invers_disp2coef_joint.py -h | --help
+
+Options:
+-h --help               Show this screen
+--cubes PATHS           Paths to the displacement cubes (BIP format) of each track separated by commas (e.g. depl_cumule_asc,depl_cumule_desc)
+--list_images PATHS     Paths to the list images files of each track (same format than for invers_disp2coef.py) separated by commas
+--east PATHS            Paths to the East component of the LOS unit vector of each track in r4 or tif format separated by commas
+--up PATHS              Paths to the Up component of the LOS unit vector of each track in r4 or tif format separated by commas
+--north PATHS           Paths to the North component of the LOS unit vector of each track. If not None, also solve for North [default: None]
+--lectfile PATH         Path to the lect.in file of the common grid [default: lect.in]
+--imref VALUES          Reference image number of each track separated by commas [default: 1]
+--interseismic YES/NO   Add a linear function in the inversion [default: yes]
+--seasonal YES/NO       If yes, add seasonal terms in the inversion
+--semianual YES/NO      If yes, add semianual terms in the inversion
+--coseismic VALUES      Add heaviside functions to the inversion, indicate coseismic time (e.g 2004.,2006.)
+--postseismic VALUES    Add logarithmic transients to each coseismic step, indicate characteristic time of the log function (e.g 1.,None)
+--crop VALUES           Define a region of interest for the decomposition [default: 0,nlign,0,ncol]
+--tile VALUE            Number of lines read at once in the cubes [default: 100]
+--cond VALUE            Singular value smaller than cond*largest_singular_value are considered zero [default: 1.0e-10]
+--geotiff PATH          Path to Geotiff to also save outputs in tif format [default: None]
+--plot YES/NO           Display and save the decimated plot of the coefficients [default: yes]
+"""
+
+print
+print '# # # # # # # # # # # # # # # # # # # # # # # # # # # # # # # # # # #'
+print '#'                                                                 '#'
+print '#         Joint inversion of InSAR time series displacements        #'
+print '#         into East and Up components                               #'
+print '#'                                                                 '#'
+print '# # # # # # # # # # # # # # # # # # # # # # # # # # # # # # # # # # #'
+print
+
+# numpy
+import numpy as np
+
+# basic
+import math,sys
+from os import path, environ
+import os
+
+# gdal
+import gdal
+
+# plot
+import matplotlib
+if environ["TERM"].startswith("screen"):
+    matplotlib.use('Agg')
+import matplotlib.pyplot as plt
+import matplotlib.cm as cm
+
+# docopt (command line parser)
+import docopt
+
+# decimated quick-looks
+import quicklook
+
+np.warnings.filterwarnings('ignore')
+
+################################
+# Create lib of wavelet functions
+################################
+
+class pattern:
+    def __init__(self,name,reduction,date):
+        self.name=name
+        self.reduction=reduction
+        self.date=date
+
+    def info(self):
+        print self.name, self.date
+
+def Heaviside(t):
+        h=np.zeros((len(t)))
+        h[t>=0]=1.0
+        return h
+
+class coseismic(pattern):
+      def __init__(self,name,reduction,date):
+          pattern.__init__(self,name,reduction,date)
+          self.to=date
+
+      def g(self,t):
+        return Heaviside(t-self.to)
+
+class postseismic(pattern):
+      def __init__(self,name,reduction,date,tcar=1):
+          pattern.__init__(self,name,reduction,date)
+          self.to=date
+          self.tcar=tcar
+
+      def g(self,t):
+        t=(t-self.to)/self.tcar
+        t[t<=0] = 0
+        g = np.log10(1+t)
+        return g
+
+class interseismic(pattern):
+    def __init__(self,name,reduction,date):
+        pattern.__init__(self,name,reduction,date)
+        self.to=date
+
+    def g(self,t):
+        func=(t-self.to)
+        return func
+
+class sinvar(pattern):
+    def __init__(self,name,reduction,date):
+        pattern.__init__(self,name,reduction,date)
+        self.to=date
+
+    def g(self,t):
+        return np.sin(2*math.pi*(t-self.to))
+
+class cosvar(pattern):
+    def __init__(self,name,reduction,date):
+        pattern.__init__(self,name,reduction,date)
+        self.to=date
+
+    def g(self,t):
+        return np.cos(2*math.pi*(t-self.to))
+
+class sin2var(pattern):
+     def __init__(self,name,reduction,date):
+         pattern.__init__(self,name,reduction,date)
+         self.to=date
+
+     def g(self,t):
+         return np.sin(4*math.pi*(t-self.to))
+
+class cos2var(pattern):
+     def __init__(self,name,reduction,date):
+         pattern.__init__(self,name,reduction,date)
+         self.to=date
+
+     def g(self,t):
+         return np.cos(4*math.pi*(t-self.to))
+
+################################
+# Initialization
+################################
+
+# read arguments
+arguments = docopt.docopt(__doc__)
+
+cubes = arguments["--cubes"].replace(',',' ').split()
+listims = arguments["--list_images"].replace(',',' ').split()
+eastf = arguments["--east"].replace(',',' ').split()
+upf = arguments["--up"].replace(',',' ').split()
+if arguments["--north"] ==  None:
+    northf = None
+else:
+    northf = arguments["--north"].replace(',',' ').split()
+ntrack = len(cubes)
+if len(listims) != ntrack or len(eastf) != ntrack or len(upf) != ntrack or (northf is not None and len(northf) != ntrack):
+    raise Exception("cubes, list_images and LOS files lists are not the same size")
+
+if arguments["--lectfile"] ==  None:
+    infile = "lect.in"
+else:
+    infile = arguments["--lectfile"]
+if arguments["--imref"] ==  None:
+    imref = [0]*ntrack
+else:
+    imref = [int(i) - 1 for i in arguments["--imref"].replace(',',' ').split()]
+    if len(imref) == 1:
+        imref = imref*ntrack
+if arguments["--interseismic"] ==  None:
+    inter = 'yes'
+else:
+    inter = arguments["--interseismic"]
+if arguments["--seasonal"] ==  None:
+    seasonal = 'no'
+else:
+    seasonal = arguments["--seasonal"]
+if arguments["--semianual"] ==  None:
+    semianual = 'no'
+else:
+    semianual = arguments["--semianual"]
+if arguments["--coseismic"] ==  None:
+    cos = []
+else:
+    cos = map(float,arguments["--coseismic"].replace(',',' ').split())
+if arguments["--postseismic"] ==  None:
+    pos = []
+else:
+    pos = map(float,arguments["--postseismic"].replace('None','-1').replace(',',' ').split())
+if len(pos)>0 and len(cos) != len(pos):
+    raise Exception("coseimic and postseismic lists are not the same size")
+if arguments["--tile"] ==  None:
+    tile = 100
+else:
+    tile = int(arguments["--tile"])
+if arguments["--cond"] ==  None:
+    rcond = 1.0e-10
+else:
+    rcond = float(arguments["--cond"])
+if arguments["--plot"] ==  None:
+    plot = 'yes'
+else:
+    plot = arguments["--plot"]
+
+# read lect.in
+ncol, nlign = map(int, open(infile).readline().split(None, 2)[0:2])
+
+if arguments["--crop"] ==  None:
+    crop = [0,nlign,0,ncol]
+else:
+    crop = map(float,arguments["--crop"].replace(',',' ').split())
+ibeg,iend,jbeg,jend = int(crop[0]),int(crop[1]),int(crop[2]),int(crop[3])
+
+if arguments["--geotiff"] ==  None:
+    geotiff = None
+else:
+    geotiff = arguments["--geotiff"]
+    georef = gdal.Open(geotiff)
+    gt = georef.GetGeoTransform()
+    proj = georef.GetProjection()
+    driver = gdal.GetDriverByName('GTiff')
+
+#######################################################
+
+# load images_retenues files and open cubes
+idates, dates, maps = [], [], []
+for t in xrange(ntrack):
+    nb,idate,date,base=np.loadtxt(listims[t], comments='#', usecols=(0,1,3,5), unpack=True,dtype='i,i,f,f')
+    idates.append(idate); dates.append(date)
+    print 'Track {}: {}, number images: {}'.format(t,cubes[t],len(date))
+    # memory map the cube: nothing is read before the tile loop
+    maps.append(np.memmap(cubes[t],dtype=np.float32,mode='r',shape=(nlign,ncol,len(date))))
+Nt = np.array([len(d) for d in dates])
+datemin = np.int(np.nanmin(np.concatenate(dates)))
+
+def read_tile(infile,i0,i1):
+    ''' Read lines i0 to i1 of a r4 or tif file of size nlign x ncol (LOS component).
+    Values above 9990 are no-data, 0 is a valid component '''
+    extension = os.path.splitext(infile)[1]
+    if extension == ".tif":
+      ds = gdal.Open(infile, gdal.GA_ReadOnly)
+      band = ds.GetRasterBand(1)
+      data = band.ReadAsArray(0,i0,ncol,i1-i0)
+      del ds
+    else:
+      data = np.memmap(infile,dtype=np.float32,mode='r',shape=(nlign,ncol))[i0:i1,:]
+    data = np.array(data,dtype=np.float64)
+    data[abs(data)>9990.] = float('NaN')
+    return data
+
+#######################################################
+# Create functions of decomposition
+######################################################
+
+basis=[]
+if inter=='yes':
+    basis.append(interseismic(name='interseismic',reduction='lin',date=datemin))
+if seasonal=='yes':
+    basis.append(cosvar(name='seas. var (cos)',reduction='coswt',date=datemin))
+    basis.append(sinvar(name='seas. var (sin)',reduction='sinwt',date=datemin))
+if semianual=='yes':
+     basis.append(cos2var(name='semi-anual var (cos)',reduction='cosw2t',date=datemin))
+     basis.append(sin2var(name='semi-anual var (sin)',reduction='sinw2t',date=datemin))
+for i in xrange(len(cos)):
+    basis.append(coseismic(name='coseismic {}'.format(i),reduction='cos{}'.format(i),date=cos[i]))
+for i in xrange(len(pos)):
+    if pos[i] > 0. :
+        basis.append(postseismic(name='postseismic {}'.format(i),reduction='post{}'.format(i),date=cos[i],tcar=pos[i]))
+Mbasis = len(basis)
+if Mbasis == 0:
+    raise Exception("No temporal function to invert, set at least --interseismic=yes")
+
+# components and LOS files
+if northf is None:
+    comps, losf = ['east','up'], [eastf,upf]
+else:
+    comps, losf = ['east','north','up'], [eastf,northf,upf]
+    if ntrack < 3:
+        print 'Warning: less than 3 tracks to solve for the North component, North will be poorly constrained'
+Ncomp = len(comps)
+
+# unknowns: one offset per track then Mbasis functions per component
+M = ntrack + Ncomp*Mbasis
+print 'Number of tracks:', ntrack
+print 'Number of basis functions:', Mbasis
+print 'Components:', comps
+print 'Number of parameters per pixel:', M
+print
+print 'Basis functions, Time:'
+for i in xrange((Mbasis)):
+    basis[i].info()
+
+# temporal design matrices of each track (dates x basis), computed once
+H = []
+for t in xrange(ntrack):
+    Ht = np.zeros((Nt[t],Mbasis))
+    for l in xrange((Mbasis)):
+        Ht[:,l] = basis[l].g(np.copy(dates[t]))
+    H.append(Ht)
+# outer products of the basis functions for each date (dates x Mbasis*Mbasis)
+HH = [(Ht[:,:,np.newaxis]*Ht[:,np.newaxis,:]).reshape(Ht.shape[0],Mbasis*Mbasis) for Ht in H]
+
+#######################################################
+# Prepare memory mapped outputs
+#######################################################
+
+nl, nc = iend-ibeg, jend-jbeg
+
+def create_output(outfile):
+    return np.memmap(outfile,dtype=np.float32,mode='w+',shape=(nl,nc))
+
+outputs, sigoutputs = {}, {}
+for c in xrange(Ncomp):
+    for l in xrange(Mbasis):
+        name = '{}_{}'.format(comps[c],basis[l].reduction)
+        outputs[name] = create_output('{}_coeff.r4'.format(name))
+        sigoutputs[name] = create_output('{}_sigcoeff.r4'.format(name))
+for t in xrange(ntrack):
+    name = 'ref{}'.format(t)
+    outputs[name] = create_output('{}_coeff.r4'.format(name))
+    sigoutputs[name] = create_output('{}_sigcoeff.r4'.format(name))
+rmsmap = create_output('rms_joint.r4')
+
+fid = open('lect_joint.in','w')
+np.savetxt(fid, (nc,nl),fmt='%6i',newline='\t')
+fid.close()
+
+#######################################################
+# Joint inversion by blocks of lines
+#######################################################
+
+for i0 in xrange(ibeg,iend,tile):
+    i1 = min(i0+tile,iend)
+    npix = (i1-i0)*nc
+    print 'Lines {} to {}...'.format(i0,i1)
+
+    # accumulate normal equations of all tracks: A m = B
+    A = np.zeros((npix,M,M))
+    B = np.zeros((npix,M))
+    ndata = np.zeros((npix))
+    nvalid = np.zeros((npix,ntrack))
+    # data, weights and LOS of each track, kept for the residuals
+    blocks = []
+
+    for t in xrange(ntrack):
+        # read and reference block of the cube
+        d = np.array(maps[t][i0:i1,jbeg:jend,:],dtype=np.float64).reshape(npix,Nt[t])
+        d[d>9990] = float('NaN')
+        d = d - d[:,imref[t]][:,np.newaxis]
+        d[d==0.0] = float('NaN')
+        d[:,imref[t]] = 0.
+        w = (~np.isnan(d)).astype(np.float64)
+        d[np.isnan(d)] = 0.
+
+        # LOS unit vectors of the block
+        los = np.zeros((npix,Ncomp))
+        for c in xrange(Ncomp):
+            los[:,c] = read_tile(losf[c][t],i0,i1)[:,jbeg:jend].flatten()
+        w[np.isnan(los).any(axis=1)] = 0.
+        los[np.isnan(los)] = 0.
+        nvalid[:,t] = w.sum(axis=1)
+
+        # reduced sums over the dates of the track
+        S0 = nvalid[:,t]
+        S1 = np.dot(w,H[t])
+        S2 = np.dot(w,HH[t]).reshape(npix,Mbasis,Mbasis)
+        R0 = (w*d).sum(axis=1)
+        R1 = np.dot(w*d,H[t])
+
+        # offset of the track
+        A[:,t,t] += S0
+        B[:,t] += R0
+        for c in xrange(Ncomp):
+            sc = slice(ntrack+c*Mbasis,ntrack+(c+1)*Mbasis)
+            A[:,t,sc] += los[:,c][:,np.newaxis]*S1
+            A[:,sc,t] += los[:,c][:,np.newaxis]*S1
+            B[:,sc] += los[:,c][:,np.newaxis]*R1
+            for cc in xrange(Ncomp):
+                scc = slice(ntrack+cc*Mbasis,ntrack+(cc+1)*Mbasis)
+                A[:,sc,scc] += (los[:,c]*los[:,cc])[:,np.newaxis,np.newaxis]*S2
+        ndata += S0
+        blocks.append((d,w,los))
+
+    # keep pixels with enough dates on every track
+    kk = np.flatnonzero(np.all(nvalid > Nt[np.newaxis,:]/6,axis=1))
+    m = np.ones((npix,M))*float('NaN')
+    sigmam = np.ones((npix,M))*float('NaN')
+    rms = np.ones((npix))*float('NaN')
+    # normal equations of the valid pixels only
+    A, B = A[kk], B[kk]
+    if len(kk) > 0:
+        # batched pseudo inverse of the normal matrices
+        Ainv = np.linalg.pinv(A,rcond=rcond)
+        mk = np.einsum('pij,pj->pi',Ainv,B)
+        # misfit from the residuals of all dates of all tracks
+        res2 = np.zeros((len(kk)))
+        for t in xrange(ntrack):
+            d, w, los = blocks[t]
+            pred = np.ones((len(kk),Nt[t]))*mk[:,t][:,np.newaxis]
+            for c in xrange(Ncomp):
+                sc = slice(ntrack+c*Mbasis,ntrack+(c+1)*Mbasis)
+                pred += los[kk,c][:,np.newaxis]*np.dot(mk[:,sc],H[t].T)
+            res2 += (w[kk]*(d[kk] - pred)**2).sum(axis=1)
+            del pred
+        dof = np.maximum(ndata[kk]-M,1)
+        m[kk] = mk
+        sigmam[kk] = np.sqrt((res2/dof)[:,np.newaxis]*np.abs(np.diagonal(Ainv,axis1=1,axis2=2)))
+        rms[kk] = np.sqrt(res2/ndata[kk])
+    del A, B, blocks
+
+    # save block
+    for t in xrange(ntrack):
+        name = 'ref{}'.format(t)
+        outputs[name][i0-ibeg:i1-ibeg,:] = m[:,t].reshape(i1-i0,nc)
+        sigoutputs[name][i0-ibeg:i1-ibeg,:] = sigmam[:,t].reshape(i1-i0,nc)
+    for c in xrange(Ncomp):
+        for l in xrange(Mbasis):
+            name = '{}_{}'.format(comps[c],basis[l].reduction)
+            outputs[name][i0-ibeg:i1-ibeg,:] = m[:,ntrack+c*Mbasis+l].reshape(i1-i0,nc)
+            sigoutputs[name][i0-ibeg:i1-ibeg,:] = sigmam[:,ntrack+c*Mbasis+l].reshape(i1-i0,nc)
+    rmsmap[i0-ibeg:i1-ibeg,:] = rms.reshape(i1-i0,nc)
+
+for name in outputs.keys():
+    outputs[name].flush()
+    sigoutputs[name].flush()
+rmsmap.flush()
+
+#######################################################
+# Save functions in tif
+#######################################################
+
+if geotiff is not None:
+    for name in sorted(outputs.keys()):
+        for suffix, out in [('coeff',outputs[name]),('sigcoeff',sigoutputs[name])]:
+            ds = driver.Create('{}_{}.tif'.format(name,suffix), nc, nl, 1, gdal.GDT_Float32)
+            band = ds.GetRasterBand(1)
+            band.WriteArray(out)
+            ds.SetGeoTransform(gt)
+            ds.SetProjection(proj)
+            band.FlushCache()
+            del ds
+
+#######################################################
+# Plot
+#######################################################
+
+if plot=='yes':
+    fig = plt.figure(0,figsize=(14,8))
+    for c in xrange(Ncomp):
+        for l in xrange(Mbasis):
+            # decimated quick-look of the coefficient
+            data = quicklook.decimate(outputs['{}_{}'.format(comps[c],basis[l].reduction)])
+            vmax = np.abs([np.nanpercentile(data,98.),np.nanpercentile(data,2.)]).max()
+            ax = fig.add_subplot(Ncomp,Mbasis,c*Mbasis+l+1)
+            cax = ax.imshow(data,cmap=cm.jet,vmax=vmax,vmin=-vmax)
+            ax.set_title('{} {}'.format(comps[c],basis[l].reduction),fontsize=6)
+            plt.setp(ax.get_xticklabels(), visible=False)
+            plt.setp(ax.get_yticklabels(), visible=False)
+            fig.colorbar(cax, orientation='vertical',shrink=0.5)
+    plt.suptitle('Joint time series decomposition')
+    fig.savefig('inversion_joint.eps', format='EPS',dpi=150)
+    plt.show()
@@ -14,29 +14,34 @@ add_rmg.py
 -------------
 Add, substract, and plot RMG (BIL) unwrapped files.
 
-Usage: add_rmg.py --infile=<path> --outfile=<path> [--add=<path>] [--remove=<path>] [--plot=<yes/no>]
+Usage: add_rmg.py (--infile=<path> --outfile=<path> | --list=<path>) [--add=<path>] [--remove=<path>] [--plot=<yes/no>] [--prefetch=<value>]
 
 Options:
 -h --help           Show this screen.
 --infile PATH       Input interferogram
 --outfile PATH      Output interferogram
+--list PATH         Text file of two columns (input interferogram, output interferogram) to add or remove the same models to several interferograms
 --add PATH          Model to be added [Optional]
 --remove PATH       Model to be removed [Optional]
 --plot VALUE        Display [default:no]
+--prefetch VALUE    Number of interferograms read ahead and written behind in background, 0 to disable [default: 2]
 """
 
-import gdal
 import numpy as np
 import matplotlib as mpl
 import matplotlib.pyplot as plt
 import matplotlib.cm as cm
 from pylab import *
 import docopt
+import prefetch
+import roipac
 
 # read arguments
 arguments = docopt.docopt(__doc__)
-infile = arguments["--infile"]
-outfile = arguments["--outfile"]
+if arguments["--list"] == None:
+    files = [(arguments["--infile"], arguments["--outfile"])]
+else:
+    files = [tuple(f) for f in np.atleast_2d(np.loadtxt(arguments["--list"], comments="#", dtype=str))[:,:2]]
 if arguments["--add"] == None:
     add = 'no'
 else:
@@ -53,137 +58,125 @@ if arguments["--plot"] == None:
     plot = 'no'
 else:
     plot = arguments["--plot"]
+if arguments["--prefetch"] == None:
+    nprefetch = 2
+else:
+    nprefetch = int(arguments["--prefetch"])
 
-print infile
 print add
 print remove
 
-gdal.UseExceptions()
-# Open int
-ds = gdal.Open(infile,gdal.GA_ReadOnly)
-ds_band1 = ds.GetRasterBand(1)
-ds_band2 = ds.GetRasterBand(2)
-
-# Attributes
-print("> Driver:   ", ds.GetDriver().ShortName)
-print("> Size:     ", ds.RasterXSize,'x',ds.RasterYSize,'x',ds.RasterCount)
-print("> Datatype: ", gdal.GetDataTypeName(ds_band2.DataType))
-print
-
-amp = ds_band1.ReadAsArray(0, 0, ds.RasterXSize, ds.RasterYSize)
-phi = ds_band2.ReadAsArray(0, 0, ds.RasterXSize, ds.RasterYSize)
-nlign,ncol = ds.RasterYSize, ds.RasterXSize
-temp = np.copy(phi)
-kk = np.nonzero(temp==0.0)
-temp[kk]=np.float('NaN')
-
-del ds
-
+# models are read once for all the interferograms: second band mapped in memory
 if remove is not "no":
-    ds = gdal.Open(remove,gdal.GA_ReadOnly)
-    print("> Driver:   ", ds.GetDriver().ShortName)
-    print("> Size:     ", ds.RasterXSize,'x',ds.RasterYSize,'x',ds.RasterCount)
-    print("> Datatype: ", gdal.GetDataTypeName(ds_band2.DataType))
+    remove_map = roipac.open_unw(remove).phi
+    print("> Size:     ", remove_map.shape[1],'x',remove_map.shape[0],'x',2)
     print
-    ds_band2 = ds.GetRasterBand(2)
-    remphi = ds_band2.ReadAsArray(0, 0, ds.RasterXSize, ds.RasterYSize)[:nlign,:ncol]
-    temp -= remphi
-    del ds
 
 #Open new model
 if add is not "no":
-    ds = gdal.Open(add,gdal.GA_ReadOnly)
-    print("> Driver:   ", ds.GetDriver().ShortName)
-    print("> Size:     ", ds.RasterXSize,'x',ds.RasterYSize,'x',ds.RasterCount)
-    print("> Datatype: ", gdal.GetDataTypeName(ds_band2.DataType))
+    add_map = roipac.open_unw(add).phi
+    print("> Size:     ", add_map.shape[1],'x',add_map.shape[0],'x',2)
     print
-    ds_band2 = ds.GetRasterBand(2)
-    addphi = ds_band2.ReadAsArray(0, 0, ds.RasterXSize, ds.RasterYSize)[:nlign,:ncol]
+
+# read the next interferograms and write the new ones during the computations
+reader = prefetch.Reader(lambda f: roipac.read_unw(f[0]), files, depth=nprefetch)
+writer = prefetch.Writer(depth=nprefetch)
+for (infile, outfile), (amp, phi) in reader:
+
+  print infile
+  nlign,ncol = np.shape(phi)
+  print("> Size:     ", ncol,'x',nlign)
+  print
+
+  temp = np.copy(phi)
+  kk = np.nonzero(temp==0.0)
+  temp[kk]=np.float('NaN')
+
+  if remove is not "no":
+    remphi = remove_map[:nlign,:ncol]
+    temp -= remphi
+
+  if add is not "no":
+    addphi = add_map[:nlign,:ncol]
     temp += addphi
-    del ds
-
-kk = np.nonzero(temp > -10000)
-out = np.zeros((nlign,ncol))
-out[kk]=temp[kk]
-
-# Create new file
-drv = gdal.GetDriverByName("roi_pac")
-# Creer l'image, avec le chemin, largeur, hauteur
-dst_ds = drv.Create(outfile, ncol, nlign, 2, gdal.GDT_Float32)
-# Sortir les 2 bandes (float)
-dst_band1 = dst_ds.GetRasterBand(1)
-dst_band2 = dst_ds.GetRasterBand(2)
-# Write new data
-dst_band1.WriteArray(amp,0,0)
-dst_band2.WriteArray(out,0,0)
-# close image
-del dst_ds
-
-# plot
-if plot=="yes":
-  if remove is not "no" and add is not "no":
-    vmax = np.percentile(phi, 98)
-    fig = plt.figure(0,figsize=(8,9))
-    # data
-    ax = fig.add_subplot(1,4,1)
-    cax = ax.imshow(phi,cmap=cm.gist_rainbow,vmax=vmax)
-    ax.set_title('infile')
-    setp( ax.get_xticklabels(), visible=False)
-    # remove
-    ax = fig.add_subplot(1,4,2)
-    cax = ax.imshow(remphi,cmap=cm.gist_rainbow,vmax=vmax)
-    ax.set_title('remove')
-    setp( ax.get_xticklabels(), visible=False)
-    # model
-    ax = fig.add_subplot(1,4,3)
-    cax = ax.imshow(addphi,cmap=cm.gist_rainbow,vmax=vmax)
-    ax.set_title('add')
-    setp( ax.get_xticklabels(), visible=False)
-    # output
-    #vmax = np.percentile(out, 98)
-    ax = fig.add_subplot(1,4,4)
-    cax = ax.imshow(out,cmap=cm.gist_rainbow,vmax=vmax)
-    ax.set_title('outfile')
-    setp( ax.get_xticklabels(), visible=False)
+
+  kk = np.nonzero(temp > -10000)
+  out = np.zeros((nlign,ncol))
+  out[kk]=temp[kk]
+
+  # Create new file
+  writer.put(roipac.write_unw, outfile, amp, out, infile + '.rsc')
+
+  # plot
+  if plot=="yes":
+    if remove is not "no" and add is not "no":
+      vmax = np.percentile(phi, 98)
+      fig = plt.figure(0,figsize=(8,9))
+      # data
+      ax = fig.add_subplot(1,4,1)
+      cax = ax.imshow(phi,cmap=cm.gist_rainbow,vmax=vmax)
+      ax.set_title('infile')
+      setp( ax.get_xticklabels(), visible=False)
+      # remove
+      ax = fig.add_subplot(1,4,2)
+      cax = ax.imshow(remphi,cmap=cm.gist_rainbow,vmax=vmax)
+      ax.set_title('remove')
+      setp( ax.get_xticklabels(), visible=False)
+      # model
+      ax = fig.add_subplot(1,4,3)
+      cax = ax.imshow(addphi,cmap=cm.gist_rainbow,vmax=vmax)
+      ax.set_title('add')
+      setp( ax.get_xticklabels(), visible=False)
+      # output
+      #vmax = np.percentile(out, 98)
+      ax = fig.add_subplot(1,4,4)
+      cax = ax.imshow(out,cmap=cm.gist_rainbow,vmax=vmax)
+      ax.set_title('outfile')
+      setp( ax.get_xticklabels(), visible=False)
   
-  elif add is not "no":
-    vmax = np.percentile(phi, 98)
-    fig = plt.figure(0,figsize=(8,9))
-    # data
-    ax = fig.add_subplot(1,3,1)
-    cax = ax.imshow(phi,cmap=cm.gist_rainbow,vmax=vmax)
-    ax.set_title('infile')
-    setp( ax.get_xticklabels(), visible=False)
-    # model
-    ax = fig.add_subplot(1,3,2)
-    cax = ax.imshow(addphi,cmap=cm.gist_rainbow,vmax=vmax)
-    ax.set_title('add')
-    setp( ax.get_xticklabels(), visible=False)
-    # output
-    #vmax = np.percentile(out, 98)
-    ax = fig.add_subplot(1,3,3)
-    cax = ax.imshow(out,cmap=cm.gist_rainbow,vmax=vmax)
-    ax.set_title('outfile')
-    setp( ax.get_xticklabels(), visible=False)
-
-  else:
-    vmax = np.percentile(phi, 98)
-    fig = plt.figure(0,figsize=(8,9))
-    # data
-    ax = fig.add_subplot(1,3,1)
-    cax = ax.imshow(phi,cmap=cm.gist_rainbow,vmax=vmax)
-    ax.set_title('infile')
-    setp( ax.get_xticklabels(), visible=False)
-    # remove
-    ax = fig.add_subplot(1,3,2)
-    cax = ax.imshow(remphi,cmap=cm.gist_rainbow,vmax=vmax)
-    ax.set_title('remove')
-    setp( ax.get_xticklabels(), visible=False)
-    # output
-    #vmax = np.percentile(out, 98)
-    ax = fig.add_subplot(1,3,3)
-    cax = ax.imshow(out,cmap=cm.gist_rainbow,vmax=vmax)
-    ax.set_title('outfile')
-    setp( ax.get_xticklabels(), visible=False)
-
-plt.show()
+    elif add is not "no":
+      vmax = np.percentile(phi, 98)
+      fig = plt.figure(0,figsize=(8,9))
+      # data
+      ax = fig.add_subplot(1,3,1)
+      cax = ax.imshow(phi,cmap=cm.gist_rainbow,vmax=vmax)
+      ax.set_title('infile')
+      setp( ax.get_xticklabels(), visible=False)
+      # model
+      ax = fig.add_subplot(1,3,2)
+      cax = ax.imshow(addphi,cmap=cm.gist_rainbow,vmax=vmax)
+      ax.set_title('add')
+      setp( ax.get_xticklabels(), visible=False)
+      # output
+      #vmax = np.percentile(out, 98)
+      ax = fig.add_subplot(1,3,3)
+      cax = ax.imshow(out,cmap=cm.gist_rainbow,vmax=vmax)
+      ax.set_title('outfile')
+      setp( ax.get_xticklabels(), visible=False)
+
+    else:
+      vmax = np.percentile(phi, 98)
+      fig = plt.figure(0,figsize=(8,9))
+      # data
+      ax = fig.add_subplot(1,3,1)
+      cax = ax.imshow(phi,cmap=cm.gist_rainbow,vmax=vmax)
+      ax.set_title('infile')
+      setp( ax.get_xticklabels(), visible=False)
+      # remove
+      ax = fig.add_subplot(1,3,2)
+      cax = ax.imshow(remphi,cmap=cm.gist_rainbow,vmax=vmax)
+      ax.set_title('remove')
+      setp( ax.get_xticklabels(), visible=False)
+      # output
+      #vmax = np.percentile(out, 98)
+      ax = fig.add_subplot(1,3,3)
+      cax = ax.imshow(out,cmap=cm.gist_rainbow,vmax=vmax)
+      ax.set_title('outfile')
+      setp( ax.get_xticklabels(), visible=False)
+
+  plt.show()
+
+writer.close()
+if len(files) > 1:
+  reader.report()
+  writer.report()
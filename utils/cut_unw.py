@@ -39,51 +39,26 @@ from pylab import *
 
 import os, sys
 
-import gdal
 import time
 
 # docopt (command line parser)
 import docopt
 
+# ROI_PAC files
+import roipac
+
 # read arguments
 arguments = docopt.docopt(__doc__)
 infile = arguments["--infile"]
 outfile = arguments["--outfile"]
 plot = arguments["--plot"]
 
-gdal.UseExceptions()
-# Open dataset (image)
-ds = gdal.Open(infile, gdal.GA_ReadOnly)
-
-# Ok, assume this is a roipac image, so we can rely on the file extension
-# to know how to display the data (in the real world, we would probably write
-# different programs)
-ds_extension = os.path.splitext(infile)[1]
-
-# Get the band that have the data we want
-ds_band1 = ds.GetRasterBand(1)
-ds_band2 = ds.GetRasterBand(2)
+# Read both bands of the image in one sequential read
+amp, data = roipac.read_unw(infile)
+nlign,ncol = np.shape(data)
 
 # Attributes
-print("> Driver:   ", ds.GetDriver().ShortName)
-print("> Size:     ", ds.RasterXSize,'x',ds.RasterYSize,'x',ds.RasterCount)
-print("> Datatype: ", gdal.GetDataTypeName(ds_band2.DataType))
-
-# Read data in numpy array, resampled by a factor of 4
-#   Resampling is nearest neighbour with that function: hardly acceptable,
-#   but easy for a simple demo!
-amp = ds_band1.ReadAsArray(0, 0, ds.RasterXSize, ds.RasterYSize)
-data = ds_band2.ReadAsArray(0, 0, ds.RasterXSize, ds.RasterYSize)
-nlign,ncol = ds.RasterYSize, ds.RasterXSize
-
-# Close dataset (if this was a new image, it would be written at this moment)
-# This will free memory for the display stuff
-try:
-    del ds
-    print('... waiting ...')
-    time.sleep(0.5)
-except:
-    sys.exit(1)
+print("> Size:     ", ncol,'x',nlign,'x',2)
 
 if arguments["<ibeg>"] ==  None:
     ibeg = 0
@@ -115,23 +90,8 @@ cutdata[iend:nlign] = 0
 cutdata[0:jbeg] = 0
 cutdata[jend:ncol] = 0
 
-# create new GDAL imaga
-# recupérer driver ROI_PAC
-drv = gdal.GetDriverByName("roi_pac")
-# Creer l'image, avec le chemin, largeur, hauteur
-dst_ds = drv.Create(outfile, ncol, nlign, 2, gdal.GDT_Float32)
-# Sortir les 2 bandes (float)
-dst_band1 = dst_ds.GetRasterBand(1)
-dst_band2 = dst_ds.GetRasterBand(2)
-
-# write in the output file 
-# dst_band2.WriteArray(array2, 0, y) pour ajouter une ligne
-# dst_band1.WriteArray(data, 0, 0) pour ajouter un tableau 2d
-dst_band1.WriteArray(cutamp,0,0)
-dst_band2.WriteArray(cutdata,0,0)
-
-# close image
-del dst_ds
+# create new ROI_PAC file, written in one sequential pass
+roipac.write_unw(outfile, cutamp, cutdata, infile + '.rsc')
 
 # save output
 #fid2 = open(outfile,'wb')
@@ -13,15 +13,17 @@ mask_unw.py
 -------------
 Mask unwrapped interferogram (BIL format) given a mask file in real4 format.
 
-Usage: mask_unw.py --infile=<path> --maskfile=<path> --outfile=<path> --threshold=<value> --plot=<yes/no>
+Usage: mask_unw.py (--infile=<path> --outfile=<path> | --list=<path>) --maskfile=<path> --threshold=<value> --plot=<yes/no> [--prefetch=<value>]
 
 Options:
 -h --help           Show this screen.
 --infile PATH       File to be masked
 --maskfile PATH     File to mask int
 --outfile PATH      Masked int
+--list PATH         Text file of two columns (file to be masked, masked int) to mask several interferograms with the same mask
 --threshold         Threshold for the mask (mask pixels < threshold)
 --plot VALUE        Display interferograms
+--prefetch VALUE    Number of interferograms read ahead and written behind in background, 0 to disable [default: 2]
 """
 
 
@@ -37,77 +39,72 @@ from pylab import *
 
 import os, sys
 
-import gdal
 import time
 
 # docopt (command line parser)
 import docopt
 
+# read-ahead of the interferograms
+import prefetch
+import roipac
+
 # read arguments
 arguments = docopt.docopt(__doc__)
-infile = arguments["--infile"]
+if arguments["--list"] ==  None:
+    files = [(arguments["--infile"], arguments["--outfile"])]
+else:
+    files = [tuple(f) for f in np.atleast_2d(np.loadtxt(arguments["--list"], comments="#", dtype=str))[:,:2]]
 maskfile = arguments["--maskfile"] 
-outfile = arguments["--outfile"]
 seuil = float(arguments["--threshold"])
 plot = arguments["--plot"]
-
-gdal.UseExceptions()
-# Open dataset (image)
-ds = gdal.Open(infile, gdal.GA_ReadOnly)
-# Get the band that have the data we want
-ds_band1 = ds.GetRasterBand(1)
-ds_band2 = ds.GetRasterBand(2)
-# Attributes
-print("> Driver:   ", ds.GetDriver().ShortName)
-print("> Size:     ", ds.RasterXSize,'x',ds.RasterYSize,'x',ds.RasterCount)
-print("> Datatype: ", gdal.GetDataTypeName(ds_band2.DataType))
-amp = ds_band1.ReadAsArray(0, 0, ds.RasterXSize, ds.RasterYSize)
-data = ds_band2.ReadAsArray(0, 0, ds.RasterXSize, ds.RasterYSize)
-nlign,ncol = ds.RasterYSize, ds.RasterXSize
-del ds
-
-# Open mask
-ds2 = gdal.Open(maskfile, gdal.GA_ReadOnly)
-ds2_band1 = ds2.GetRasterBand(1)
-ds2_band2 = ds2.GetRasterBand(2)
-print("> Driver:   ", ds2.GetDriver().ShortName)
-print("> Size:     ", ds2.RasterXSize,'x',ds2.RasterYSize,'x',ds2.RasterCount)
-print("> Datatype: ", gdal.GetDataTypeName(ds2_band2.DataType))
-maskamp = ds2_band1.ReadAsArray(0, 0, ds2.RasterXSize, ds2.RasterYSize)
-maskdata = ds2_band2.ReadAsArray(0, 0, ds2.RasterXSize, ds2.RasterYSize)
-del ds2
-
-# clean
-outamp = np.copy(amp)
-outdata = np.copy(data)
-kk = np.nonzero(maskdata[:nlign,:ncol]>seuil)
-outdata[kk], outamp[kk] = 0, 0
-
-# create new GDAL image
-drv = gdal.GetDriverByName("roi_pac")
-dst_ds = drv.Create(outfile, ncol, nlign, 2, gdal.GDT_Float32)
-dst_band1 = dst_ds.GetRasterBand(1)
-dst_band2 = dst_ds.GetRasterBand(2)
-dst_band1.WriteArray(outamp,0,0)
-dst_band2.WriteArray(outdata,0,0)
-del dst_ds
-
-if plot=="yes":
-      vmax = np.percentile(data, 98)
-      # Plot
-      fig = plt.figure(0,figsize=(8,9))
-      ax = fig.add_subplot(1,2,1)
-      cax = ax.imshow(data,cmap=cm.gist_rainbow,vmax=vmax)
-      ax.set_title(infile)
-      setp( ax.get_xticklabels(), visible=False)
-
-      ax = fig.add_subplot(1,2,2)
-      cax = ax.imshow(outdata,cmap=cm.gist_rainbow,vmax=vmax)
-      ax.set_title(outfile)
-      setp( ax.get_xticklabels(), visible=False)
-
-      cbar = fig.colorbar(cax, orientation='vertical',aspect=5)
-
-      # Display the data
-      fig.canvas.set_window_title(sys.argv[1])
-      plt.show()
+if arguments["--prefetch"] ==  None:
+    nprefetch = 2
+else:
+    nprefetch = int(arguments["--prefetch"])
+
+# Open mask: second band mapped in memory
+mask = roipac.open_unw(maskfile)
+print("> Size:     ", mask.ncol,'x',mask.nlign,'x',2)
+maskdata = mask.phi
+
+# read the next interferograms and write the masked ones while masking
+reader = prefetch.Reader(lambda f: roipac.read_unw(f[0]), files, depth=nprefetch)
+writer = prefetch.Writer(depth=nprefetch)
+for (infile, outfile), (amp, data) in reader:
+    nlign,ncol = np.shape(data)
+    print(infile)
+    print("> Size:     ", ncol,'x',nlign)
+
+    # clean
+    outamp = np.copy(amp)
+    outdata = np.copy(data)
+    kk = np.nonzero(maskdata[:nlign,:ncol]>seuil)
+    outdata[kk], outamp[kk] = 0, 0
+
+    # create new ROI_PAC file
+    writer.put(roipac.write_unw, outfile, outamp, outdata, infile + '.rsc')
+
+    if plot=="yes":
+          vmax = np.percentile(data, 98)
+          # Plot
+          fig = plt.figure(0,figsize=(8,9))
+          ax = fig.add_subplot(1,2,1)
+          cax = ax.imshow(data,cmap=cm.gist_rainbow,vmax=vmax)
+          ax.set_title(infile)
+          setp( ax.get_xticklabels(), visible=False)
+
+          ax = fig.add_subplot(1,2,2)
+          cax = ax.imshow(outdata,cmap=cm.gist_rainbow,vmax=vmax)
+          ax.set_title(outfile)
+          setp( ax.get_xticklabels(), visible=False)
+
+          cbar = fig.colorbar(cax, orientation='vertical',aspect=5)
+
+          # Display the data
+          fig.canvas.set_window_title(sys.argv[1])
+          plt.show()
+
+writer.close()
+if len(files) > 1:
+    reader.report()
+    writer.report()